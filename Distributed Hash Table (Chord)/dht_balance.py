@@ -0,0 +1,140 @@
+import argparse
+import collections
+import hashlib
+import itertools
+import random
+import statistics
+
+import dht_node
+
+KEY_SETS = ("sequential", "random", "words")
+
+
+def read_hosts(host_file):
+    """
+    Read the nodes of a host file.
+    :param host_file: Path to a file of "<host> <port> [weight]" lines.
+    :return: List of (host, port, weight).
+    """
+    hosts = []
+    with open(host_file) as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                hosts.append((fields[0], fields[1], float(fields[2]) if len(fields) > 2 else 1.0))
+    return hosts
+
+
+def synthetic_hosts(count, weights):
+    """
+    Nodes on consecutive localhost ports, their weights taken in turn from a list.
+    :param count: Number of nodes.
+    :param weights: List of weights.
+    :return: List of (host, port, weight).
+    """
+    return [("127.0.0.1", str(20000 + i), weight) for i, weight in zip(range(count), itertools.cycle(weights))]
+
+
+def synthetic_keys(kind, count, seed):
+    """
+    Generate a key set.
+    :param kind: "sequential" for key0, key1, ...; "random" for random hex strings; "words" for
+    user:<id>/<field> keys over a few thousand users.
+    :param count: Number of keys.
+    :param seed: Random seed.
+    :return: List of key strings.
+    """
+    rng = random.Random(seed)
+    if kind == "sequential":
+        return ["key" + str(i) for i in range(count)]
+    if kind == "random":
+        return ["%032x" % rng.getrandbits(128) for _ in range(count)]
+    fields = ("name", "email", "cart", "session", "avatar")
+    return ["user:" + str(rng.randrange(count // len(fields) + 1)) + "/" + rng.choice(fields) + str(i)
+            for i in range(count)]
+
+
+def ring(hosts, vnodes):
+    """
+    Build the routing state a node of the ring would have.
+    :param hosts: List of (host, port, weight).
+    :param vnodes: Virtual nodes per unit of weight.
+    :return: Node, and the weight of each Node ID.
+    """
+    members = {}
+    weights = {}
+    for host, port, weight in hosts:
+        node_id = dht_node.Node.hash_address(host, port)
+        members[node_id] = (host + " " + port, max(1, round(vnodes * weight)))
+        weights[node_id] = weight
+    node = dht_node.Node.__new__(dht_node.Node)
+    node.NODE_ID = next(iter(members))
+    node.set_members(members)
+    return node, weights
+
+
+def key_shares(node, weights, hashed_keys):
+    """
+    Count the keys each node owns, relative to its fair share of them by weight.
+    :param node: Node from ring().
+    :param weights: Weight of each Node ID.
+    :param hashed_keys: Hashed keys.
+    :return: Dictionary of owned keys by Node ID, and of owned keys over the fair share by Node ID.
+    """
+    owned = collections.Counter(node.successor_of(x) for x in hashed_keys)
+    total_weight = sum(weights.values())
+    shares = {node_id: owned[node_id] / (len(hashed_keys) * weight / total_weight)
+              for node_id, weight in weights.items()}
+    return owned, shares
+
+
+def report(hosts, vnode_counts, hashed_keys, per_node):
+    """
+    Print how evenly keys spread over the nodes for each virtual node count.
+    :param hosts: List of (host, port, weight).
+    :param vnode_counts: Virtual nodes per unit of weight to compare.
+    :param hashed_keys: Hashed keys.
+    :param per_node: Also list every node's share.
+    """
+    for vnodes in vnode_counts:
+        node, weights = ring(hosts, vnodes)
+        owned, shares = key_shares(node, weights, hashed_keys)
+        ratios = sorted(shares.values())
+        # The busiest node saturates first, so its share sets the ring's capacity
+        print('vnodes {vnodes:>4}  positions {positions:>6}  of fair share: busiest {busiest:>5.2f}x  '
+              'idlest {idlest:>5.2f}x  stdev {stdev:>5.2f}  capacity {capacity:>6.1%}'.format(
+                  vnodes=vnodes, positions=len(node.POSITIONS), busiest=ratios[-1], idlest=ratios[0],
+                  stdev=statistics.pstdev(ratios), capacity=1 / ratios[-1]))
+        if per_node:
+            for node_id in sorted(weights, key=shares.get, reverse=True):
+                print('    {location:<22} weight {weight:>5.2f}  keys {keys:>8,}  {share:>5.2f}x'.format(
+                    location=node.get_loc_key(node_id).strip(), weight=weights[node_id], keys=owned[node_id],
+                    share=shares[node_id]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report how evenly a DHT ring spreads keys over its nodes "
+                                                 "with different numbers of virtual nodes.")
+    parser.add_argument("--host-file", help="ring to report on (default: synthetic localhost nodes)")
+    parser.add_argument("--nodes", type=int, default=32, help="number of synthetic nodes")
+    parser.add_argument("--weights", default="1", help="comma separated weights given to synthetic nodes in turn")
+    parser.add_argument("--vnodes", default="1,8,32,128", help="comma separated virtual nodes per unit of weight")
+    parser.add_argument("--keys", type=int, default=200000)
+    parser.add_argument("--key-set", default="sequential", choices=KEY_SETS)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--per-node", action="store_true", help="list every node's share")
+    args = parser.parse_args()
+
+    if args.host_file:
+        hosts = read_hosts(args.host_file)
+    else:
+        hosts = synthetic_hosts(args.nodes, [float(w) for w in args.weights.split(",")])
+    hashed_keys = [int(hashlib.sha1(key.encode()).hexdigest(), 16)
+                   for key in synthetic_keys(args.key_set, args.keys, args.seed)]
+    print("{nodes} nodes, {keys:,} {kind} keys, capacity is the ring's throughput relative to a perfect spread".format(
+        nodes=len(hosts), keys=len(hashed_keys), kind=args.key_set))
+    report(hosts, [int(v) for v in args.vnodes.split(",")], hashed_keys, args.per_node)
+
+
+if __name__ == '__main__':
+    main()
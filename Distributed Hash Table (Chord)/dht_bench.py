@@ -0,0 +1,293 @@
+import argparse
+import hashlib
+import random
+import timeit
+
+import dht_node
+import dht_protocol
+
+SOURCE_ADDRESS = ('127.0.0.1', 11190)
+NEXT_NODE = 12345
+VALUE_SIZES = (8, 1024, 16384)
+RING_SIZES = (4, 16, 64, 256)
+LOOKUPS = 2000
+
+
+def text_table():
+    """
+    Build a Table just far enough to run its text parsing and forwarding code.
+    :return: Table instance.
+    """
+    table = dht_node.Table.__new__(dht_node.Table)
+    table.n = dht_node.Node.__new__(dht_node.Node)
+    table.n.nodes_key = {NEXT_NODE: "127.0.0.1 19002\n"}
+    return table
+
+
+def text_request(key, value):
+    """
+    Construct a put request the way dht_client.py does.
+    :param key: Key string.
+    :param value: Value string.
+    :return: Request datagram.
+    """
+    request = "Destination: 127.0.0.1 19001\r\n"
+    request += "Nodes Visited: 0\r\n"
+    request += "Data: put " + key + " " + value
+    return request.encode()
+
+
+def text_hop(table, data):
+    """
+    Work done by an intermediate node on a text request: parse it, hash the key and rebuild it.
+    :param table: Table from text_table().
+    :param data: Received request datagram.
+    :return: Request for the next node and its address.
+    """
+    context = table.parse_request(data, SOURCE_ADDRESS)
+    verb, key_val = context.data.split(" ", 1)
+    key, val = key_val.strip().split()
+    int(hashlib.sha1(key.encode()).hexdigest(), 16)
+    return table.go_next(context, NEXT_NODE)
+
+
+def binary_hop(data):
+    """
+    Work done by an intermediate node on a binary request: decode it, read the carried key digest
+    and patch the header for the next node.
+    :param data: Received request datagram.
+    :return: Request for the next node.
+    """
+    message = dht_protocol.decode(data)
+    int.from_bytes(message.key_hash, byteorder='big')
+    return dht_protocol.forwarded(data, SOURCE_ADDRESS, message.nodes_visited + 1)
+
+
+def per_call(function, number):
+    """
+    Time a function.
+    :param function: Callable to time.
+    :param number: Number of calls per repetition.
+    :return: Best time per call in microseconds.
+    """
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def bench(number):
+    """
+    Compare the text and binary protocols per hop, for client encoding and for message size.
+    :param number: Number of timing iterations.
+    """
+    table = text_table()
+    key = "user:1234567"
+    for size in VALUE_SIZES:
+        value = "v" * size
+        text_data = text_request(key, value)
+        binary_message = dht_protocol.request(dht_protocol.PUT, key.encode(), value.encode())
+        binary_data = dht_protocol.encode(binary_message)
+
+        print('value {size:>6} B   size text {text_size:>6} B  binary {binary_size:>6} B'.format(
+            size=size, text_size=len(text_data), binary_size=len(binary_data)))
+        print('    encode  text {text:>7.2f} us   binary {binary:>7.2f} us'.format(
+            text=per_call(lambda: text_request(key, value), number),
+            binary=per_call(lambda: dht_protocol.encode(
+                dht_protocol.request(dht_protocol.PUT, key.encode(), value.encode())), number)))
+        print('    per hop text {text:>7.2f} us   binary {binary:>7.2f} us'.format(
+            text=per_call(lambda: text_hop(table, text_data), number),
+            binary=per_call(lambda: binary_hop(binary_data), number)))
+        print('    decode  text {text:>7.2f} us   binary {binary:>7.2f} us'.format(
+            text=per_call(lambda: table.parse_request(text_data, SOURCE_ADDRESS), number),
+            binary=per_call(lambda: dht_protocol.decode(binary_data), number)))
+
+
+def ring_nodes(count):
+    """
+    Build the routing state of every node in a ring without starting any servers.
+    :param count: Number of nodes.
+    :return: Dictionary of Node by Node ID.
+    """
+    members = {dht_node.Node.hash_address("127.0.0.1", 20000 + i): ("127.0.0.1 " + str(20000 + i), 1)
+               for i in range(count)}
+    nodes = {}
+    for node_id in members:
+        node = dht_node.Node.__new__(dht_node.Node)
+        node.NODE_ID = node_id
+        node.set_members(members)
+        node.legacy_table = legacy_build_table(node)
+        nodes[node_id] = node
+    return nodes
+
+
+def legacy_check_successor(node, x):
+    """
+    Compare the location of x to the range between a node and its successor, as Node did before the
+    finger table was rebuilt.
+    :param node: Node.
+    :param x: Key or finger.
+    :return: True if x is in range, false if not.
+    """
+    if node.NODE_ID > node.SUCC_ID and (
+            x in range(node.NODE_ID, pow(2, node.MAX_ENT)) or x in range(0, node.SUCC_ID)):
+        return True
+    elif node.SUCC_ID > node.NODE_ID and x in range(node.NODE_ID, node.SUCC_ID):
+        return True
+    else:
+        return False
+
+
+def legacy_check_self(node, x):
+    """
+    Compare the location of x to the range between a node and its predecessor, the old way.
+    :param node: Node.
+    :param x: Key.
+    :return: True if x is in range, false if not.
+    """
+    if (node.NODE_ID > node.PRED_ID) and x in range(node.PRED_ID, node.NODE_ID):
+        return True
+    if (node.PRED_ID > node.NODE_ID) and (
+            x in range(node.PRED_ID, pow(2, node.MAX_ENT)) or x in range(0, node.NODE_ID)):
+        return True
+    else:
+        return False
+
+
+def legacy_set_successor(node, x):
+    """
+    Determine the successor of a finger by XOR distance, the old way.
+    :param node: Node.
+    :param x: Finger.
+    :return: Finger's successor.
+    """
+    successor = node.SUCC_ID
+    if legacy_check_successor(node, x):
+        return node.SUCC_ID
+    for other in node.NODES:
+        if (other ^ x) < (successor ^ x) and x < other:
+            successor = other
+    return successor
+
+
+def legacy_build_table(node):
+    """
+    Build the old finger table, with one row per host up to m rows.
+    :param node: Node.
+    :return: Finger table dictionary.
+    """
+    mod_val = pow(2, node.MAX_ENT)
+    table = {}
+    for i in range(min(node.LINE_COUNT, node.MAX_ENT)):
+        x = ((node.NODE_ID + pow(2, i)) % mod_val)
+        y = ((node.NODE_ID + pow(2, i + 1)) % mod_val)
+        table[i] = {"start": x, "end": y, "successor": legacy_set_successor(node, x)}
+    return table
+
+
+def legacy_hash_loc(node, x):
+    """
+    Determine the next hop for a hashed key the old way: scan every finger with range() membership
+    tests, then fall back to the finger successor closest to the key by XOR distance.
+    :param node: Node.
+    :param x: Hashed representation of key.
+    :return: Location of key's successor, or None if the key belongs to this node.
+    """
+    table = node.legacy_table
+    if len(table) == 1 or legacy_check_self(node, x):
+        return None
+    if legacy_check_successor(node, x):
+        return node.SUCC_ID
+    for i in range(len(table)):
+        finger = table.get(i)
+        start = finger.get("start")
+        end = finger.get("end")
+        if start > end and (x in range(start, pow(2, node.MAX_ENT)) or x in range(0, end)):
+            return finger.get("successor")
+        elif end > start and x in range(start, end):
+            return finger.get("successor")
+    successor = node.SUCC_ID
+    for i in range(len(table)):
+        finger = table.get(i)
+        if (finger.get("start") ^ x) < (successor ^ x) and x < finger.get("successor"):
+            successor = finger.get("successor")
+    return successor
+
+
+def route(nodes, node_id, x, next_hop):
+    """
+    Follow a lookup from node to node until it reaches the node that stores the key.
+    :param nodes: Ring from ring_nodes().
+    :param node_id: Node the lookup starts at.
+    :param x: Hashed representation of key.
+    :param next_hop: legacy_hash_loc or current_hash_loc.
+    :return: Number of forwards, or None if the lookup loops or ends at the wrong node.
+    """
+    hops = 0
+    while True:
+        location = next_hop(nodes[node_id], x)
+        if location is None:
+            break
+        node_id = location
+        hops += 1
+        if hops > len(nodes):
+            return None
+    return hops if nodes[node_id].successor_of(x) == node_id else None
+
+
+def current_hash_loc(node, x):
+    """
+    Determine the next hop for a hashed key with the current finger table.
+    :param node: Node.
+    :param x: Hashed representation of key.
+    :return: Location of key's successor, or None if the key belongs to this node.
+    """
+    return node.hash_loc(x)
+
+
+def hop_summary(nodes, lookups, next_hop):
+    """
+    Route random keys from random nodes.
+    :param nodes: Ring from ring_nodes().
+    :param lookups: List of (starting node, hashed key).
+    :param next_hop: legacy_hash_loc or current_hash_loc.
+    :return: Mean and maximum forwards, and the number of lookups that failed.
+    """
+    hops = [route(nodes, node_id, x, next_hop) for node_id, x in lookups]
+    delivered = [h for h in hops if h is not None]
+    mean = sum(delivered) / len(delivered) if delivered else float('nan')
+    return mean, max(delivered, default=0), len(hops) - len(delivered)
+
+
+def bench_routing(number):
+    """
+    Compare hop counts and per-lookup CPU of the old XOR routing with closest preceding finger routing.
+    :param number: Number of timing iterations.
+    """
+    rng = random.Random(1)
+    for count in RING_SIZES:
+        nodes = ring_nodes(count)
+        node_ids = list(nodes)
+        lookups = [(rng.choice(node_ids), rng.getrandbits(dht_node.Node.MAX_ENT)) for _ in range(LOOKUPS)]
+        legacy_mean, legacy_max, legacy_failed = hop_summary(nodes, lookups, legacy_hash_loc)
+        mean, most, failed = hop_summary(nodes, lookups, current_hash_loc)
+        print('{count:>4} nodes  hops legacy mean {legacy_mean:>6.2f} max {legacy_max:>4} failed {legacy_failed:>4}'
+              '   current mean {mean:>5.2f} max {most:>3} failed {failed}'.format(
+                  count=count, legacy_mean=legacy_mean, legacy_max=legacy_max, legacy_failed=legacy_failed,
+                  mean=mean, most=most, failed=failed))
+        node = nodes[node_ids[0]]
+        keys = [x for node_id, x in lookups[:100]]
+        print('             per lookup legacy {legacy:>8.2f} us   current {current:>5.2f} us'.format(
+            legacy=per_call(lambda: [legacy_hash_loc(node, x) for x in keys], max(number // 1000, 1)) / len(keys),
+            current=per_call(lambda: [node.hash_loc(x) for x in keys], max(number // 100, 1)) / len(keys)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a DHT node's per-hop request handling, text against "
+                                                 "binary, and its routing against the legacy successor walk.")
+    parser.add_argument("iterations", type=int, nargs="?", default=20000, help="calls timed per measurement")
+    args = parser.parse_args()
+
+    bench(args.iterations)
+    bench_routing(args.iterations)
+
+
+if __name__ == '__main__':
+    main()
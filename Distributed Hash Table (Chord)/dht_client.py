@@ -1,7 +1,158 @@
+import collections
+import json
 import os
+import random
 import sys
 import socket
 
+import dht_node
+import dht_protocol
+
+
+class RoutingCache:
+    """
+    Client-side copy of the ring, so requests go straight to a node that holds the key instead of hopping
+    around the ring from an entry node. Seeded from the host file and corrected from replies: a node that
+    answers without being in the copy is added to it, and keys that still needed forwarding remember the
+    node that answered them. A node sent a key it is not responsible for routes the request as usual, so a
+    stale copy costs hops, not answers. What is learned lasts as long as the object unless it is given a
+    file to keep it in, as the one-shot command line client does.
+    """
+
+    # Keys whose answering node is remembered after they needed forwarding
+    LEARNED_KEYS = 4096
+    # Suffix of the file next to the host file that the command line client keeps what it learns in
+    ROUTES_SUFFIX = ".routes"
+
+    def __init__(self, host_file, vnodes=1, replicas=dht_node.Node.REPLICAS, path=None):
+        """
+        :param host_file: Path to a file of "<host> <port> [weight]" lines, as the nodes read.
+        :param vnodes: Virtual nodes per unit of weight the nodes were started with.
+        :param replicas: Copies the nodes keep on successors; gets go to any copy.
+        :param path: File to load what earlier clients learned from and save what this one learns to,
+        or None to keep it in memory only.
+        """
+        self.VNODES = vnodes
+        self.REPLICAS = replicas
+        self.PATH = path
+        self.members = {}
+        # Nodes learned from replies that the host file does not list, and listed nodes that did not answer
+        self.added = {}
+        self.removed = set()
+        with open(host_file) as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    weight = float(fields[2]) if len(fields) > 2 else 1.0
+                    self.members[dht_node.Node.hash_address(fields[0], fields[1])] = (
+                        fields[0] + " " + fields[1], max(1, round(vnodes * weight)))
+        self.learned = collections.OrderedDict()
+        if path is not None:
+            self.load()
+        self.rebuild()
+
+    def load(self):
+        """
+        Apply what earlier clients learned, as saved in PATH, on top of the host file.
+        """
+        try:
+            with open(self.PATH) as f:
+                saved = json.load(f)
+            for node_id, (location, vnodes) in saved["added"].items():
+                self.added[int(node_id)] = (location, vnodes)
+            self.removed = {int(node_id) for node_id in saved["removed"]}
+            for key_hash, host, port in saved["learned"]:
+                self.learned[int(key_hash)] = (host, port)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(e)
+            return
+        self.members.update(self.added)
+        for node_id in self.removed:
+            if len(self.members) > 1:
+                self.members.pop(node_id, None)
+
+    def save(self):
+        """
+        Keep what has been learned in PATH for later clients, replacing the file in one rename.
+        """
+        if self.PATH is None:
+            return
+        saved = {"added": {str(node_id): list(member) for node_id, member in self.added.items()},
+                 "removed": [str(node_id) for node_id in self.removed],
+                 "learned": [[str(key_hash), host, port] for key_hash, (host, port) in self.learned.items()]}
+        try:
+            with open(self.PATH + ".tmp", "w") as f:
+                json.dump(saved, f)
+            os.replace(self.PATH + ".tmp", self.PATH)
+        except OSError as e:
+            print(e)
+
+    def rebuild(self):
+        """
+        Lay out the ring of the current members.
+        """
+        self.ring = dht_node.Node.__new__(dht_node.Node)
+        self.ring.REPLICAS = self.REPLICAS
+        self.ring.NODE_ID = next(iter(self.members))
+        self.ring.set_members(self.members)
+
+    def locate(self, key_hash, kind):
+        """
+        Pick the node to send a request to.
+        :param key_hash: Hashed representation of key.
+        :param kind: dht_protocol.GET or dht_protocol.PUT; puts go to the owner, gets to any copy.
+        :return: Host and port tuple.
+        """
+        address = self.learned.get(key_hash)
+        if address is not None:
+            return address
+        if kind == dht_protocol.GET:
+            location = random.choice(self.ring.replica_set(key_hash))
+        else:
+            location = self.ring.successor_of(key_hash)
+        return dht_node.Table.address(self.ring.get_loc_key(location))
+
+    def learn(self, key_hash, reply, server):
+        """
+        Correct the copy of the ring from a binary reply.
+        :param key_hash: Hashed representation of the key asked for.
+        :param reply: Decoded reply.
+        :param server: Address of the node that answered.
+        """
+        node_id = int.from_bytes(reply.node_hash, byteorder='big')
+        changed = False
+        if node_id not in self.members:
+            # A node that joined since the host file was written; its weight is not known, so assume 1
+            self.members[node_id] = self.added[node_id] = (server[0] + " " + str(server[1]), self.VNODES)
+            self.removed.discard(node_id)
+            self.rebuild()
+            changed = True
+        if reply.nodes_visited > 1 and reply.status == 200 and self.learned.get(key_hash) != server:
+            self.learned[key_hash] = server
+            self.learned.move_to_end(key_hash)
+            if len(self.learned) > self.LEARNED_KEYS:
+                self.learned.popitem(last=False)
+            changed = True
+        if changed:
+            self.save()
+
+    def forget(self, server):
+        """
+        Drop a node that did not answer, so its keys are sent to the nodes that take them over.
+        :param server: Host and port tuple of the node.
+        """
+        node_id = dht_node.Node.hash_address(*server)
+        if node_id in self.members and len(self.members) > 1:
+            del self.members[node_id]
+            self.added.pop(node_id, None)
+            self.removed.add(node_id)
+            self.rebuild()
+        for key_hash in [key_hash for key_hash, address in self.learned.items() if address == server]:
+            del self.learned[key_hash]
+        self.save()
+
 
 class Client:
     """
@@ -13,6 +164,8 @@ class Client:
         self.VERB = verb
         self.KEY = key
         self.VALUE = value
+        self.BINARY = binary
+        self.CACHE = cache
         self.MAX_PACKET = 65507
         my_hostname = socket.gethostname()
         my_ip = socket.gethostbyname(my_hostname)
@@ -27,25 +180,89 @@ class Client:
 
         # Create socket and bind to default port
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Batch results can arrive as a burst of full-size datagrams
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
         client_socket.bind(self.CLIENT_ADD)
 
         # Set timeout
         client_socket.settimeout(3.0)
 
         # Construct request message
-        message = self.form_request()
+        if self.BINARY:
+            message = self.form_binary_request()
+        else:
+            message = self.form_request().encode()
+
+        if self.CACHE is not None:
+            self.cached_action(client_socket, message)
+            return
 
         # Send request
-        client_socket.sendto(message.encode(), self.SERVER_ADDRESS)
+        client_socket.sendto(message, self.SERVER_ADDRESS)
 
-        # Listen for response
+        # Listen for response; batch results may span several datagrams
+        waiting = set(self.KEY.split()[::2] if self.VERB == "mput" else self.KEY.split())
         try:
-            data, server = client_socket.recvfrom(self.MAX_PACKET)
-            data = self.split_lines(data.decode())
-            print(f'{data}')
+            while True:
+                data, server = client_socket.recvfrom(self.MAX_PACKET)
+                if self.BINARY:
+                    print(f'{self.format_binary_reply(data, server)}')
+                    break
+                print(f'{self.split_lines(data.decode())}')
+                if self.VERB not in ("mget", "mput") or data.startswith(b"Error"):
+                    break
+                waiting -= self.answered_keys(data.decode())
+                if not waiting:
+                    break
         except socket.timeout:
             print('REQUEST TIMED OUT')
 
+    def cached_action(self, client_socket, message):
+        """
+        Send a binary request straight to a node holding the key, as the routing cache knows it, falling back
+        to routing through the given node if that node does not answer. A miss the node answers itself is
+        final, as a node that no longer holds the key's range forwards the request instead.
+        :param client_socket: Bound socket with a timeout.
+        :param message: Binary request datagram.
+        """
+        key_hash = int.from_bytes(dht_protocol.key_digest(self.KEY.encode()), byteorder='big')
+        kind = dht_protocol.GET if self.VERB == "get" else dht_protocol.PUT
+        destination = self.CACHE.locate(key_hash, kind)
+        reply = server = None
+        try:
+            client_socket.sendto(message, destination)
+            data, server = client_socket.recvfrom(self.MAX_PACKET)
+            reply = dht_protocol.decode(data)
+        except socket.timeout:
+            self.CACHE.forget(destination)
+        except ValueError as h:
+            print(h)
+            return
+
+        if reply is None:
+            fallback = self.SERVER_ADDRESS
+            if dht_node.Node.hash_address(*destination) == dht_node.Node.hash_address(*fallback):
+                # The given node is the one that is down; the next holder the cache knows routes instead
+                fallback = self.CACHE.locate(key_hash, kind)
+            print("Routing cache: no answer from " + destination[0] + " " + str(destination[1]) +
+                  " - routing through " + fallback[0] + " " + str(fallback[1]))
+            try:
+                destination = fallback
+                client_socket.sendto(message, destination)
+                data, server = client_socket.recvfrom(self.MAX_PACKET)
+                reply = dht_protocol.decode(data)
+            except socket.timeout:
+                print('REQUEST TIMED OUT')
+                return
+            except ValueError as h:
+                print(h)
+                return
+
+        self.CACHE.learn(key_hash, reply, server)
+        print(f'{self.format_binary_reply(data, server)}')
+        print("Routing cache: sent to " + destination[0] + " " + str(destination[1]) + ", " +
+              str(reply.nodes_visited) + " node(s) visited")
+
     def form_request(self):
         """
         Construct Request message from given command line arguments
@@ -59,6 +276,57 @@ class Client:
             request += "Data: " + self.VERB + " " + self.KEY + " " + self.VALUE
         return request
 
+    def form_binary_request(self):
+        """
+        Construct a binary request from given command line arguments.
+        Keys and values may contain spaces in this format.
+        :return: Request datagram.
+        """
+        kind = dht_protocol.GET if self.VERB == "get" else dht_protocol.PUT
+        value = None if self.VALUE is None else self.VALUE.encode()
+        return dht_protocol.encode(dht_protocol.request(kind, self.KEY.encode(), value))
+
+    @staticmethod
+    def format_binary_reply(data, server):
+        """
+        Describe a binary reply in the same layout as a text response.
+        :param data: Received reply.
+        :param server: Address of the node that answered.
+        :return: Printable reply.
+        """
+        try:
+            reply = dht_protocol.decode(data)
+        except ValueError as h:
+            return str(h)
+        lines = ["Success!" if reply.status == 200 else "Error",
+                 "Source: " + server[0] + " " + str(server[1]),
+                 "Node Hash: " + str(int.from_bytes(reply.node_hash, byteorder='big')),
+                 "Nodes Visited: " + str(reply.nodes_visited)]
+        if reply.status == 200:
+            lines += ["Key: " + reply.key.decode(errors='replace'),
+                      "Value: " + (reply.value.decode(errors='replace') if reply.flags & dht_protocol.HAS_VALUE
+                                   else "<EMPTY>"),
+                      "Key Hash: " + str(int.from_bytes(reply.key_hash, byteorder='big'))]
+        else:
+            lines.append("Status: " + str(reply.status))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def answered_keys(response):
+        """
+        Find the keys a batch response has results for.
+        :param response: Received response to a mget or mput.
+        :return: Set of keys.
+        """
+        keys = set()
+        for line in response.splitlines():
+            name, sep, tokens = line.partition(': ')
+            if name == "Values":
+                keys.update(tokens.split()[::2])
+            elif name in ("Missing", "Stored", "Failed"):
+                keys.update(tokens.split())
+        return keys
+
     @staticmethod
     def split_lines(response):
         """
@@ -73,13 +341,50 @@ class Client:
 
 
 if __name__ == '__main__':
+    # Usage: dht_client.py [-b] <node> <port> <get|put> <key> [value], where -b selects the binary protocol
+    #        dht_client.py -c <host file> [-v <vnodes>] [-r <replicas>] <node> <port> <get|put> <key> [value]
+    #        dht_client.py <node> <port> mget <key> [key ...]
+    #        dht_client.py <node> <port> mput <key> <value> [key value ...]
+    # -c sends binary requests straight to a node holding the key, laying out the ring from the host file with
+    # the nodes' -v and -r settings, and routes through <node> <port> only if that node does not answer.
+    # What replies teach about the ring is kept in <host file>.routes for the next invocation.
+    binary = False
+    cache = None
+    host_file = None
+    cache_vnodes = 1
+    cache_replicas = dht_node.Node.REPLICAS
+    while len(sys.argv) > 1 and sys.argv[1] in ("-b", "-c", "-v", "-r"):
+        if sys.argv[1] == "-b":
+            binary = True
+            del sys.argv[1]
+            continue
+        if len(sys.argv) < 3:
+            print("Please provide a value for " + sys.argv[1] + ".")
+            os._exit(0)
+        try:
+            if sys.argv[1] == "-c":
+                host_file = sys.argv[2]
+            elif sys.argv[1] == "-v":
+                cache_vnodes = int(sys.argv[2])
+            else:
+                cache_replicas = int(sys.argv[2])
+        except ValueError:
+            print("Please provide a valid number for " + sys.argv[1] + ".")
+            os._exit(0)
+        del sys.argv[1:3]
     if len(sys.argv) >= 5:
         try:
             NODE = sys.argv[1]
             NODE_PORT = sys.argv[2]
             verb = sys.argv[3]
             key = sys.argv[4]
-            if len(sys.argv) == 6:
+            if verb in ("mget", "mput"):
+                if binary or host_file is not None:
+                    print("Batches use the text protocol.")
+                    os._exit(0)
+                key = " ".join(sys.argv[4:])
+                value = None
+            elif len(sys.argv) == 6:
                 value = sys.argv[5]
             else:
                 value = None
@@ -91,6 +396,14 @@ if __name__ == '__main__':
     else:
         print("Please provide a valid file and/or line number.")
         os._exit(0)
+    if host_file is not None:
+        # Only binary replies name the node that answered
+        binary = True
+        try:
+            cache = RoutingCache(host_file, cache_vnodes, cache_replicas, host_file + RoutingCache.ROUTES_SUFFIX)
+        except (OSError, ValueError) as e:
+            print(e)
+            os._exit(0)
 
 
     Client()
@@ -0,0 +1,335 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import dht_client
+import dht_protocol
+
+NODE_DIR = os.path.dirname(os.path.abspath(__file__))
+HOST = "127.0.0.1"
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of sorted values.
+    :param values: Sorted list of numbers.
+    :param fraction: Percentile as a fraction between 0 and 1.
+    :return: Percentile value, or None for an empty list.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def zipf_weights(count, exponent):
+    """
+    Cumulative Zipf weights for ranked keys, for random.choices().
+    :param count: Number of keys.
+    :param exponent: Skew; 0 is uniform, around 1 is typical of popular content.
+    :return: List of cumulative weights.
+    """
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+class Ring:
+    """
+    Starts a ring of dht_node.py processes on localhost with a given replication setting.
+    """
+
+    def __init__(self, nodes, base_port, replicas, write_quorum, vnodes=1):
+        self.ports = [base_port + i for i in range(nodes)]
+        self.replicas = replicas
+        self.write_quorum = write_quorum
+        self.vnodes = vnodes
+        self.processes = []
+        self.host_files = []
+
+    def __enter__(self):
+        host_file = self.write_host_file(self.ports)
+        for line in range(len(self.ports)):
+            self.start(host_file, line)
+        try:
+            self.wait_ready()
+        except RuntimeError:
+            self.__exit__()
+            raise
+        return self
+
+    def write_host_file(self, ports):
+        """
+        Write a temporary host file.
+        :param ports: Port of each line.
+        :return: Path of the file.
+        """
+        fd, host_file = tempfile.mkstemp(prefix="dht_hosts.", suffix=".txt")
+        with os.fdopen(fd, "w") as f:
+            f.writelines(HOST + " " + str(port) + "\n" for port in ports)
+        self.host_files.append(host_file)
+        return host_file
+
+    def start(self, host_file, line, *options):
+        """
+        Start the node on a line of a host file.
+        :param host_file: Path of the host file.
+        :param line: Line number.
+        :param options: Further dht_node.py options.
+        """
+        self.processes.append(subprocess.Popen(
+            [sys.executable, "dht_node.py", "-r", str(self.replicas), "-w", str(self.write_quorum),
+             "-v", str(self.vnodes)] + list(options) +
+            [host_file, str(line)], cwd=NODE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    def join(self):
+        """
+        Start one more node, joining the running ring through its first node.
+        """
+        port = max(self.ports) + 1
+        self.start(self.write_host_file([port]), 0, "-j", HOST, str(self.ports[0]))
+        self.ports.append(port)
+
+    def wait_ready(self, timeout=30.0):
+        """
+        Wait until every node answers a get, so no puts are sent to nodes that are still starting.
+        :param timeout: Seconds before giving up.
+        """
+        probe = dht_protocol.encode(dht_protocol.request(dht_protocol.GET, b"ready"))
+        deadline = time.monotonic() + timeout
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe_socket:
+            probe_socket.settimeout(0.2)
+            for port in self.ports:
+                while True:
+                    probe_socket.sendto(probe, (HOST, port))
+                    try:
+                        probe_socket.recvfrom(65507)
+                        break
+                    except OSError:
+                        if time.monotonic() > deadline:
+                            raise RuntimeError("node on port " + str(port) + " did not start")
+
+    def __exit__(self, *exc_info):
+        # Killed rather than terminated: a terminated node leaves gracefully, handing its keys to nodes that are going too
+        for process in self.processes:
+            process.kill()
+        for process in self.processes:
+            process.wait()
+        for host_file in self.host_files:
+            os.remove(host_file)
+
+
+class LoadProtocol(asyncio.DatagramProtocol):
+    """
+    Hands each reply, with the address of the node that sent it, to the request waiting for its request ID.
+    """
+
+    def __init__(self, pending):
+        self.pending = pending
+
+    def datagram_received(self, data, addr):
+        try:
+            reply = dht_protocol.decode(data)
+        except ValueError:
+            return
+        future = self.pending.pop(reply.request_id, None)
+        if future is not None and not future.done():
+            future.set_result((reply, addr))
+
+
+async def run_load(ports, requests, concurrency, timeout, cache=None):
+    """
+    Send requests from concurrent clients, each to a random node, waiting for every reply.
+    :param ports: Node ports.
+    :param requests: Iterator of (kind, key, value) to send until it is exhausted or the caller stops it.
+    :param concurrency: Requests in flight.
+    :param timeout: Seconds before a request counts as failed.
+    :param cache: dht_client.RoutingCache to send each request straight to a node holding its key, learning
+    from the replies, instead of to a random node.
+    :return: Sorted latencies of answered requests, their replies and the number that failed.
+    """
+    loop = asyncio.get_running_loop()
+    pending = {}
+    transport, protocol = await loop.create_datagram_endpoint(lambda: LoadProtocol(pending), local_addr=(HOST, 0))
+    request_ids = itertools.count(1)
+    latencies = []
+    replies = []
+    failed = 0
+
+    async def client():
+        nonlocal failed
+        for kind, key, value in requests:
+            request_id = next(request_ids)
+            future = loop.create_future()
+            pending[request_id] = future
+            message = dht_protocol.request(kind, key, value, request_id)
+            if cache is None:
+                destination = HOST, random.choice(ports)
+            else:
+                key_hash = int.from_bytes(message.key_hash, byteorder='big')
+                destination = cache.locate(key_hash, kind)
+            started = time.perf_counter()
+            transport.sendto(dht_protocol.encode(message), destination)
+            try:
+                reply, server = await asyncio.wait_for(future, timeout)
+                latencies.append(time.perf_counter() - started)
+                replies.append(reply)
+                if cache is not None:
+                    cache.learn(key_hash, reply, server)
+            except asyncio.TimeoutError:
+                pending.pop(request_id, None)
+                failed += 1
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    transport.close()
+    return sorted(latencies), replies, failed
+
+
+def timed(requests, duration):
+    """
+    Stop an iterator of requests after a number of seconds.
+    :param requests: Iterator of requests.
+    :param duration: Seconds.
+    :return: Generator of requests.
+    """
+    deadline = time.monotonic() + duration
+    for request in requests:
+        if time.monotonic() > deadline:
+            return
+        yield request
+
+
+def bench(args, replicas):
+    """
+    Load a ring with keys and measure gets on Zipf-distributed keys, sent to random nodes and, with
+    --routing-cache, also straight to nodes holding them.
+    :param args: Parsed command line.
+    :param replicas: Copies kept on successors.
+    :return: List of results dictionaries.
+    """
+    keys = [("key" + str(i)).encode() for i in range(args.keys)]
+    value = b"v" * args.value_size
+    weights = zipf_weights(args.keys, args.zipf)
+    with Ring(args.nodes, args.port, replicas, min(args.write_quorum, replicas + 1), args.vnodes) as ring:
+        latencies, replies, failed = asyncio.run(run_load(
+            ring.ports, ((dht_protocol.PUT, key, value) for key in keys), args.concurrency, 2.0))
+        if failed:
+            print("  {failed} puts unanswered".format(failed=failed))
+
+        gets = ((dht_protocol.GET, random.choices(keys, cum_weights=weights)[0], None) for _ in itertools.count())
+        caches = [None]
+        if args.routing_cache:
+            caches.append(dht_client.RoutingCache(ring.host_files[0], args.vnodes, replicas))
+        results = []
+        for cache in caches:
+            started = time.perf_counter()
+            latencies, replies, failed = asyncio.run(run_load(
+                ring.ports, timed(gets, args.duration), args.concurrency, 2.0, cache))
+            elapsed = time.perf_counter() - started
+
+            answered = collections.Counter(reply.node_hash for reply in replies)
+            results.append({
+                "replicas": replicas,
+                "routing": "entry node" if cache is None else "routing cache",
+                "rps": len(replies) / elapsed,
+                "p50_ms": percentile(latencies, 0.50) * 1e3,
+                "p99_ms": percentile(latencies, 0.99) * 1e3,
+                "hops": sum(reply.nodes_visited for reply in replies) / len(replies),
+                "busiest": max(answered.values()) / len(replies),
+                "found": sum(1 for reply in replies if reply.status == 200) / len(replies),
+                "failed": failed,
+            })
+    return results
+
+
+def bench_scale_out(args, replicas):
+    """
+    Join a node to a loaded ring while it serves gets and puts, reporting each second's throughput, latency
+    and nodes visited, then check that every key can still be read. With --routing-cache the clients send
+    straight to the nodes holding each key, from a copy of the ring that only replies tell about the new node.
+    :param args: Parsed command line.
+    :param replicas: Copies kept on successors.
+    """
+    keys = [("key" + str(i)).encode() for i in range(args.keys)]
+    value = b"v" * args.value_size
+    weights = zipf_weights(args.keys, args.zipf)
+    with Ring(args.nodes, args.port, replicas, min(args.write_quorum, replicas + 1), args.vnodes) as ring:
+        entry_ports = list(ring.ports)
+        cache = None
+        if args.routing_cache:
+            cache = dht_client.RoutingCache(ring.host_files[0], args.vnodes, replicas)
+        latencies, replies, failed = asyncio.run(run_load(
+            entry_ports, ((dht_protocol.PUT, key, value) for key in keys), args.concurrency, 2.0))
+        if failed:
+            print("  {failed} puts unanswered".format(failed=failed))
+
+        requests = ((dht_protocol.PUT, key, value) if random.random() < args.put_share else (dht_protocol.GET, key, None)
+                    for key in iter(lambda: random.choices(keys, cum_weights=weights)[0], None))
+        print("replicas {replicas}, {routing}, joining a node to {nodes} after {join} s".format(
+            replicas=replicas, routing="routing cache" if cache is not None else "entry node", nodes=args.nodes,
+            join=int(args.duration) // 3))
+        for second in range(int(args.duration)):
+            if second == int(args.duration) // 3:
+                ring.join()
+            started = time.perf_counter()
+            latencies, replies, failed = asyncio.run(run_load(entry_ports, timed(requests, 1.0), args.concurrency,
+                                                              2.0, cache))
+            elapsed = time.perf_counter() - started
+            print('  {second:>3} s {event:<5} {rps:>8,.0f} req/s  p50 {p50:>6.2f} ms  p99 {p99:>7.2f} ms  '
+                  'nodes visited {hops:.2f}  errors {errors}  timed out {failed}'.format(
+                      second=second, event="join" if second == int(args.duration) // 3 else "",
+                      rps=len(replies) / elapsed, p50=(percentile(latencies, 0.50) or 0) * 1e3,
+                      p99=(percentile(latencies, 0.99) or 0) * 1e3,
+                      hops=sum(reply.nodes_visited for reply in replies) / max(1, len(replies)),
+                      errors=sum(1 for reply in replies if reply.status != 200), failed=failed))
+
+        latencies, replies, failed = asyncio.run(run_load(
+            ring.ports, ((dht_protocol.GET, key, None) for key in keys), args.concurrency, 2.0))
+        print("  every key read back from {nodes} nodes: found {found:.1%}, timed out {failed}".format(
+            nodes=len(ring.ports), found=sum(1 for reply in replies if reply.status == 200) / len(keys),
+            failed=failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure DHT get throughput on a Zipf workload with and "
+                                                 "without replica reads.")
+    parser.add_argument("--nodes", type=int, default=8)
+    parser.add_argument("--port", type=int, default=19101, help="port of the first node")
+    parser.add_argument("--replicas", default="0,2", help="comma separated replica counts to compare")
+    parser.add_argument("--write-quorum", type=int, default=2)
+    parser.add_argument("--vnodes", type=int, default=1, help="virtual nodes per node")
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of key popularity")
+    parser.add_argument("--concurrency", type=int, default=64, help="gets in flight")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of gets per measurement")
+    parser.add_argument("--scale-out", action="store_true",
+                        help="instead, join a node a third of the way through a run of gets and puts")
+    parser.add_argument("--put-share", type=float, default=0.1, help="fraction of puts with --scale-out")
+    parser.add_argument("--routing-cache", action="store_true",
+                        help="also send requests straight to the nodes holding each key, using the client's "
+                             "routing cache, to compare nodes visited")
+    args = parser.parse_args()
+
+    for replicas in (int(r) for r in args.replicas.split(",")):
+        if args.scale_out:
+            bench_scale_out(args, replicas)
+            continue
+        results = bench(args, replicas)
+        for result in results:
+            print('replicas {replicas}  {routing:<13} {rps:>8,.0f} gets/s  p50 {p50_ms:>6.2f} ms  '
+                  'p99 {p99_ms:>6.2f} ms  nodes visited {hops:.2f}  busiest node {busiest:>5.1%}  '
+                  'found {found:.1%}  timed out {failed}'.format(**result))
+        if len(results) > 1:
+            print('replicas {replicas}  routing cache saves {saved:.2f} nodes visited per get ({share:.0%})'.format(
+                replicas=replicas, saved=results[0]["hops"] - results[1]["hops"],
+                share=1 - results[1]["hops"] / results[0]["hops"]))
+
+
+if __name__ == '__main__':
+    main()
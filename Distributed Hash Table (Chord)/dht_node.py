@@ -1,7 +1,36 @@
+import asyncio
+import bisect
+import collections
+import functools
 import hashlib
+import itertools
 import os
+import random
+import signal
 import socket
 import sys
+import time
+
+import dht_protocol
+import dht_store
+
+
+# Fields of a received request; handlers build replies from it without keeping any shared per-request state
+RequestContext = collections.namedtuple('RequestContext', ['source', 'nodes_visited', 'data', 'request_id'])
+
+# A sub-batch waiting for replies: keys not yet answered, results so far and the future set once every key is in
+PendingBatch = collections.namedtuple('PendingBatch', ['waiting', 'results', 'done'])
+
+# Reply fields of mget and mput results, in the order they are written
+BATCH_FIELDS = ("Values", "Missing", "Stored", "Failed")
+
+# A ring member as this node last heard of it: "<host> <port>", the version its own node gave the entry,
+# whether it is in the ring or has left, and how many virtual nodes it has been admitted with; the higher
+# version wins, and a departure wins a tie
+Member = collections.namedtuple('Member', ['location', 'version', 'alive', 'vnodes'])
+
+# Sorted ring positions of a membership, and for each position the nodes keeping copies of the keys it owns
+Layout = collections.namedtuple('Layout', ['positions', 'holders'])
 
 
 class Table:
@@ -10,23 +39,83 @@ class Table:
     as well as handles connections, requests, and responses.
     """
     MAX_PACKET = 65507
+    RECV_BUFFER = 4 * 1024 * 1024
     KV_STORE = {}
-    lines = {}
+    # Room left in each mget/mput datagram for everything but the keys and values
+    BATCH_HEADER = 512
+    # Seconds the entry node waits for sub-batches; each further hop waits a margin less so its partial
+    # results reach the node above it before that node gives up
+    BATCH_TIMEOUT = 2.0
+    BATCH_HOP_MARGIN = 0.1
+    # When keys are kept on disk: "always", "group" or "none", see dht_store.FSYNC_POLICIES
+    FSYNC_POLICY = "group"
+    # Copies of a write, counting the owner's, acknowledged before the put succeeds; see Node.REPLICAS.
+    # Gets may be answered by any copy, so they are only sure to see the last successful put when the
+    # quorum is every copy, REPLICAS + 1; a smaller quorum trades that for puts that survive a slow replica.
+    WRITE_QUORUM = 1
+    REPLICA_TIMEOUT = 1.0
+    # Seconds between membership exchanges with the successor, the predecessor and one random node
+    STABILIZE_INTERVAL = 1.0
+    # Keys handed to a new holder per round trip when membership changes, and attempts per batch or join
+    HANDOFF_BATCH = 256
+    HANDOFF_RETRIES = 5
+    # Keys checked between yields to the event loop while working out which keys move
+    HANDOFF_SCAN = 1024
+    JOIN_TIMEOUT = 60.0
 
     def __init__(self):
         self.n = Node()
-        self.LINE_COUNT = line_count
         self.SERVER_ADDRESS = server_add
+        self.SOURCE = server_add[0] + " " + str(server_add[1])
+        self.NODE_DIGEST = self.n.NODE_ID.to_bytes(20, byteorder='big')
+        if store_dir is not None:
+            print("Loading store...")
+            self.KV_STORE = dht_store.LogStore(store_dir, self.FSYNC_POLICY)
+        self.transport = None
+        self.pending = {}
+        self.replica_acks = {}
+        self.request_ids = itertools.count(random.getrandbits(31))
+
+        # The host file is the starting membership; this node's own entry is versioned by its start time,
+        # so it supersedes whatever the ring remembers from an earlier run. A joining node starts out alone.
+        self.members = {node_id: Member(self.n.get_loc_key(node_id).strip(), 0, True, len(self.n.vnode_ids[node_id]))
+                        for node_id in self.n.NODES}
+        self.members[self.n.NODE_ID] = self.members[self.n.NODE_ID]._replace(version=time.time_ns())
+        if bootstrap is not None:
+            self.members = {self.n.NODE_ID: self.members[self.n.NODE_ID]}
+            self.n.set_members(self.alive_members())
+        # Layout the keys stored here were last placed for, and the one they are being handed over for while
+        # a join or leave is under way
+        self.placed = self.n.layout()
+        self.upcoming = None
+        self.leaving = False
+        self.membership_lock = None
+        self.stopped = None
         Table.serve(self)
 
     def serve(self):
         """
-        Listens for client connections until stopped.
+        Listens for requests until stopped.
+        """
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if isinstance(self.KV_STORE, dht_store.LogStore):
+                self.KV_STORE.close()
+
+    async def run(self):
+        """
+        Answer and forward requests on an asyncio datagram endpoint. Every request is handled
+        as soon as it arrives, so any number of gets and puts can be in flight through the node.
         """
 
         # Set up socket
         try:
             node_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # Absorb bursts of requests while the loop is busy
+            node_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECV_BUFFER)
             node_socket.bind(self.SERVER_ADDRESS)
         except PermissionError as x:
             print(x)
@@ -35,98 +124,336 @@ class Table:
             print('Serving on port {port} ...'.format(port=PORT))
 
         # Core Functionality
-        # Accept connections and serve
-        while True:
-            request = node_socket.recvfrom(self.MAX_PACKET)
-            self.split_lines(request)
-            message = self.handle()
-            host, port = self.lines.get('Destination').split()
-            addr = (host, int(port))
-            node_socket.sendto(message, addr)
-            print("Sent\n")
-
-    def split_lines(self, req):
-        """
-        Split request string with newline characters for later processing.
-        :param req:
-        :param request: Received request from client.
-        :return: Request string object broken up by newline characters.
-        """
-        request = req[0].decode()
-        self.lines = {"Source": req[1][0] + " " + str(req[1][1])}
-        print("\nReceived Request: ")
-        for line in request.splitlines():
-            print(line)
-            key, val = line.split(': ')
-            self.lines[key] = val
-
-    def handle(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.membership_lock = asyncio.Lock()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.request_leave)
+        await loop.create_datagram_endpoint(lambda: NodeProtocol(self), sock=node_socket)
+        if bootstrap is not None:
+            print("Joining through " + bootstrap + " ...")
+            if not await self.join(self.address(bootstrap)):
+                print("Could not join the ring.")
+                return
+            print("Joined a ring of " + str(self.n.LINE_COUNT) + " nodes.")
+        stabilizer = asyncio.ensure_future(self.stabilize())
+        await self.stopped.wait()
+        stabilizer.cancel()
+
+    def write_count(self):
+        """
+        Bytes written to the durable store so far.
+        :return: Count, or None if keys are only kept in memory.
+        """
+        return getattr(self.KV_STORE, "appended", None)
+
+    def send(self, message, address, written=None):
+        """
+        Send a message. Replies to requests that wrote to the durable store are held until the writes are on disk.
+        :param message: Datagram to send.
+        :param address: Address to send it to.
+        :param written: write_count() from before the request was handled, or None.
+        """
+        if written is not None and written != self.KV_STORE.appended:
+            self.KV_STORE.when_durable(lambda: self.transport.sendto(message, address))
+        else:
+            self.transport.sendto(message, address)
+
+    def respond(self, data, addr):
+        """
+        Handle one received datagram.
+        :param data: Received request.
+        :param addr: Address the request came from.
+        :return: Message to send and the address to send it to, or None if there is nothing to send.
+        """
+        if dht_protocol.is_binary(data):
+            return self.respond_binary(data, addr)
+        if data.startswith((b"Success!", b"Error")):
+            self.batch_reply(data)
+            return None
+        try:
+            context = self.parse_request(data, addr)
+        except (ValueError, UnicodeDecodeError) as c:
+            print(c)
+            return self.err_response(RequestContext(addr[0] + " " + str(addr[1]), 0, "", None), 400)
+        return self.handle(context)
+
+    def respond_binary(self, data, addr):
+        """
+        Handle one request in the binary format. The decoded message is the request's context;
+        forwarding patches the received datagram and routes on the key digest it carries.
+        :param data: Received request.
+        :param addr: Address the request came from.
+        :return: Reply or forwarded request and the address to send it to, or None for stray replies.
+        """
+        try:
+            message = dht_protocol.decode(data)
+        except ValueError as c:
+            print(c)
+            message = dht_protocol.request(dht_protocol.GET, b'')
+            return dht_protocol.encode(dht_protocol.reply(message, 400, self.NODE_DIGEST)), addr
+        if message.kind == dht_protocol.REPLY:
+            # Only replicas' acknowledgements of this node's writes are replies addressed to a node
+            ack = self.replica_acks.pop(message.request_id, None)
+            if ack is not None and not ack.done():
+                ack.set_result(message.status)
+            return None
+
+        # The first node fills in the requester's address
+        source = message.source if message.source[1] else addr
+        message = message._replace(source=source)
+        if message.nodes_visited == self.n.HOP_LIMIT:
+            return dht_protocol.encode(dht_protocol.reply(message, 404, self.NODE_DIGEST)), source
+
+        # Keys and values share the store with text requests
+        key = message.key.decode('utf-8', 'surrogateescape')
+        val = None
+        if message.flags & dht_protocol.HAS_VALUE:
+            val = message.value.decode('utf-8', 'surrogateescape')
+        if message.kind == dht_protocol.REPLICATE:
+            self.KV_STORE[key] = val
+            return dht_protocol.encode(dht_protocol.reply(message, 200, self.NODE_DIGEST)), source
+
+        x = int.from_bytes(message.key_hash, byteorder='big')
+        if message.kind == dht_protocol.GET:
+            location = self.read_location(x, key)
+        else:
+            location = self.n.hash_loc(x)
+        if location is not None:
+            destination = self.n.get_loc_key(location)
+            return dht_protocol.forwarded(data, source, message.nodes_visited + 1), self.address(destination)
+
+        if message.kind == dht_protocol.GET:
+            val = self.KV_STORE.get(key)
+            if val is None:
+                return dht_protocol.encode(dht_protocol.reply(message, 404, self.NODE_DIGEST)), source
+            return dht_protocol.encode(dht_protocol.reply(message, 200, self.NODE_DIGEST,
+                                                          val.encode('utf-8', 'surrogateescape'))), source
+        elif message.kind == dht_protocol.PUT:
+            written = self.write_count()
+            self.KV_STORE[key] = val
+            response = dht_protocol.encode(dht_protocol.reply(message, 200, self.NODE_DIGEST, message.value
+                                                              if val is not None else None)), source
+            failure = dht_protocol.encode(dht_protocol.reply(message, 503, self.NODE_DIGEST)), source
+            return self.replicated_reply(response, failure, [(key, val)], written)
+        else:
+            return dht_protocol.encode(dht_protocol.reply(message, 501, self.NODE_DIGEST)), source
+
+    def read_location(self, x, key):
+        """
+        Determine where a get goes next. This node answers if it owns the key or holds a copy of it;
+        a copy that is missing here, perhaps because the write has not reached it yet, defers to the owner.
+        :param x: Hashed representation of key.
+        :param key: String representation of key.
+        :return: Location of the next node, or None to answer here.
+        """
+        location = self.n.hash_loc(x)
+        if location is None:
+            return None
+        if self.n.holds(x):
+            return None if key in self.KV_STORE else self.n.successor_of(x)
+        return self.n.read_loc(x)
+
+    def replicated_reply(self, response, failure, items, written):
+        """
+        Reply to a write stored here once enough replicas have acknowledged it.
+        :param response: Reply for success and the address to send it to.
+        :param failure: Reply if too few replicas acknowledge in time, and the address to send it to.
+        :param items: Written (key, value) pairs, with None values for removals.
+        :param written: write_count() from before the write.
+        :return: The reply to send now, or None if it is sent once the replicas answer.
+        """
+        if not self.n.REPLICA_COUNT and self.upcoming is None:
+            return response
+
+        async def reply():
+            if await self.replicate(items):
+                self.send(*response, written)
+            else:
+                self.send(*failure)
+
+        asyncio.ensure_future(reply())
+        return None
+
+    async def replicate(self, items):
+        """
+        Copy writes stored here to the nodes that hold replicas of their keys, one message per replica.
+        Copies to the remaining replicas carry on after the quorum is reached.
+        :param items: Written (key, value) pairs, with None values for removals.
+        :return: True once WRITE_QUORUM copies of every write, counting this node's, are acknowledged; False if
+        too few are.
+        """
+        # Positions in items of the writes each replica is sent
+        groups = collections.defaultdict(list)
+        for i, item in enumerate(items):
+            x = int(hashlib.sha1(item[0].encode()).hexdigest(), 16)
+            for location in self.n.replica_set(x)[1:]:
+                groups[location].append(i)
+
+        if self.upcoming is not None:
+            # Nodes that are being handed these keys get every write made until the handover is done
+            extra = collections.defaultdict(list)
+            for item in items:
+                x = int(hashlib.sha1(item[0].encode()).hexdigest(), 16)
+                holders = self.n.replica_set(x)
+                for location in self.n.replica_set(x, self.upcoming):
+                    if location not in holders and location != self.n.NODE_ID:
+                        extra[location].append(item)
+            for location, extra_items in extra.items():
+                asyncio.ensure_future(self.replica_write(location, extra_items))
+
+        # Acknowledgements still needed for each write; replicas of different keys may be different nodes
+        needed = [min(self.WRITE_QUORUM, self.n.REPLICA_COUNT + 1) - 1] * len(items)
+        replicas = {asyncio.ensure_future(self.replica_write(location, [items[i] for i in group])): group
+                    for location, group in groups.items()}
+        waiting = set(replicas)
+        while waiting and max(needed, default=0) > 0:
+            done, waiting = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for replica in done:
+                if replica.result():
+                    for i in replicas[replica]:
+                        needed[i] -= 1
+        return max(needed, default=0) <= 0
+
+    async def replica_write(self, location, items):
+        """
+        Send writes to one replica, in the binary format so any value can be carried.
+        :param location: Hashed value of the replica.
+        :param items: Written (key, value) pairs, with None values for removals.
+        :return: True if the replica acknowledged every write in time.
+        """
+        address = self.address(self.n.get_loc_key(location))
+        loop = asyncio.get_running_loop()
+        acks = {}
+        for key, val in items:
+            request_id = next(self.request_ids) & 0xFFFFFFFF
+            acks[request_id] = self.replica_acks[request_id] = loop.create_future()
+            message = dht_protocol.request(dht_protocol.REPLICATE, key.encode('utf-8', 'surrogateescape'),
+                                           None if val is None else val.encode('utf-8', 'surrogateescape'),
+                                           request_id)
+            self.transport.sendto(dht_protocol.encode(message), address)
+        try:
+            done, pending = await asyncio.wait(acks.values(), timeout=self.REPLICA_TIMEOUT)
+        finally:
+            for request_id in acks:
+                self.replica_acks.pop(request_id, None)
+        return not pending and all(ack.result() == 200 for ack in done)
+
+    @staticmethod
+    def parse_request(data, addr):
+        """
+        Split a request into its fields.
+        :param data: Received request.
+        :param addr: Address the request came from, used as its source unless it names another.
+        :return: RequestContext for the request.
+        """
+        lines = {"Source": addr[0] + " " + str(addr[1])}
+        for line in data.decode().splitlines():
+            key, val = line.split(': ', 1)
+            lines[key] = val
+        return RequestContext(lines["Source"], int(lines.get("Nodes Visited", 0)), lines.get("Data", ""),
+                              lines.get("Request ID"))
+
+    @staticmethod
+    def address(location):
+        """
+        Convert a "<host> <port>" string into a socket address.
+        :param location: Host and port separated by whitespace.
+        :return: Host and port tuple.
+        """
+        host, port = location.split()
+        return host, int(port)
+
+    def handle(self, context):
         """
         Handle received request from client.
-        :return: Appropriate response for condition.
+        :param context: RequestContext of the request.
+        :return: Appropriate response for condition and the address to send it to.
         """
         try:
             # Return error if resource is not identified after visiting every node
-            if int(self.lines.get("Nodes Visited")) == line_count:
-                return self.err_response(404)
+            if context.nodes_visited == self.n.HOP_LIMIT:
+                return self.err_response(context, 404)
+
+            # Dispatch on the first word of the data, as keys and values may contain any of the verbs
+            verb = context.data.partition(" ")[0]
+
+            # If mget or mput request, answered once every sub-batch is in
+            if verb in ("mget", "mput"):
+                asyncio.ensure_future(self.handle_batch(context))
+                return None
+
+            # If another node's view of the ring, exchanged while stabilizing
+            elif verb == "members":
+                if self.merge_members(context.data.split()[1:]):
+                    self.change_view()
+                return None
+
+            # If a node asking to join the ring
+            elif verb == "join":
+                return self.handle_join(context)
 
             # If get request
-            if "get" in self.lines.get("Data"):
-                return self.handle_get()
+            elif verb == "get":
+                return self.handle_get(context)
 
             # If put request
-            elif "put" in self.lines.get("Data"):
-                return self.handle_put()
+            elif verb == "put":
+                return self.handle_put(context)
 
             # If request is something other than get or put
             else:
-                return self.err_response(501)
+                return self.err_response(context, 501)
 
         except Exception as f:
             print(f)
-            return self.err_response(500)
+            return self.err_response(context, 500)
 
-    def handle_get(self):
+    def handle_get(self, context):
         """
         Check get request and form appropriate response.
-        :return: Appropriate response for condition.
+        :param context: RequestContext of the request.
+        :return: Appropriate response for condition and the address to send it to.
         """
 
         try:
             # Split get and key from data value
-            verb, key = self.lines.get("Data").split(" ", 1)
+            verb, key = context.data.split(" ", 1)
 
-            # Find location and hash value of key
-            location, key_hash = self.n.key_loc(key)
+            # Find location and hash value of key; this node answers if it owns the key or holds a copy
+            x = int(hashlib.sha1(key.encode()).hexdigest(), 16)
+            location = self.read_location(x, key)
+            key_hash = x
 
             # If key is supposed to be stored locally
             if location is None:
 
                 # Find key in Table and return success response if found
                 if key in self.KV_STORE:
-                    return self.gen_response(key, self.KV_STORE.get(key), verb, key_hash)
+                    return self.gen_response(context, key, self.KV_STORE.get(key), verb, key_hash)
 
                 # If not found in local table
                 else:
-                    return self.err_response(404)
+                    return self.err_response(context, 404)
 
             # If key is supposed to be stored in a different node
             else:
-                return self.go_next(location)
+                return self.go_next(context, location)
 
         except Exception as e:
             print(e)
-            return self.err_response(500)
+            return self.err_response(context, 500)
 
-    def handle_put(self):
+    def handle_put(self, context):
         """
         Check put request and form appropriate response.
-        :return: Appropriate response for condition.
+        :param context: RequestContext of the request.
+        :return: Appropriate response for condition and the address to send it to.
         """
 
         try:
             # Split put and key/value from data value
-            verb, key_val = self.lines.get("Data").split(" ", 1)
+            verb, key_val = context.data.split(" ", 1)
             key_val = key_val.strip()
 
             # If placing/replacing value
@@ -141,91 +468,305 @@ class Table:
             # Find location and hash value of key
             location, key_hash = self.n.key_loc(key)
 
-            # If key is supposed to be stored locally
+            # If key is supposed to be stored locally, reply once enough replicas have a copy
             if location is None:
-
-                # Find key in Table and return success response if found
+                written = self.write_count()
                 self.KV_STORE[key] = val
-                return self.gen_response(key, val, verb, key_hash)
+                return self.replicated_reply(self.gen_response(context, key, val, verb, key_hash),
+                                             self.err_response(context, 503), [(key, val)], written)
 
             # If key is supposed to be stored in a different node
             else:
-                return self.go_next(location)
+                return self.go_next(context, location)
         except ValueError as e:
             print(e)
-            return self.err_response(400)
+            return self.err_response(context, 400)
         except Exception as e:
             print(e)
-            return self.err_response(500)
+            return self.err_response(context, 500)
+
+    async def handle_batch(self, context):
+        """
+        Answer a mget or mput request. Keys stored locally are answered at once; the rest are grouped
+        by the next node on their route in the finger table and sent on as sub-batches in parallel.
+        Each node that receives a sub-batch does the same, and the results are combined into one
+        response, split over as many datagrams as needed.
+        :param context: RequestContext of the request.
+        """
+        written = self.write_count()
+        try:
+            verb, items = self.parse_batch(context.data)
+        except ValueError as e:
+            print(e)
+            self.transport.sendto(*self.err_response(context, 400))
+            return
+
+        try:
+            # Answer local keys and group the rest by next hop
+            results = {}
+            groups = collections.OrderedDict()
+            stored = []
+            for item in items:
+                x = int(hashlib.sha1(item[0].encode()).hexdigest(), 16)
+                if verb == "mget":
+                    location = self.read_location(x, item[0])
+                else:
+                    location = self.n.hash_loc(x)
+                if location is None:
+                    results[item[0]] = self.local_batch_item(verb, item)
+                    if verb == "mput":
+                        stored.append(item)
+                else:
+                    groups.setdefault(location, []).append(item)
+
+            # Fan sub-batches out in parallel and wait for all of them
+            timeout = max(self.BATCH_TIMEOUT - context.nodes_visited * self.BATCH_HOP_MARGIN, self.BATCH_HOP_MARGIN)
+            sub_batches = [self.sub_batch(context, verb, location, chunk, timeout)
+                           for location, group in groups.items() for chunk in self.split_batch(group)]
+            if stored and (self.n.REPLICA_COUNT or self.upcoming is not None):
+                sub_batches.append(self.replicate_batch(stored))
+            for sub_results in await asyncio.gather(*sub_batches):
+                results.update(sub_results)
+
+            for message in self.batch_responses(context, items, results):
+                self.send(message, self.address(context.source), written)
+        except Exception as f:
+            print(f)
+            self.transport.sendto(*self.err_response(context, 500))
+
+    async def replicate_batch(self, items):
+        """
+        Copy the keys of a mput stored here to the replicas.
+        :param items: Stored (key, value) pairs.
+        :return: Dictionary of reply field by key, for keys whose write quorum was not reached.
+        """
+        if await self.replicate(items):
+            return {}
+        return {item[0]: ("Failed", None) for item in items}
+
+    @staticmethod
+    def parse_batch(data):
+        """
+        Split the data of a mget or mput request into its keys and values.
+        :param data: "mget <key> <key> ..." or "mput <key> <value> <key> <value> ...".
+        :return: Verb and list of (key,) or (key, value) tuples.
+        :raises ValueError: If there are no keys or a key has no value.
+        """
+        tokens = data.split()
+        verb, tokens = tokens[0], tokens[1:]
+        if not tokens:
+            raise ValueError("empty batch")
+        if verb == "mget":
+            return verb, [(token,) for token in tokens]
+        if len(tokens) % 2:
+            raise ValueError("mput key without a value")
+        return verb, list(zip(tokens[0::2], tokens[1::2]))
+
+    def local_batch_item(self, verb, item):
+        """
+        Get or put one key of a batch in the local table.
+        :param verb: "mget" or "mput".
+        :param item: (key,) or (key, value).
+        :return: Reply field and value for the key.
+        """
+        if verb == "mput":
+            self.KV_STORE[item[0]] = item[1]
+            return "Stored", None
+        val = self.KV_STORE.get(item[0])
+        if val is None:
+            return "Missing", None
+        return "Values", val
+
+    def split_batch(self, items):
+        """
+        Split batch items into chunks that each fit in one datagram.
+        :param items: List of key tuples.
+        :return: Generator of lists of key tuples.
+        """
+        chunk = []
+        size = 0
+        for item in items:
+            item_size = sum(len(token.encode()) + 1 for token in item)
+            if chunk and size + item_size > self.MAX_PACKET - self.BATCH_HEADER:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(item)
+            size += item_size
+        if chunk:
+            yield chunk
+
+    async def sub_batch(self, context, verb, location, items, timeout):
+        """
+        Send part of a batch to the next node on its keys' route and wait for every key to be answered.
+        :param context: RequestContext of the batch.
+        :param verb: "mget" or "mput".
+        :param location: Hashed value of next node in path.
+        :param items: Key tuples for that node, small enough for one datagram.
+        :param timeout: Seconds to wait for the replies.
+        :return: Dictionary of reply field and value by key; keys not answered in time are "Failed".
+        """
+        request_id = str(next(self.request_ids))
+        pending = PendingBatch(set(item[0] for item in items), {}, asyncio.get_running_loop().create_future())
+        self.pending[request_id] = pending
+
+        # Replies come back to this node, which combines them for its own requester
+        destination = self.n.get_loc_key(location).strip('\n')
+        request = "Source: " + self.SOURCE + "\r\n"
+        request += "Destination: " + destination + "\r\n"
+        request += "Nodes Visited: " + str(context.nodes_visited + 1) + "\r\n"
+        request += "Request ID: " + request_id + "\r\n"
+        request += "Data: " + verb + " " + " ".join(token for item in items for token in item)
+        self.transport.sendto(request.encode(), self.address(destination))
 
-    def gen_response(self, key, val, verb, key_hash):
+        try:
+            await asyncio.wait_for(pending.done, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.pending.pop(request_id, None)
+        for key in pending.waiting:
+            pending.results[key] = ("Failed", None)
+        return pending.results
+
+    def batch_reply(self, data):
+        """
+        Record the results in a reply to one of this node's sub-batches.
+        :param data: Received reply.
+        """
+        fields = {}
+        for line in data.decode(errors='replace').splitlines():
+            name, sep, val = line.partition(': ')
+            if sep:
+                fields[name] = val
+        pending = self.pending.get(fields.get("Request ID"))
+        if pending is None:
+            return
+
+        # A join waits on a plain future for the fields of its reply
+        if isinstance(pending, asyncio.Future):
+            if not pending.done():
+                pending.set_result(fields)
+            return
+
+        # A node that could not handle the sub-batch at all fails every key in it
+        if data.startswith(b"Error"):
+            for key in pending.waiting:
+                pending.results[key] = ("Failed", None)
+            pending.waiting.clear()
+        else:
+            tokens = fields.get("Values", "").split()
+            for key, val in zip(tokens[0::2], tokens[1::2]):
+                pending.results[key] = ("Values", val)
+                pending.waiting.discard(key)
+            for name in BATCH_FIELDS[1:]:
+                for key in fields.get(name, "").split():
+                    pending.results[key] = (name, None)
+                    pending.waiting.discard(key)
+        if not pending.waiting and not pending.done.done():
+            pending.done.set_result(None)
+
+    def batch_responses(self, context, items, results):
+        """
+        Constructs the Success Responses to a batch, each listing the results for as many keys as fit
+        in one datagram.
+        :param context: RequestContext of the request.
+        :param items: Key tuples of the request.
+        :param results: Dictionary of reply field and value by key.
+        :return: List of response datagrams.
+        """
+        answers = []
+        seen = set()
+        for item in items:
+            if item[0] not in seen:
+                seen.add(item[0])
+                field, val = results[item[0]]
+                answers.append((field, item[0]) if val is None else (field, item[0], val))
+
+        messages = []
+        for chunk in self.split_batch(answers):
+            message = "Success!\r\n"
+            message += "Source: " + self.SOURCE + "\r\n"
+            message += "Node Hash: " + str(self.n.SUCC_ID) + "\r\n"
+            message += "Destination: " + context.source + "\r\n"
+            message += "Nodes Visited: " + str(context.nodes_visited + 1) + "\r\n"
+            message += self.request_id_line(context)
+            for field in BATCH_FIELDS:
+                tokens = [token for answer in chunk if answer[0] == field for token in answer[1:]]
+                if tokens:
+                    message += field + ": " + " ".join(tokens) + "\r\n"
+            message += "\r\n"
+            messages.append(message.encode())
+        return messages
+
+    def gen_response(self, context, key, val, verb, key_hash):
         """
         Constructs complete Success Response.
+        :param context: RequestContext of the request.
         :param key: String representation of key in hashtable.
         :param val: String representation of value in hashtable.
         :param verb: Action to be taken by hashtable (get or put).
         :param key_hash: String representation of hashed key.
-        :return: Complete Success Response.
+        :return: Complete Success Response and the address of the requester.
         """
         try:
 
             # If key's value has been "removed" return not found
             if verb == "get" and val is None:
-                return self.err_response(404)
+                return self.err_response(context, 404)
 
             # Build response
             message = "Success!\r\n"
-            message += "Source: " + server_add[0] + " " + str(server_add[1]) + "\r\n"
+            message += "Source: " + self.SOURCE + "\r\n"
             message += "Node Hash: " + str(self.n.SUCC_ID) + "\r\n"
-            message += "Destination: " + self.lines.get("Source") + "\r\n"
-            message += "Nodes Visited: " + str((int(self.lines.get("Nodes Visited")) + 1)) + "\r\n"
+            message += "Destination: " + context.source + "\r\n"
+            message += "Nodes Visited: " + str(context.nodes_visited + 1) + "\r\n"
+            message += self.request_id_line(context)
             if val is None:
                 message += "Key: " + key + "\nValue: <EMPTY>\nKey Hash: " + str(key_hash)
             else:
                 message += "Key: " + key + "\nValue: " + val + "\nKey Hash: " + str(key_hash)
             message += "\r\n\r\n"
 
-            # Set class-level dictionary 'lines' with return information
-            self.lines["Destination"] = self.lines.get("Source")
-            self.lines["Source"] = server_add[0] + " " + str(server_add[1])
-            print("Sending Success Response to: " + self.lines["Destination"])
-
-            return message.encode()
+            return message.encode(), self.address(context.source)
 
         except Exception as b:
             print(b)
-            return self.err_response(500)
+            return self.err_response(context, 500)
 
-    def err_response(self, response_code):
+    def err_response(self, context, response_code):
         """
         Constructs complete error response.
+        :param context: RequestContext of the request.
         :param response_code: Integer representation of HTTP error code.
-        :return: Complete Error Response.
+        :return: Complete Error Response and the address of the requester.
         """
 
-        try:
-            # Retrieve appropriate error statement
-            response = self.generate_response_message(response_code)
-
-            # Build response
-            message = "Error\r\n"
-            message += "Source: " + server_add[0] + " " + str(server_add[1]) + "\r\n"
-            message += "Node Hash: " + str(self.n.SUCC_ID) + "\r\n"
-            message += "Destination: " + self.lines.get("Source") + "\r\n"
-            message += "Nodes Visited: " + str(int(self.lines.get("Nodes Visited")) + 1) + "\r\n"
-            message += "Error Message: " + response
-            message += "\r\n\r\n"
+        # Retrieve appropriate error statement
+        response = self.generate_response_message(response_code)
 
-            # Set class-level dictionary 'lines' lines with return information
-            self.lines["Destination"] = self.lines.get("Source")
-            self.lines["Source"] = server_add[0] + " " + str(server_add[1])
-            print("Sending Error Response: " + response)
+        # Build response
+        message = "Error\r\n"
+        message += "Source: " + self.SOURCE + "\r\n"
+        message += "Node Hash: " + str(self.n.SUCC_ID) + "\r\n"
+        message += "Destination: " + context.source + "\r\n"
+        message += "Nodes Visited: " + str(context.nodes_visited + 1) + "\r\n"
+        message += self.request_id_line(context)
+        message += "Error Message: " + response
+        message += "\r\n\r\n"
 
-            return message.encode()
+        return message.encode(), self.address(context.source)
 
-        except Exception as a:
-            print(a)
-            return self.err_response(500)
+    @staticmethod
+    def request_id_line(context):
+        """
+        Carry the requester's Request ID, if it sent one, so it can match responses to requests.
+        :param context: RequestContext of the request.
+        :return: Request ID line, or an empty string.
+        """
+        if context.request_id is None:
+            return ""
+        return "Request ID: " + context.request_id + "\r\n"
 
     @staticmethod
     def generate_response_message(response_code):
@@ -238,30 +779,345 @@ class Table:
             400: "Bad Request - The request line contained invalid characters following the protocol string.",
             404: "Not Found - The requested resource was not found.",
             500: "Internal Server - Sorry, something went wrong.",
-            501: "Not Implemented - Server does not support the functionality required to fulfill the request."
+            501: "Not Implemented - Server does not support the functionality required to fulfill the request.",
+            503: "Service Unavailable - Too few replicas acknowledged the write."
         }.get(response_code)
 
-    def go_next(self, location):
+    def go_next(self, context, location):
         """
         Find next node in path and construct request to send to that node.
+        :param context: RequestContext of the request.
         :param location: Hashed value of next node in path.
-        :return: Request for next node.
+        :return: Request for next node and the address of that node.
         """
 
         # Get string value of hashed node id
-        destination = self.n.get_loc_key(location)
-        print("Forwarding to Node: " + str(location))
+        destination = self.n.get_loc_key(location).strip('\n')
 
         # Build request
-        request = "Source: " + self.lines.get("Source") + "\r\n"
-        request += "Destination: " + destination.strip('\n') + "\r\n"
-        request += "Nodes Visited: " + str((int(self.lines.get("Nodes Visited")) + 1)) + "\r\n"
-        request += "Data: " + self.lines.get("Data")
+        request = "Source: " + context.source + "\r\n"
+        request += "Destination: " + destination + "\r\n"
+        request += "Nodes Visited: " + str(context.nodes_visited + 1) + "\r\n"
+        request += self.request_id_line(context)
+        request += "Data: " + context.data
 
-        # Set class-level dictionary 'lines' with return information
-        self.lines["Destination"] = destination
+        return request.encode(), self.address(destination)
 
-        return request.encode()
+    def alive_members(self):
+        """
+        Current membership, in the form Node.set_members() takes.
+        :return: Dictionary of ("<host> <port>", virtual node count) by Node ID for the members in the ring.
+        """
+        return {node_id: (member.location, member.vnodes) for node_id, member in self.members.items() if member.alive}
+
+    def members_entries(self):
+        """
+        Format the membership for another node.
+        :return: Space separated "<host>:<port>:<version>:<1 if in the ring, else 0>:<virtual nodes>" entries.
+        """
+        return " ".join(member.location.replace(" ", ":") + ":" + str(member.version) + ":" + str(int(member.alive)) +
+                        ":" + str(member.vnodes) for member in self.members.values())
+
+    def merge_members(self, entries):
+        """
+        Merge another node's view of the membership into this one's.
+        :param entries: List of entries as written by members_entries().
+        :return: True if a node joined, left or took more virtual nodes as a result.
+        """
+        changed = False
+        for entry in entries:
+            host, port, version, alive, vnodes = entry.split(":")
+            node_id = self.n.hash_address(host, port)
+            member = Member(host + " " + port, int(version), alive == "1", int(vnodes))
+            current = self.members.get(node_id)
+            if current is not None and (member.version, not member.alive) <= (current.version, not current.alive):
+                continue
+
+            # A stale departure of this node, from before it restarted, is overruled rather than accepted
+            if node_id == self.n.NODE_ID and not self.leaving:
+                self.members[node_id] = current._replace(version=member.version + 1)
+                continue
+            self.members[node_id] = member
+            changed = changed or current is None or (current.alive, current.vnodes) != (member.alive, member.vnodes)
+        return changed
+
+    def entries_layout(self, entries):
+        """
+        Layout of the members in another node's view.
+        :param entries: List of entries as written by members_entries().
+        :return: Layout.
+        """
+        node_ids = []
+        for entry in entries:
+            host, port, version, alive, vnodes = entry.split(":")
+            if alive == "1":
+                node_ids.append(self.n.hash_address(host, port))
+                self.n.register(node_ids[-1], host + " " + port, int(vnodes))
+        return self.n.layout(sorted(node_ids))
+
+    def send_members(self, locations):
+        """
+        Send this node's view of the membership.
+        :param locations: Node IDs to send it to.
+        """
+        request = "Source: " + self.SOURCE + "\r\n"
+        request += "Nodes Visited: 0\r\n"
+        request += "Data: members " + self.members_entries()
+        for location in locations:
+            self.transport.sendto(request.encode(), self.address(self.members[location].location))
+
+    async def stabilize(self):
+        """
+        Exchange membership with the successor, the predecessor and one random node every STABILIZE_INTERVAL,
+        so joins and departures reach every node within a few rounds. Each change rebuilds the finger table.
+        """
+        while True:
+            await asyncio.sleep(self.STABILIZE_INTERVAL)
+            peers = {self.n.SUCC_ID, self.n.PRED_ID, random.choice(self.n.NODES)}
+            peers.discard(self.n.NODE_ID)
+            self.send_members(peers)
+
+    def change_view(self):
+        """
+        Switch to the current membership, then move the keys whose holders changed in the background.
+        The node that owned a joining node's range, or a leaving node, has already handed over the keys
+        it owned by the time others hear of the change; what moves here are copies of other ranges.
+        """
+        members = self.alive_members()
+        if self.leaving or self.n.NODE_ID not in members:
+            return
+        self.n.set_members(members)
+
+        async def follow():
+            async with self.membership_lock:
+                # Changes that arrived while keys were moving are caught up with together
+                layout = self.n.layout()
+                if layout.positions != self.placed.positions:
+                    dropped = await self.rebalance(self.placed, layout)
+                    self.placed = layout
+                    self.drop(dropped)
+
+        asyncio.ensure_future(follow())
+
+    async def stored_keys(self):
+        """
+        List the keys stored here. The durable store is scanned on a worker thread so requests keep being served.
+        :return: List of key strings.
+        """
+        if isinstance(self.KV_STORE, dht_store.LogStore):
+            return await asyncio.get_running_loop().run_in_executor(None, self.KV_STORE.keys)
+        return [key for key, val in self.KV_STORE.items() if val is not None]
+
+    async def rebalance(self, old_layout, new_layout):
+        """
+        Hand keys over between two memberships. Each key this node owned goes to the nodes that hold it
+        under the new membership but did not under the old one. Its owner is sent every write first, so
+        its copy is the latest; other holders leave the key to it, unless it has left. It hands over what it
+        owned as it leaves, but by its own view of the ring, so the first remaining holder sends the key too.
+        :param old_layout: Layout before the change.
+        :param new_layout: Layout after the change.
+        :return: Keys this node no longer holds, for the caller to drop once it routes by the new membership.
+        """
+        survivors = set(self.n.physical[position] for position in new_layout.positions)
+        streams = collections.defaultdict(list)
+        dropped = []
+        for count, key in enumerate(await self.stored_keys()):
+            if count % self.HANDOFF_SCAN == 0:
+                await asyncio.sleep(0)
+            x = int(hashlib.sha1(key.encode()).hexdigest(), 16)
+            old = self.n.replica_set(x, old_layout)
+            new = self.n.replica_set(x, new_layout)
+            sender = old[0] if old[0] in survivors else next((node for node in old if node in survivors), None)
+            if self.n.NODE_ID in (old[0], sender):
+                for location in new:
+                    if location not in old:
+                        streams[location].append(key)
+            if self.n.NODE_ID not in new:
+                dropped.append(key)
+        await asyncio.gather(*(self.hand_off(location, keys) for location, keys in streams.items()))
+        return dropped
+
+    async def hand_off(self, location, keys):
+        """
+        Stream keys to a node that now holds them, HANDOFF_BATCH at a time. The next batch is sent once
+        the last is acknowledged, so one batch is in flight per receiver and requests keep being served
+        between batches. Values are read as each batch is sent, so writes made meanwhile are carried.
+        :param location: Node ID of the receiver.
+        :param keys: Key strings.
+        """
+        sent = 0
+        for start in range(0, len(keys), self.HANDOFF_BATCH):
+            batch = keys[start:start + self.HANDOFF_BATCH]
+            for attempt in range(self.HANDOFF_RETRIES):
+                items = [(key, self.KV_STORE.get(key)) for key in batch]
+                items = [item for item in items if item[1] is not None]
+                if await self.replica_write(location, items):
+                    break
+            else:
+                print("Handing keys to " + self.n.get_loc_key(location).strip() + " failed after " +
+                      str(sent) + " keys.")
+                return
+            sent += len(items)
+        print("Handed " + str(sent) + " keys to " + self.n.get_loc_key(location).strip())
+
+    def drop(self, keys):
+        """
+        Remove keys this node no longer holds.
+        :param keys: Key strings.
+        """
+        for key in keys:
+            self.KV_STORE.pop(key, None)
+
+    def handle_join(self, context):
+        """
+        Route a join request to the node that owns the position the joining node is taking: its Node ID,
+        or with virtual nodes, the next of its positions.
+        :param context: RequestContext of the request, whose data is "join <host> <port> <version> <virtual nodes>".
+        :return: Request for next node and its address, or None when this node admits the joining node.
+        """
+        verb, host, port, version, vnodes = context.data.split()
+        location = self.n.hash_loc(self.n.hash_address(host, port, int(vnodes) - 1))
+        if location is not None:
+            return self.go_next(context, location)
+        member = Member(host + " " + port, int(version), True, int(vnodes))
+        asyncio.ensure_future(self.admit(context, self.n.hash_address(host, port), member))
+        return None
+
+    async def admit(self, context, node_id, member):
+        """
+        Admit a node to a position in this node's range. This node keeps answering for the range while
+        the keys the new node will own are streamed to it, copying writes made meanwhile to it as well;
+        then it switches to the new membership, replies with the member list and drops what it no longer holds.
+        :param context: RequestContext of the join request.
+        :param node_id: Node ID of the joining node.
+        :param member: Member entry of the joining node.
+        """
+        async with self.membership_lock:
+            self.n.register(node_id, member.location, member.vnodes)
+            self.upcoming = self.n.layout(sorted(set(self.n.NODES) | {node_id}))
+            try:
+                dropped = await self.rebalance(self.placed, self.upcoming)
+                # Changes heard of meanwhile are caught up with by change_view() once the lock is released
+                self.placed = self.upcoming
+            finally:
+                self.upcoming = None
+            self.members[node_id] = member
+            self.n.set_members(self.alive_members())
+
+            message = "Success!\r\n"
+            message += "Source: " + self.SOURCE + "\r\n"
+            message += "Node Hash: " + str(self.n.SUCC_ID) + "\r\n"
+            message += "Destination: " + context.source + "\r\n"
+            message += "Nodes Visited: " + str(context.nodes_visited + 1) + "\r\n"
+            message += self.request_id_line(context)
+            message += "Members: " + self.members_entries() + "\r\n\r\n"
+            self.transport.sendto(message.encode(), self.address(context.source))
+
+            # Tell every member at once rather than waiting for stabilization: until this node's predecessor
+            # routes the range to the new node, lookups for it would go back and forth between the two
+            self.send_members(set(self.n.NODES) - {self.n.NODE_ID, node_id})
+            self.drop(dropped)
+        print("Admitted " + member.location)
+
+    async def join(self, bootstrap):
+        """
+        Join a running ring through any of its nodes, taking one virtual node at a time. Each request is routed
+        to the node that owns the position being taken, which streams over the keys this node will own there
+        and replies with the member list. As one owner hands over at a time, and only after it has, no write
+        made here is overwritten by an older copy still being handed over.
+        :param bootstrap: Address of a node in the ring.
+        :return: True once joined.
+        """
+        target = self.members[self.n.NODE_ID]
+        for vnodes in range(1, target.vnodes + 1):
+            # Each step is a newer entry for this node, superseding the last as it spreads
+            self.members[self.n.NODE_ID] = target._replace(version=target.version + vnodes, vnodes=vnodes)
+            for attempt in range(self.HANDOFF_RETRIES):
+                request_id = str(next(self.request_ids))
+                joined = asyncio.get_running_loop().create_future()
+                self.pending[request_id] = joined
+                request = "Source: " + self.SOURCE + "\r\n"
+                request += "Nodes Visited: 0\r\n"
+                request += "Request ID: " + request_id + "\r\n"
+                request += "Data: join " + self.SOURCE + " " + str(target.version + vnodes) + " " + str(vnodes)
+                self.transport.sendto(request.encode(), bootstrap)
+                try:
+                    fields = await asyncio.wait_for(joined, self.JOIN_TIMEOUT)
+                except asyncio.TimeoutError:
+                    continue
+                finally:
+                    self.pending.pop(request_id, None)
+                if "Members" not in fields:
+                    print(fields.get("Error Message"))
+                    continue
+
+                # The keys this node owns were handed over before the reply, and copies of its predecessors' keys
+                # come from their owners as they hear of the join, so there is nothing to move from here
+                entries = fields["Members"].split()
+                self.placed = self.entries_layout(entries)
+                self.merge_members(entries)
+                self.n.set_members(self.alive_members())
+                self.change_view()
+                break
+            else:
+                return False
+        return True
+
+    def request_leave(self):
+        """
+        Leave the ring on SIGINT or SIGTERM; a second signal stops the node at once.
+        """
+        if self.leaving:
+            self.stopped.set()
+        else:
+            asyncio.ensure_future(self.leave())
+
+    async def leave(self):
+        """
+        Leave the ring: hand the keys this node owns to the nodes that hold them once it is gone, copying
+        writes made meanwhile to them as well, then announce the departure to every member, whose owners
+        move the copies this node kept of their keys.
+        """
+        print("Leaving...")
+        self.leaving = True
+        async with self.membership_lock:
+            survivors = sorted(node_id for node_id in self.alive_members() if node_id != self.n.NODE_ID)
+            if survivors:
+                self.upcoming = self.n.layout(survivors)
+                try:
+                    await self.rebalance(self.placed, self.upcoming)
+                finally:
+                    self.upcoming = None
+            member = self.members[self.n.NODE_ID]
+            self.members[self.n.NODE_ID] = member._replace(version=member.version + 1, alive=False)
+            self.send_members(survivors)
+        self.stopped.set()
+
+
+class NodeProtocol(asyncio.DatagramProtocol):
+    """
+    Receives requests for a Table and sends each reply or forwarded request without blocking.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.table.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            written = self.table.write_count()
+            response = self.table.respond(data, addr)
+            if response is not None:
+                self.table.send(*response, written)
+        except Exception as d:
+            print(d)
+
+    def error_received(self, exc):
+        print(exc)
 
 
 class Node:
@@ -269,194 +1125,245 @@ class Node:
     Node implements the the various local components of A Scalable Peer-to-peer Lookup Service (Chord)
     """
     MAX_ENT = 160
-    finger_table = {}
+    RING = 1 << MAX_ENT
+    # Copies of each key kept on the successors of its owner, in addition to the owner's own; none unless
+    # asked for with -r, so a ring behaves as it did without replication
+    REPLICAS = 0
+    # Virtual nodes per unit of capacity: a node weighted w in the host file takes round(VNODES * w) positions
+    # on the ring, at least one, so that key shares even out and follow capacity
+    VNODES = 1
     NODE_ID = 0
     SUCC_ID = 0
     PRED_ID = 0
     nodes_key = {}
+    # Node ID of the node at each ring position, and each node's positions, its Node ID first
+    physical = {}
+    vnode_ids = {}
 
     def __init__(self):
         self.SERVER_LINES = server_lines
-        self.LINE_COUNT = line_count
-        self.NODES = Node.discover(self)
         print("Discovering...")
+        members = Node.gen_hash(self)
         print("Building Table...")
-        Node.build_table(self)
-
-    def discover(self):
-        """
-        Sets Successor and Predecessor Node ID.
-        :return:
-        """
-
-        # Create list of hashed nodes
-        hashed_nodes = self.gen_hash()
-
-        # Loop through sorted list and assign appropriate members
-        for i in range(len(hashed_nodes)):
-            if self.NODE_ID == hashed_nodes[i]:
-                try:
-                    self.SUCC_ID = hashed_nodes[i + 1]
-                except IndexError:
-                    self.SUCC_ID = hashed_nodes[0]
-                try:
-                    self.PRED_ID = hashed_nodes[i - 1]
-                except IndexError:
-                    self.PRED_ID = hashed_nodes[len(hashed_nodes) - 1]
-        return hashed_nodes
+        Node.set_members(self, members)
 
     def gen_hash(self):
         """
-        Construct list of sorted, hashed nodes.
-        :return: List of sorted, hashed nodes.
+        Read the host file into the starting membership.
+        :return: Dictionary of ("<host> <port>", virtual node count) by Node ID.
         """
 
         line_num = 0
-        hashed_nodes = [None] * self.LINE_COUNT
+        members = {}
 
-        # Loop through given list of Hostnames and Port numbers
+        # Loop through given list of Hostnames, Port numbers and optional capacity weights
         for line in self.SERVER_LINES:
 
-            # Determine host and port from each line
-            line.strip('\n')
-            host, port = line.split()
-
-            # Get IPv4 representation of host
-            ip = socket.gethostbyname(host)
-
-            # Convert port to int then to bytes
-            port_int = int(port)
-            port_bytes = port_int.to_bytes(2, byteorder='big')
-
-            # Convert IPv4 to bytes then append port bytes
-            node_id = socket.inet_pton(socket.AF_INET, ip)
-            node_id += port_bytes
-
-            # Hash byte representation
-            hashed_val = int(hashlib.sha1(node_id).hexdigest(), 16)
+            # Determine host, port and weight from each line
+            fields = line.split()
+            host, port = fields[:2]
+            weight = float(fields[2]) if len(fields) > 2 else 1.0
 
-            # Store in local array
-            hashed_nodes[line_num] = hashed_val
-
-            # Store hashed node as key and original host and port strings as value in class-level dictionary
-            self.nodes_key[hashed_val] = line
+            # Hash byte representation of IPv4 address and port
+            hashed_val = self.hash_address(host, port)
+            members[hashed_val] = (host + " " + port, max(1, round(self.VNODES * weight)))
 
             # Set Current Node ID based off command line argument
             if line_num == int(sys.argv[2]):
-                self.NODE_ID = hashed_nodes[line_num]
+                self.NODE_ID = hashed_val
             line_num += 1
 
-        # Sort list
-        hashed_nodes.sort()
-
-        return hashed_nodes
+        return members
 
-    def build_table(self):
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def hash_address(host, port, vnode=0):
         """
-        Build finger table from sorted list of hashed nodes
+        Hash a node's address onto the ring; cached, as membership exchanges name every node.
+        :param host: Hostname or IPv4 address.
+        :param port: Port number.
+        :param vnode: Which of the node's virtual nodes; the first is the Node ID itself.
+        :return: Ring position.
         """
+        # Convert IPv4 to bytes then append port bytes, and the virtual node number after the first
+        node_id = socket.inet_pton(socket.AF_INET, socket.gethostbyname(host))
+        node_id += int(port).to_bytes(2, byteorder='big')
+        if vnode:
+            node_id += vnode.to_bytes(2, byteorder='big')
+        return int(hashlib.sha1(node_id).hexdigest(), 16)
+
+    def register(self, node_id, location, vnodes):
+        """
+        Record a node's address and ring positions.
+        :param node_id: Node ID.
+        :param location: "<host> <port>" of the node.
+        :param vnodes: Number of virtual nodes it has.
+        """
+        host, port = location.split()
+        self.nodes_key[node_id] = location + "\n"
+        self.vnode_ids[node_id] = [self.hash_address(host, port, vnode) for vnode in range(vnodes)]
+        for position in self.vnode_ids[node_id]:
+            self.physical[position] = node_id
 
-        # Set modulo value
-        mod_val = pow(2, self.MAX_ENT)
-
-        # Number of rows in table = k where 1 < k < m
-        if self.LINE_COUNT < self.MAX_ENT:
-            k = self.LINE_COUNT
-        else:
-            k = self.MAX_ENT
-
-        # Create finger table entries
-        # Entries are represented by ~ log2(Given Host List) nodes
-        # Visual Representation of table: <index> \\ <N+2^i mod 2^m> // <N+2^i+1 mod 2^m> // <Successor of range>
-        for i in range(k):
-            x = ((self.NODE_ID + pow(2, i)) % mod_val)
-            y = ((self.NODE_ID + pow(2, i + 1)) % mod_val)
-            successor_node = self.set_successor(x)
-            self.finger_table[i] = {"start": x, "end": y, "successor": successor_node}
-
-    def set_successor(self, x):
+    def layout(self, node_ids=None):
+        """
+        Ring positions of a membership and the holders of each position's keys, as replica_set() takes them.
+        A key's owner is the node of the position after it, and its replicas are the nodes of the positions
+        after that, skipping positions of nodes already counted, until REPLICAS more are found.
+        :param node_ids: Registered Node IDs, or None for the current membership.
+        :return: Layout.
         """
-        Determine successor of finger.
-        :param x: Finger.
-        :return: Finger's Successor
+        if node_ids is None:
+            return self.LAYOUT
+        positions = sorted(position for node_id in node_ids for position in self.vnode_ids[node_id])
+        wanted = min(self.REPLICAS + 1, len(node_ids))
+        count = len(positions)
+        holders = []
+        for index in range(count):
+            nodes = []
+            while len(nodes) < wanted:
+                node_id = self.physical[positions[index % count]]
+                if node_id not in nodes:
+                    nodes.append(node_id)
+                index += 1
+            holders.append(nodes)
+        return Layout(positions, holders)
+
+    def set_members(self, members):
         """
+        Switch to a new ring membership: set Successor and Predecessor and rebuild the finger table.
+        Addresses and positions of nodes that left are kept, as keys are still being handed over by them.
+        :param members: Dictionary of ("<host> <port>", virtual node count) by Node ID, including this node.
+        """
+        self.nodes_key = dict(self.nodes_key)
+        self.physical = dict(self.physical)
+        self.vnode_ids = dict(self.vnode_ids)
+        for node_id, (location, vnodes) in members.items():
+            self.register(node_id, location, vnodes)
+        self.NODES = sorted(members)
+        self.LINE_COUNT = len(self.NODES)
+        self.LAYOUT = self.layout(self.NODES)
+        self.POSITIONS = self.LAYOUT.positions
+        # A lookup moves to a closer position each hop, so it can take as many hops as there are positions
+        self.HOP_LIMIT = len(self.POSITIONS)
+        self.build_table()
 
-        # Set default to Node's Successor
-        successor = self.SUCC_ID
+    def build_table(self):
+        """
+        Build a finger table for each of this node's positions from the sorted list of ring positions.
+        Finger i of position N starts at N+2^i mod 2^m and its successor is found by bisecting the sorted
+        positions, so building the table is O(v m log n) for v virtual nodes. Fingers are kept as parallel
+        lists: for each position, the distinct fingers ordered by clockwise distance and the nodes they belong to.
+        """
+        self.OWN_POSITIONS = sorted(self.vnode_ids[self.NODE_ID])
+        count = len(self.POSITIONS)
+        self.PRED_POSITIONS = []
+        self.OWN_DISTANCES = []
+        self.SUCC_NODES = []
+        self.SUCC_DISTANCES = []
+        self.READ_DISTANCES = []
+        self.finger_nodes = []
+        self.finger_distances = []
+        for own in self.OWN_POSITIONS:
+            index = bisect.bisect_left(self.POSITIONS, own)
+            successor = self.POSITIONS[(index + 1) % count]
+            self.PRED_POSITIONS.append(self.POSITIONS[index - 1])
+            self.OWN_DISTANCES.append(self.distance(self.POSITIONS[index - 1], own) or self.RING)
+            self.SUCC_NODES.append(self.physical[successor])
+            self.SUCC_DISTANCES.append(self.distance(own, successor) or self.RING)
+
+            # Distinct fingers other than this position, closest first, for closest preceding finger lookups
+            nodes = [self.physical[successor]]
+            distances = [self.SUCC_DISTANCES[-1]]
+            for i in range(self.MAX_ENT):
+                finger = self.position_of((own + (1 << i)) % self.RING)
+                distance = self.distance(own, finger)
+                if distance > distances[-1]:
+                    nodes.append(self.physical[finger])
+                    distances.append(distance)
+            self.finger_nodes.append(nodes)
+            self.finger_distances.append(distances)
+
+            # Reads for keys owned within the next few positions go straight to one of the key's copies
+            self.READ_DISTANCES.append(self.distance(own, self.POSITIONS[(index + min(2 * self.REPLICAS + 1, count - 1))
+                                                                          % count]))
+
+        position = self.OWN_POSITIONS.index(self.NODE_ID)
+        self.SUCC_ID = self.SUCC_NODES[position]
+        self.PRED_ID = self.physical[self.PRED_POSITIONS[position]]
+
+        # Each key is copied to REPLICAS nodes after its owner, as laid out by layout()
+        self.REPLICA_COUNT = min(self.REPLICAS, self.LINE_COUNT - 1)
+        self.HOLDS_ALL = self.LINE_COUNT <= self.REPLICAS + 1
+
+    def position_of(self, x):
+        """
+        Determine the ring position responsible for a point: the first position above it.
+        :param x: Key or finger start.
+        :return: Ring position.
+        """
+        return self.POSITIONS[bisect.bisect_right(self.POSITIONS, x) % len(self.POSITIONS)]
 
-        # If finger is between current node and its successor
-        if self.check_successor(x):
-            return self.SUCC_ID
+    def successor_of(self, x):
+        """
+        Determine the node responsible for a point on the ring. A position stores the keys from the
+        position before it up to but not including its own, so this is the node of the first position above x.
+        :param x: Key or finger start.
+        :return: Node ID of the responsible node.
+        """
+        return self.physical[self.position_of(x)]
 
-        # If finger is not between current node and successor, find next closest node
-        else:
-            for node in self.NODES:
-                if (node ^ x) < (successor ^ x) and x < node:
-                    successor = node
-            return successor
+    def distance(self, a, b):
+        """
+        Clockwise distance between two points on the ring.
+        :param a: Starting point.
+        :param b: End point.
+        :return: Distance from a to b going clockwise, modulo 2^m.
+        """
+        return (b - a) % self.RING
 
-    def closest_successor(self, x):
+    def closest_preceding_finger(self, x, own=None):
         """
-        Search finger table for closest successor node to key.
+        Search finger table for the finger that most closely precedes key.
         :param x: Key.
-        :return: Closest successor to key's location.
+        :param own: Index of the position of this node's that most closely precedes the key, if already known.
+        :return: Node ID of the farthest finger not past the key.
         """
+        if own is None:
+            own = bisect.bisect_right(self.OWN_POSITIONS, x) - 1
+        distance = self.distance(self.OWN_POSITIONS[own], x)
+        return self.finger_nodes[own][bisect.bisect_right(self.finger_distances[own], distance) - 1]
 
-        # Set default to Node's Successor
-        successor = self.SUCC_ID
-
-        # Loop through finger table and compare successors
-        for i in range(len(self.finger_table)):
-            node = self.finger_table.get(i)
-            finger = node.get("start")
-            if (finger ^ x) < (successor ^ x) and x < node.get("successor"):
-                successor = node.get("successor")
-
-        return successor
-
-    def check_successor(self, x):
+    def holds(self, x):
         """
-        Compare the location of x to the range between the current node and its successor.
-        :param x: Key or finger.
-        :return: True if x is in range, false if not.
+        Check whether this node keeps a copy of a key, as its owner or as one of its replicas.
+        :param x: Hashed representation of key.
+        :return: True if a copy of the key belongs here.
         """
-        if self.NODE_ID > self.SUCC_ID and (
-                x in range(self.NODE_ID, pow(2, self.MAX_ENT)) or x in range(0, self.SUCC_ID)):
-            return True
-        elif self.SUCC_ID > self.NODE_ID and x in range(self.NODE_ID, self.SUCC_ID):
-            return True
-        else:
-            return False
+        return self.HOLDS_ALL or self.NODE_ID in self.replica_set(x)
 
-    def check_self(self, x):
+    def replica_set(self, x, layout=None):
         """
-        Compare the location of x to the range between the current node and its predecessor.
-        :param x: Key.
-        :return: True if x is in range, false if not.
+        Determine the nodes keeping copies of a key: its owner and the owner's REPLICAS successors.
+        :param x: Hashed representation of key.
+        :param layout: Layout of a membership other than the current one.
+        :return: List of Node IDs, owner first, not to be modified.
         """
-        if (self.NODE_ID > self.PRED_ID) and x in range(self.PRED_ID, self.NODE_ID):
-            return True
-        if (self.PRED_ID > self.NODE_ID) and (
-                x in range(self.PRED_ID, pow(2, self.MAX_ENT)) or x in range(0, self.NODE_ID)):
-            return True
-        else:
-            return False
+        if layout is None:
+            layout = self.LAYOUT
+        return layout.holders[bisect.bisect_right(layout.positions, x) % len(layout.positions)]
 
-    def check_table(self, x):
+    def read_loc(self, x):
         """
-        Search table for successor.
-        :param x: Key.
-        :return: Location of successor if found.
-        """
-        for i in range(len(self.finger_table)):
-            finger = self.finger_table.get(i)
-            start = finger.get("start")
-            end = finger.get("end")
-            if start > end and (x in range(start, pow(2, self.MAX_ENT)) or x in range(0, end)):
-                return finger.get("successor")
-            elif end > start and x in range(start, end):
-                return finger.get("successor")
-        return None
+        Determine the next hop for a read. Once the key's owner is among the next few positions, any of the
+        key's copies can answer, so one is picked at random to spread the load of popular keys.
+        :param x: Hashed representation of key.
+        :return: Location of the next node.
+        """
+        own = bisect.bisect_right(self.OWN_POSITIONS, x) - 1
+        if self.distance(self.OWN_POSITIONS[own], x) < self.READ_DISTANCES[own]:
+            return random.choice(self.replica_set(x))
+        return self.hash_loc(x)
 
     def key_loc(self, key):
         """
@@ -467,21 +1374,29 @@ class Node:
 
         # Hash key
         x = int(hashlib.sha1(key.encode()).hexdigest(), 16)
+        return self.hash_loc(x), x
 
-        # If only one node in system or the key can be found locally
-        if len(self.finger_table) == 1 or self.check_self(x):
-            return None, x
+    def hash_loc(self, x):
+        """
+        Determine the location of a hashed key.
+        :param x: Hashed representation of key.
+        :return: Location of key's successor, or None if the key belongs to this node.
+        """
 
-        # If key's successor is current node's successor
-        if self.check_successor(x):
-            return self.SUCC_ID, x
+        # If only one node in system or the key can be found locally: x in [PRED, POSITION) for one of this
+        # node's positions, the first one above x
+        after = bisect.bisect_right(self.OWN_POSITIONS, x)
+        own = after % len(self.OWN_POSITIONS)
+        if self.LINE_COUNT == 1 or self.distance(self.PRED_POSITIONS[own], x) < self.OWN_DISTANCES[own]:
+            return None
 
-        # Search Table
-        else:
-            loc = self.check_table(x)
-            if loc is None:
-                loc = self.closest_successor(x)
-        return loc, x
+        # If key's successor is the successor of the closest of this node's positions before it: x in [POSITION, SUCC)
+        own = after - 1
+        if self.distance(self.OWN_POSITIONS[own], x) < self.SUCC_DISTANCES[own]:
+            return self.SUCC_NODES[own]
+
+        # Otherwise forward to the closest preceding finger, at least halving the remaining distance
+        return self.closest_preceding_finger(x, own)
 
     def get_loc_key(self, location):
         """
@@ -491,9 +1406,35 @@ class Node:
         """
         return self.nodes_key.get(location)
 
-
 if __name__ == '__main__':
 
+    # Usage: dht_node.py [-r replicas] [-w write quorum] [-v virtual nodes] [-j <host> <port>] <host file>
+    # <line number> [store directory], keeping keys in memory without a directory. Host file lines are
+    # "<host> <port> [weight]", and a node takes virtual nodes in proportion to its weight, 1 by default.
+    # With -j the node joins a running ring through the node at <host> <port> and only its own line of the
+    # host file is used. Replicas default to 0 and the write quorum to 1; with -r 2 -w 3 every get sees the
+    # last successful put, while -r 2 -w 2 lets a get answered by a lagging replica return an older value.
+    bootstrap = None
+    while len(sys.argv) > 2 and sys.argv[1] in ("-r", "-w", "-v", "-j"):
+        if sys.argv[1] == "-j":
+            if len(sys.argv) < 4:
+                print("Please provide the host and port of a node to join through.")
+                os._exit(0)
+            bootstrap = sys.argv[2] + " " + sys.argv[3]
+            del sys.argv[1:4]
+            continue
+        try:
+            if sys.argv[1] == "-r":
+                Node.REPLICAS = int(sys.argv[2])
+            elif sys.argv[1] == "-v":
+                Node.VNODES = int(sys.argv[2])
+            else:
+                Table.WRITE_QUORUM = int(sys.argv[2])
+        except ValueError as z:
+            print("Please provide a valid number of replicas.")
+            os._exit(0)
+        del sys.argv[1:3]
+
     # Check Command Line args
     if len(sys.argv) > 1:
         try:
@@ -511,8 +1452,9 @@ if __name__ == '__main__':
             if line_count < int(sys.argv[2]) + 1:
                 print("Please provide a valid line number.")
                 os._exit(0)
-            host_name, port_num = server_lines[int(sys.argv[2])].split()
+            host_name, port_num = server_lines[int(sys.argv[2])].split()[:2]
             server_add = (HOST, PORT) = host_name, int(port_num)
+            store_dir = sys.argv[3] if len(sys.argv) > 3 else None
             FILE.close()
 
             Table()
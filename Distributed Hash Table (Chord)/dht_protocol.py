@@ -0,0 +1,123 @@
+import collections
+import hashlib
+import socket
+import struct
+
+# First byte of every binary message; text messages always start with an ASCII letter
+MAGIC = 0xD7
+VERSION = 1
+
+# Message kinds; REPLICATE carries a write from a key's owner to a successor keeping a copy
+GET = 1
+PUT = 2
+REPLY = 3
+REPLICATE = 4
+
+# Flag set when the message carries a value; a put without one removes the key
+HAS_VALUE = 0x01
+
+# magic, version, kind, flags, status, nodes visited, request id, source ip, source port,
+# key digest, node digest, key length, value length; the key and value bytes follow
+HEADER = struct.Struct('!BBBBHHI4sH20s20sHI')
+NODES_VISITED = struct.Struct('!H')
+NODES_VISITED_OFFSET = 6
+SOURCE = struct.Struct('!4sH')
+SOURCE_OFFSET = 12
+NO_DIGEST = bytes(20)
+
+# A decoded binary message; source is the requester's (ip, port), with port 0 until the first node fills it in
+Message = collections.namedtuple('Message', ['kind', 'flags', 'status', 'nodes_visited', 'request_id', 'source',
+                                             'key_hash', 'node_hash', 'key', 'value'])
+
+
+def key_digest(key):
+    """
+    Hash a key onto the ring.
+    :param key: Key bytes.
+    :return: 20-byte SHA-1 digest.
+    """
+    return hashlib.sha1(key).digest()
+
+
+def is_binary(data):
+    """
+    Tell binary messages from text ones.
+    :param data: Received datagram.
+    :return: True if the datagram uses the binary format.
+    """
+    return data[:1] == b'\xd7'
+
+
+def request(kind, key, value=None, request_id=0):
+    """
+    Construct a get or put request from a client.
+    :param kind: GET or PUT.
+    :param key: Key bytes.
+    :param value: Value bytes for puts, or None to remove the key.
+    :param request_id: ID echoed in the reply.
+    :return: Message.
+    """
+    return Message(kind, HAS_VALUE if value is not None else 0, 0, 0, request_id, ('0.0.0.0', 0),
+                   key_digest(key), NO_DIGEST, key, value if value is not None else b'')
+
+
+def reply(message, status, node_hash, value=None):
+    """
+    Construct the reply to a request.
+    :param message: Request being answered.
+    :param status: HTTP-style status code.
+    :param node_hash: 20-byte digest identifying the answering node.
+    :param value: Value bytes, or None.
+    :return: Message.
+    """
+    return message._replace(kind=REPLY, flags=HAS_VALUE if value is not None else 0, status=status,
+                            nodes_visited=message.nodes_visited + 1, node_hash=node_hash,
+                            value=value if value is not None else b'')
+
+
+def encode(message):
+    """
+    Pack a message into a datagram.
+    :param message: Message.
+    :return: Datagram bytes.
+    """
+    return b''.join((HEADER.pack(MAGIC, VERSION, message.kind, message.flags, message.status,
+                                 message.nodes_visited, message.request_id,
+                                 socket.inet_aton(message.source[0]), message.source[1], message.key_hash,
+                                 message.node_hash, len(message.key), len(message.value)),
+                     message.key, message.value))
+
+
+def decode(data):
+    """
+    Unpack a datagram into a message.
+    :param data: Datagram bytes.
+    :return: Message.
+    :raises ValueError: If the datagram is not a complete binary message of a known version.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("truncated header")
+    (magic, version, kind, flags, status, nodes_visited, request_id, source_ip, source_port, key_hash,
+     node_hash, key_length, value_length) = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("unsupported message version")
+    if len(data) != HEADER.size + key_length + value_length:
+        raise ValueError("message length does not match header")
+    key_end = HEADER.size + key_length
+    return Message(kind, flags, status, nodes_visited, request_id, (socket.inet_ntoa(source_ip), source_port),
+                   key_hash, node_hash, bytes(data[HEADER.size:key_end]), bytes(data[key_end:]))
+
+
+def forwarded(data, source, nodes_visited):
+    """
+    Copy a request for the next hop, patching only the header fields that change,
+    so intermediate nodes neither re-encode the key and value nor re-hash the key.
+    :param data: Received request datagram.
+    :param source: Requester's (ip, port).
+    :param nodes_visited: Updated count of nodes visited.
+    :return: Datagram bytes for the next node.
+    """
+    message = bytearray(data)
+    NODES_VISITED.pack_into(message, NODES_VISITED_OFFSET, nodes_visited)
+    SOURCE.pack_into(message, SOURCE_OFFSET, socket.inet_aton(source[0]), source[1])
+    return message
@@ -0,0 +1,485 @@
+import asyncio
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+LOG_FILE = 'data.log'
+INDEX_FILE = 'data.idx'
+LOG_MAGIC = b'DHTLOG1\0'
+INDEX_MAGIC = b'DHTIDX1\0'
+
+# magic, generation; a log and an index only belong together if their generations match
+LOG_HEADER = struct.Struct('!8sQ')
+# magic, generation, log offset the index covers up to, number of entries
+INDEX_HEADER = struct.Struct('!8sQQQ')
+# key digest, offset of the key's latest record in the log, record length; entries are sorted by digest
+INDEX_ENTRY = struct.Struct('!20sQI')
+# crc32 of the rest of the record, kind, key length, value length; the key and value bytes follow
+RECORD = struct.Struct('!IBHI')
+
+# Record kinds
+PUT = 1
+DELETE = 2
+
+# always: fsync before every put returns; group: a syncer thread fsyncs whatever has been written since
+# its last fsync and replies wait for it; none: leave writeback to the operating system
+FSYNC_POLICIES = ("always", "group", "none")
+
+# Compact once the log has doubled since the last compaction and is at least this large
+COMPACT_MIN_BYTES = 64 * 1024 * 1024
+# Write a new index once this much log has been appended past the one on disk
+CHECKPOINT_BYTES = 16 * 1024 * 1024
+READ_CHUNK = 1024 * 1024
+# Keys read per hold of the lock when listing keys
+SCAN_CHUNK = 1024
+
+
+def key_digest(key):
+    """
+    Hash a key for the index; the same SHA-1 that places the key on the ring.
+    :param key: Key bytes.
+    :return: 20-byte digest.
+    """
+    return hashlib.sha1(key).digest()
+
+
+def encode_record(kind, key, value):
+    """
+    Pack one put or delete for the log.
+    :param kind: PUT or DELETE.
+    :param key: Key bytes.
+    :param value: Value bytes, empty for deletes.
+    :return: Record bytes.
+    """
+    body = RECORD.pack(0, kind, len(key), len(value))[4:] + key + value
+    return struct.pack('!I', zlib.crc32(body)) + body
+
+
+def fsync_directory(directory):
+    """
+    Make renames and newly created files in a directory durable.
+    :param directory: Directory path.
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class LogStore:
+    """
+    Durable replacement for a node's KV_STORE dictionary. Every put and delete is appended to a
+    checksummed log, and a sorted index of each key's latest record is kept on disk and mmapped,
+    so a restart only replays the log written after the index instead of the whole history.
+    Checkpoints of the index and compaction of the log run on a background thread.
+    """
+
+    def __init__(self, directory, fsync_policy, compact_min_bytes=COMPACT_MIN_BYTES,
+                 checkpoint_bytes=CHECKPOINT_BYTES):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError("unknown fsync policy " + str(fsync_policy))
+        self.DIRECTORY = directory
+        self.FSYNC_POLICY = fsync_policy
+        self.COMPACT_MIN_BYTES = compact_min_bytes
+        self.CHECKPOINT_BYTES = checkpoint_bytes
+        self.LOG_PATH = os.path.join(directory, LOG_FILE)
+        self.INDEX_PATH = os.path.join(directory, INDEX_FILE)
+
+        # lock guards the log descriptor, offsets and lookups; sync_lock keeps the descriptor open during fsync
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.written = threading.Condition(self.lock)
+
+        # Records appended after the index: digest -> (offset, length, deleted)
+        self.recent = {}
+        self.index = None
+        self.index_count = 0
+        self.index_position = LOG_HEADER.size
+        self.appended = 0
+        self.durable = 0
+        self.waiters = []
+        self.closed = False
+        self.maintainer = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.fd, self.generation = self.open_log()
+        self.open_index()
+        self.end = self.replay(self.index_position)
+        self.compacted_size = self.end
+
+        self.syncer = None
+        if self.FSYNC_POLICY == "group":
+            self.syncer = threading.Thread(target=self.sync_loop, daemon=True)
+            self.syncer.start()
+
+    def open_log(self):
+        """
+        Open the log, creating it with a new generation if there is none.
+        :return: Log file descriptor and generation.
+        """
+        if not os.path.exists(self.LOG_PATH):
+            generation = int.from_bytes(os.urandom(8), byteorder='big')
+            self.write_file(self.LOG_PATH, [LOG_HEADER.pack(LOG_MAGIC, generation)])
+        fd = os.open(self.LOG_PATH, os.O_RDWR | os.O_APPEND)
+        magic, generation = LOG_HEADER.unpack(os.pread(fd, LOG_HEADER.size, 0))
+        if magic != LOG_MAGIC:
+            os.close(fd)
+            raise ValueError(self.LOG_PATH + " is not a store log")
+        return fd, generation
+
+    def write_file(self, path, chunks):
+        """
+        Durably create or replace a file: write a temporary file, fsync it and rename it into place.
+        :param path: Destination path.
+        :param chunks: Iterable of bytes to write.
+        """
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        fsync_directory(self.DIRECTORY)
+
+    def open_index(self):
+        """
+        Map the index if it was written for this log; otherwise the whole log is replayed.
+        """
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        self.index_count = 0
+        self.index_position = LOG_HEADER.size
+        try:
+            with open(self.INDEX_PATH, 'rb') as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return
+        magic, generation, position, count = INDEX_HEADER.unpack_from(index)
+        if (magic != INDEX_MAGIC or generation != self.generation or position > os.fstat(self.fd).st_size
+                or len(index) != INDEX_HEADER.size + count * INDEX_ENTRY.size):
+            index.close()
+            return
+        self.index = index
+        self.index_count = count
+        self.index_position = position
+
+    def replay(self, position):
+        """
+        Read the log from a position to its end into recent, cutting off a torn or corrupt final write.
+        :param position: Log offset to start from.
+        :return: Offset of the end of the log.
+        """
+        offset = position
+        buffer = b''
+        intact = True
+        with open(self.LOG_PATH, 'rb') as f:
+            f.seek(position)
+            while intact:
+                chunk = f.read(READ_CHUNK)
+                if not chunk:
+                    break
+                buffer += chunk
+                start = 0
+                while len(buffer) - start >= RECORD.size:
+                    crc, kind, key_length, value_length = RECORD.unpack_from(buffer, start)
+                    length = RECORD.size + key_length + value_length
+                    if len(buffer) - start < length:
+                        break
+                    if zlib.crc32(buffer[start + 4:start + length]) != crc or kind not in (PUT, DELETE):
+                        intact = False
+                        break
+                    key = buffer[start + RECORD.size:start + RECORD.size + key_length]
+                    self.recent[key_digest(key)] = (offset, length, kind == DELETE)
+                    offset += length
+                    start += length
+                buffer = buffer[start:]
+
+        size = os.fstat(self.fd).st_size
+        if offset != size:
+            print("Discarding " + str(size - offset) + " bytes of incomplete log")
+            os.truncate(self.LOG_PATH, offset)
+        return offset
+
+    def find(self, digest):
+        """
+        Binary search the mapped index.
+        :param digest: Key digest.
+        :return: Offset and length of the key's record, or None.
+        """
+        low, high = 0, self.index_count
+        while low < high:
+            middle = (low + high) // 2
+            position = INDEX_HEADER.size + middle * INDEX_ENTRY.size
+            found = self.index[position:position + 20]
+            if found < digest:
+                low = middle + 1
+            elif found > digest:
+                high = middle
+            else:
+                return INDEX_ENTRY.unpack_from(self.index, position)[1:]
+        return None
+
+    def locate(self, digest):
+        """
+        Find a key's latest record. Callers hold the lock.
+        :param digest: Key digest.
+        :return: Offset and length of the record, or None if the key is absent or deleted.
+        """
+        entry = self.recent.get(digest)
+        if entry is not None:
+            return None if entry[2] else entry[:2]
+        if self.index is None:
+            return None
+        return self.find(digest)
+
+    def get(self, key, default=None):
+        """
+        Look up a key.
+        :param key: Key string.
+        :param default: Returned if the key is absent.
+        :return: Value string.
+        """
+        key = key.encode('utf-8', 'surrogateescape')
+        with self.lock:
+            location = self.locate(key_digest(key))
+            if location is None:
+                return default
+            record = os.pread(self.fd, location[1], location[0])
+        return record[RECORD.size + len(key):].decode('utf-8', 'surrogateescape')
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.locate(key_digest(key.encode('utf-8', 'surrogateescape'))) is not None
+
+    def __setitem__(self, key, value):
+        """
+        Append a put, or a delete when the value is None, as handle_put() uses it.
+        :param key: Key string.
+        :param value: Value string, or None.
+        """
+        key = key.encode('utf-8', 'surrogateescape')
+        if value is None:
+            record = encode_record(DELETE, key, b'')
+        else:
+            record = encode_record(PUT, key, value.encode('utf-8', 'surrogateescape'))
+        with self.lock:
+            os.write(self.fd, record)
+            self.recent[key_digest(key)] = (self.end, len(record), value is None)
+            self.end += len(record)
+            self.appended += len(record)
+            if self.FSYNC_POLICY == "always":
+                os.fsync(self.fd)
+                self.durable = self.appended
+            elif self.FSYNC_POLICY == "group":
+                self.written.notify()
+            self.maybe_maintain()
+
+    def pop(self, key, default=None):
+        """
+        Remove a key, appending a delete if it is present.
+        :param key: Key string.
+        :param default: Returned if the key is absent.
+        :return: The removed value string.
+        """
+        value = self.get(key)
+        if value is None:
+            return default
+        self[key] = None
+        return value
+
+    def keys(self):
+        """
+        List the live keys, for handing ranges of them to other nodes. The lock is taken a slice of
+        keys at a time, so writers are not held up for the whole scan; keys written after it starts
+        may be missed.
+        :return: List of key strings.
+        """
+        with self.lock:
+            digests = set(self.recent)
+            if self.index is not None:
+                digests.update(entry[0] for entry in INDEX_ENTRY.iter_unpack(
+                    self.index[INDEX_HEADER.size:INDEX_HEADER.size + self.index_count * INDEX_ENTRY.size]))
+        digests = list(digests)
+
+        keys = []
+        for start in range(0, len(digests), SCAN_CHUNK):
+            with self.lock:
+                for digest in digests[start:start + SCAN_CHUNK]:
+                    location = self.locate(digest)
+                    if location is not None:
+                        key_length = RECORD.unpack(os.pread(self.fd, RECORD.size, location[0]))[2]
+                        key = os.pread(self.fd, key_length, location[0] + RECORD.size)
+                        keys.append(key.decode('utf-8', 'surrogateescape'))
+        return keys
+
+    def when_durable(self, callback):
+        """
+        Call back on the running event loop once everything written so far is on disk.
+        :param callback: Function taking no arguments.
+        """
+        with self.lock:
+            if self.FSYNC_POLICY == "group" and self.durable < self.appended:
+                self.waiters.append((self.appended, asyncio.get_running_loop(), callback))
+                return
+        callback()
+
+    def sync_loop(self):
+        """
+        Group commit: fsync everything written while the previous fsync was running, then release
+        the replies waiting on it.
+        """
+        while True:
+            with self.lock:
+                while self.durable == self.appended and not self.closed:
+                    self.written.wait()
+                if self.durable == self.appended:
+                    return
+                target = self.appended
+            with self.sync_lock:
+                os.fsync(self.fd)
+            self.synced(target)
+
+    def synced(self, target):
+        """
+        Record that the log is on disk up to a point and wake the replies waiting for it.
+        :param target: Bytes appended when the fsync began.
+        """
+        with self.lock:
+            self.durable = max(self.durable, target)
+            ready = [waiter for waiter in self.waiters if waiter[0] <= self.durable]
+            self.waiters = [waiter for waiter in self.waiters if waiter[0] > self.durable]
+        for appended, loop, callback in ready:
+            # A node that has stopped serving has no replies left to send
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(callback)
+
+    def maybe_maintain(self):
+        """
+        Start compaction or a checkpoint in the background when the log has grown enough. Callers hold the lock.
+        """
+        if self.closed or (self.maintainer is not None and self.maintainer.is_alive()):
+            return
+        if self.end > max(2 * self.compacted_size, self.COMPACT_MIN_BYTES):
+            compact = True
+        elif self.end - self.index_position > self.CHECKPOINT_BYTES:
+            compact = False
+        else:
+            return
+        self.maintainer = threading.Thread(target=self.maintain, args=(compact,), daemon=True)
+        self.maintainer.start()
+
+    def maintain(self, compact):
+        """
+        Write a new index covering the log up to now and, when compacting, a new log holding only
+        each live key's latest record. Writers carry on meanwhile; only the final switch takes the lock.
+        :param compact: True to rewrite the log as well as the index.
+        """
+        try:
+            with self.lock:
+                position = self.end
+                recent = dict(self.recent)
+                index, count = self.index, self.index_count
+
+            # Live keys as of position: the old index overlaid with everything appended after it
+            live = {}
+            if index is not None:
+                live = {digest: (offset, length) for digest, offset, length
+                        in INDEX_ENTRY.iter_unpack(index[INDEX_HEADER.size:INDEX_HEADER.size +
+                                                         count * INDEX_ENTRY.size])}
+            for digest, (offset, length, deleted) in recent.items():
+                if deleted:
+                    live.pop(digest, None)
+                else:
+                    live[digest] = (offset, length)
+
+            if compact:
+                self.compact(position, live)
+            else:
+                self.write_index(self.INDEX_PATH, self.generation, position, live)
+                with self.lock:
+                    self.open_index()
+                    self.recent = {digest: entry for digest, entry in self.recent.items() if entry[0] >= position}
+        except OSError as e:
+            print(e)
+
+    def write_index(self, path, generation, position, live):
+        """
+        Write an index file.
+        :param path: Destination path.
+        :param generation: Generation of the log it indexes.
+        :param position: Log offset the index covers up to.
+        :param live: Dictionary of (offset, length) by key digest.
+        """
+        digests = sorted(live)
+        self.write_file(path, [INDEX_HEADER.pack(INDEX_MAGIC, generation, position, len(digests)),
+                               b''.join(INDEX_ENTRY.pack(digest, *live[digest]) for digest in digests)])
+
+    def compact(self, position, live):
+        """
+        Copy each live record into a new log, then switch to it, bringing over whatever was appended
+        to the old log while the copy ran.
+        :param position: Log offset the copy covers up to.
+        :param live: Dictionary of (offset, length) by key digest as of position.
+        """
+        generation = int.from_bytes(os.urandom(8), byteorder='big')
+        temporary = self.LOG_PATH + '.tmp'
+        moved = {}
+        with open(temporary, 'wb') as f:
+            f.write(LOG_HEADER.pack(LOG_MAGIC, generation))
+            for digest, (offset, length) in sorted(live.items(), key=lambda item: item[1][0]):
+                moved[digest] = (f.tell(), length)
+                f.write(os.pread(self.fd, length, offset))
+            f.flush()
+            tail_start = f.tell()
+        self.write_index(self.INDEX_PATH + '.new', generation, tail_start, moved)
+
+        with self.sync_lock, self.lock:
+            # Bring over records appended during the copy; they are few, so writers wait only briefly
+            with open(temporary, 'ab') as f:
+                copied = position
+                while copied < self.end:
+                    chunk = os.pread(self.fd, min(READ_CHUNK, self.end - copied), copied)
+                    f.write(chunk)
+                    copied += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.LOG_PATH)
+            os.replace(self.INDEX_PATH + '.new', self.INDEX_PATH)
+            fsync_directory(self.DIRECTORY)
+
+            os.close(self.fd)
+            self.fd, self.generation = self.open_log()
+            self.open_index()
+            shift = tail_start - position
+            self.recent = {digest: (offset + shift, length, deleted)
+                           for digest, (offset, length, deleted) in self.recent.items() if offset >= position}
+            self.end += shift
+            self.compacted_size = self.end
+            target = self.appended
+        self.synced(target)
+
+    def close(self):
+        """
+        Stop the background threads, flush the log and write an index covering all of it,
+        so the next start has nothing to replay.
+        """
+        with self.lock:
+            self.closed = True
+            self.written.notify()
+            maintainer = self.maintainer
+        if maintainer is not None:
+            maintainer.join()
+        if self.syncer is not None:
+            self.syncer.join()
+        os.fsync(self.fd)
+        if self.end > self.index_position:
+            self.maintain(False)
+        if self.index is not None:
+            self.index.close()
+        os.close(self.fd)
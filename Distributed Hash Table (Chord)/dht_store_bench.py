@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+import dht_store
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of sorted values.
+    :param values: Sorted list of numbers.
+    :param fraction: Percentile as a fraction between 0 and 1.
+    :return: Percentile value, or None for an empty list.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def put_load(store, puts, concurrency, value):
+    """
+    Put keys from concurrent writers that each wait for their put to be acknowledged, the way a
+    node holds its reply until the store reports the write durable.
+    :param store: LogStore.
+    :param puts: Total number of puts.
+    :param concurrency: Number of writers.
+    :param value: Value string.
+    :return: Sorted acknowledgement latencies in seconds.
+    """
+    loop = asyncio.get_running_loop()
+    latencies = []
+
+    async def writer(first):
+        for i in range(first, puts, concurrency):
+            started = time.perf_counter()
+            store["key" + str(i)] = value
+            acknowledged = loop.create_future()
+            store.when_durable(lambda: acknowledged.set_result(None))
+            await acknowledged
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(writer(first) for first in range(concurrency)))
+    return sorted(latencies)
+
+
+def bench_puts(directory, policies, puts, concurrency, value_size):
+    """
+    Compare put throughput and acknowledgement latency under each fsync policy.
+    :param directory: Scratch directory.
+    :param policies: Fsync policies to run.
+    :param puts: Puts per policy.
+    :param concurrency: Number of concurrent writers.
+    :param value_size: Bytes per value.
+    """
+    value = "v" * value_size
+    for policy in policies:
+        path = os.path.join(directory, policy)
+        store = dht_store.LogStore(path, policy)
+        started = time.perf_counter()
+        latencies = asyncio.run(put_load(store, puts, concurrency, value))
+        elapsed = time.perf_counter() - started
+        store.close()
+        shutil.rmtree(path)
+        print('{policy:<7} {rate:>10,.0f} puts/s   ack p50 {p50:>8.3f} ms  p99 {p99:>8.3f} ms'.format(
+            policy=policy, rate=puts / elapsed, p50=percentile(latencies, 0.50) * 1e3,
+            p99=percentile(latencies, 0.99) * 1e3))
+
+
+def timed_open(path):
+    """
+    Open a store and close it again without writing anything.
+    :param path: Store directory.
+    :return: Seconds taken to open the store and number of log records it replayed.
+    """
+    started = time.perf_counter()
+    store = dht_store.LogStore(path, "none")
+    elapsed = time.perf_counter() - started
+    replayed = len(store.recent)
+    store.closed = True
+    os.close(store.fd)
+    if store.index is not None:
+        store.index.close()
+    return elapsed, replayed
+
+
+def bench_restart(directory, keys, rewrites, value_size):
+    """
+    Compare restart time from the index with replaying the whole log, and show the log size
+    compaction keeps after every key has been rewritten many times.
+    :param directory: Scratch directory.
+    :param keys: Number of distinct keys.
+    :param rewrites: Times each key is written.
+    :param value_size: Bytes per value.
+    """
+    path = os.path.join(directory, "restart")
+    store = dht_store.LogStore(path, "none")
+    for round_number in range(rewrites):
+        value = str(round_number) * value_size
+        for i in range(keys):
+            store["key" + str(i)] = value
+    if store.maintainer is not None:
+        store.maintainer.join()
+    store.close()
+    log_size = os.path.getsize(os.path.join(path, dht_store.LOG_FILE))
+    index_size = os.path.getsize(os.path.join(path, dht_store.INDEX_FILE))
+    written = keys * rewrites * (dht_store.RECORD.size + len("key" + str(keys)) + value_size)
+    print('{keys:,} keys written {rewrites} times: {written:,.1f} MiB of puts, log {log:,.1f} MiB, '
+          'index {index:,.1f} MiB'.format(keys=keys, rewrites=rewrites, written=written / 2 ** 20,
+                                         log=log_size / 2 ** 20, index=index_size / 2 ** 20))
+
+    elapsed, replayed = timed_open(path)
+    print('restart from index   {ms:>9.1f} ms   {replayed:>9,} records replayed'.format(
+        ms=elapsed * 1e3, replayed=replayed))
+    os.remove(os.path.join(path, dht_store.INDEX_FILE))
+    elapsed, replayed = timed_open(path)
+    print('restart without one  {ms:>9.1f} ms   {replayed:>9,} records replayed'.format(
+        ms=elapsed * 1e3, replayed=replayed))
+    shutil.rmtree(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DHT node's durable store.")
+    parser.add_argument("--directory", help="scratch directory on the disk to measure (default: a temporary one)")
+    parser.add_argument("--policies", default=",".join(dht_store.FSYNC_POLICIES),
+                        help="comma separated: " + ", ".join(dht_store.FSYNC_POLICIES))
+    parser.add_argument("--puts", type=int, default=5000, help="puts per fsync policy")
+    parser.add_argument("--concurrency", type=int, default=64, help="writers waiting on acknowledgements")
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--keys", type=int, default=200000, help="distinct keys in the restart test")
+    parser.add_argument("--rewrites", type=int, default=5, help="times each key is written in the restart test")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="dht_store_bench.", dir=args.directory)
+    try:
+        bench_puts(directory, args.policies.split(","), args.puts, args.concurrency, args.value_size)
+        bench_restart(directory, args.keys, args.rewrites, args.value_size)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+import asyncio
+import bisect
+import collections
+import hashlib
+import itertools
+import os
+import random
+import socket
+import time
+
+MAX_PACKET = 65507
+# Value the nodes report for a key that was put without one, i.e. removed
+EMPTY_VALUE = "<EMPTY>"
+
+
+def node_id(host, port):
+    """
+    Hash a node's address onto the ring the same way dht_node.py does.
+    :param host: Hostname or IPv4 address.
+    :param port: Port number.
+    :return: Node ID and IPv4 address of the host.
+    """
+    ip = socket.gethostbyname(host)
+    return int(hashlib.sha1(socket.inet_pton(socket.AF_INET, ip) + int(port).to_bytes(2, byteorder='big'))
+               .hexdigest(), 16), ip
+
+
+def load_ring(host_file):
+    """
+    Read the DHT host file, one "<host> <port> [weight]" line per node. The ring is placed by each node's
+    ID alone; with virtual nodes, requests for keys owned at other positions are forwarded by the nodes.
+    :param host_file: Path to the host file the DHT nodes were started with.
+    :return: Sorted node IDs and the address of each node, in the same order.
+    """
+    nodes = []
+    with open(host_file) as f:
+        for line in f:
+            if line.strip():
+                host, port = line.split()[:2]
+                hashed, ip = node_id(host, port)
+                nodes.append((hashed, (ip, int(port))))
+    nodes.sort()
+    return [hashed for hashed, address in nodes], [address for hashed, address in nodes]
+
+
+def parse_message(data):
+    """
+    Split a DHT message into its fields.
+    :param data: Received datagram.
+    :return: Dictionary of fields, with the first line under "Status".
+    """
+    lines = data.decode(errors='replace').splitlines()
+    fields = {"Status": lines[0] if lines else ''}
+    for line in lines[1:]:
+        name, sep, value = line.partition(': ')
+        if sep:
+            fields[name] = value
+    return fields
+
+
+def interpret(fields):
+    """
+    Map a DHT response onto an HTTP status.
+    :param fields: Parsed response, or None if no node answered.
+    :return: HTTP status code and the value for successful gets.
+    """
+    if fields is None:
+        return 504, None
+    if fields["Status"] == "Success!":
+        value = fields.get("Value")
+        # A removed key is answered as found with no value
+        if value == EMPTY_VALUE:
+            return 404, None
+        return 200, value
+    message = fields.get("Error Message", '')
+    if message.startswith("Not Found"):
+        return 404, None
+    if message.startswith("Bad Request"):
+        return 400, None
+    return 502, None
+
+
+class ResponseProtocol(asyncio.DatagramProtocol):
+    """
+    Hands each response received on a pooled socket to the request waiting for its Request ID.
+    """
+
+    def __init__(self, pending):
+        self.pending = pending
+
+    def datagram_received(self, data, addr):
+        fields = parse_message(data)
+        future = self.pending.pop(fields.get("Request ID"), None)
+        if future is not None and not future.done():
+            future.set_result(fields)
+
+
+class DHTGateway:
+    """
+    Gateway from the HTTP server to the Chord DHT. Requests are sent straight to the node that owns
+    the key, over a small pool of non-blocking UDP sockets shared by every request in the process.
+    Each request carries a Request ID that the nodes echo, so many lookups can be in flight on one
+    socket and late or duplicate responses are ignored. Successful gets are cached for a short TTL.
+
+    The pool and cache belong to one process, so what they buy depends on the serving mode:
+    event mode shares them between every connection; prefork and reuseport workers share them between
+    the connections each worker serves, but call() blocks the worker for up to TIMEOUT * (RETRIES + 1)
+    while a node does not answer; fork-mode children serve a single connection, so the server gives them
+    a pool of one socket, opened on their first request, and no cache.
+    """
+
+    def __init__(self, host_file, pool_size, timeout, retries, cache_ttl, cache_size):
+        self.POOL_SIZE = pool_size
+        self.TIMEOUT = timeout
+        self.RETRIES = retries
+        self.CACHE_TTL = cache_ttl
+        self.CACHE_SIZE = cache_size
+        self.node_ids, self.addresses = load_ring(host_file)
+        self.cache = collections.OrderedDict()
+        self.pid = None
+        self.sockets = []
+        self.transports = None
+        self.pending = {}
+        self.next_socket = None
+        self.request_ids = None
+
+    def owner(self, key):
+        """
+        Find the node responsible for a key. A node stores the keys hashing between its
+        predecessor's ID and its own, so the owner is the first node whose ID is above the key's hash.
+        :param key: Key string.
+        :return: Address of the owning node.
+        """
+        key_hash = int(hashlib.sha1(key.encode()).hexdigest(), 16)
+        return self.addresses[bisect.bisect_right(self.node_ids, key_hash) % len(self.addresses)]
+
+    def prepare(self):
+        """
+        Open this process's socket pool; forked children start their own instead of sharing the parent's.
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.sockets = []
+        self.transports = None
+        self.pending = {}
+        for _ in range(self.POOL_SIZE):
+            pool_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            pool_socket.setblocking(False)
+            pool_socket.bind(('', 0))
+            self.sockets.append(pool_socket)
+        self.next_socket = itertools.cycle(range(self.POOL_SIZE))
+        self.request_ids = itertools.count(random.getrandbits(31))
+
+    @staticmethod
+    def form_request(address, request_id, verb, key, value):
+        """
+        Construct a request in the format dht_client.py sends.
+        :param address: Address of the node the request is sent to.
+        :param request_id: ID the node echoes in its response.
+        :param verb: "get" or "put".
+        :param key: Key string.
+        :param value: Value for puts, or None.
+        :return: Request datagram.
+        """
+        request = "Destination: " + address[0] + " " + str(address[1]) + "\r\n"
+        request += "Nodes Visited: 0\r\n"
+        request += "Request ID: " + request_id + "\r\n"
+        request += "Data: " + verb + " " + key + ("" if value is None else " " + value)
+        return request.encode()
+
+    def cached(self, key):
+        """
+        Look up a recent successful get.
+        :param key: Key string.
+        :return: Cached value, or None on a miss.
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.cache[key]
+            return None
+        return value
+
+    def remember(self, key, value):
+        """
+        Cache a value, evicting the oldest entries beyond the cache size.
+        :param key: Key string.
+        :param value: Value, or None to forget the key.
+        """
+        self.cache.pop(key, None)
+        if value is None or not self.CACHE_SIZE:
+            return
+        self.cache[key] = (time.monotonic() + self.CACHE_TTL, value)
+        while len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def finish(self, verb, key, value, fields):
+        """
+        Interpret a response and keep the cache in step with it.
+        :param verb: "get" or "put".
+        :param key: Key string.
+        :param value: Value for puts, or None.
+        :param fields: Parsed response, or None if no node answered.
+        :return: HTTP status code and the value for successful gets.
+        """
+        status, found = interpret(fields)
+        if verb == "get" and status == 200:
+            self.remember(key, found)
+        elif verb == "put" and status == 200:
+            self.remember(key, value)
+        return status, found
+
+    def call(self, verb, key, value=None):
+        """
+        Send a request and wait for its response, for the blocking serving modes.
+        :param verb: "get" or "put".
+        :param key: Key string.
+        :param value: Value for puts, or None.
+        :return: HTTP status code and the value for successful gets.
+        """
+        if verb == "get":
+            found = self.cached(key)
+            if found is not None:
+                return 200, found
+        self.prepare()
+        pool_socket = self.sockets[next(self.next_socket)]
+        request_id = str(next(self.request_ids))
+        address = self.owner(key)
+        message = self.form_request(address, request_id, verb, key, value)
+        fields = None
+        try:
+            for attempt in range(self.RETRIES + 1):
+                pool_socket.sendto(message, address)
+                fields = self.wait_for_response(pool_socket, request_id)
+                if fields is not None:
+                    break
+        except OSError as e:
+            print(e)
+        return self.finish(verb, key, value, fields)
+
+    def wait_for_response(self, pool_socket, request_id):
+        """
+        Receive on a pooled socket until the response to a request arrives or the timeout expires,
+        dropping responses to earlier requests that arrive late.
+        :param pool_socket: Socket the request was sent from.
+        :param request_id: ID of the request.
+        :return: Parsed response, or None on timeout.
+        """
+        deadline = time.monotonic() + self.TIMEOUT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            pool_socket.settimeout(remaining)
+            try:
+                data, server = pool_socket.recvfrom(MAX_PACKET)
+            except socket.timeout:
+                return None
+            fields = parse_message(data)
+            if fields.get("Request ID") == request_id:
+                return fields
+
+    async def open_transports(self):
+        """
+        Register the socket pool with the running event loop.
+        :return: List of transports, one per pooled socket.
+        """
+        loop = asyncio.get_running_loop()
+        transports = []
+        try:
+            for pool_socket in self.sockets:
+                transport, protocol = await loop.create_datagram_endpoint(
+                    lambda: ResponseProtocol(self.pending), sock=pool_socket)
+                transports.append(transport)
+        except Exception:
+            # Close the whole pool, so the next attempt starts from fresh sockets none of which is registered
+            for transport in transports:
+                transport.close()
+            for pool_socket in self.sockets:
+                pool_socket.close()
+            self.pid = None
+            raise
+        return transports
+
+    async def call_async(self, verb, key, value=None):
+        """
+        Send a request and wait for its response without blocking the event loop.
+        :param verb: "get" or "put".
+        :param key: Key string.
+        :param value: Value for puts, or None.
+        :return: HTTP status code and the value for successful gets.
+        """
+        if verb == "get":
+            found = self.cached(key)
+            if found is not None:
+                return 200, found
+        self.prepare()
+        loop = asyncio.get_running_loop()
+        # The first request registers the pool once; requests arriving meanwhile wait for the same task
+        if self.transports is None:
+            self.transports = asyncio.ensure_future(self.open_transports())
+        try:
+            transports = await self.transports
+        except Exception:
+            # Let the next request try again rather than fail the same way for the life of the process
+            self.transports = None
+            raise
+        transport = transports[next(self.next_socket)]
+        request_id = str(next(self.request_ids))
+        address = self.owner(key)
+        message = self.form_request(address, request_id, verb, key, value)
+        future = loop.create_future()
+        self.pending[request_id] = future
+        fields = None
+        try:
+            for attempt in range(self.RETRIES + 1):
+                transport.sendto(message, address)
+                try:
+                    fields = await asyncio.wait_for(asyncio.shield(future), self.TIMEOUT)
+                    break
+                except asyncio.TimeoutError:
+                    continue
+        finally:
+            self.pending.pop(request_id, None)
+        return self.finish(verb, key, value, fields)
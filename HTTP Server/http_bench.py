@@ -0,0 +1,548 @@
+import argparse
+import asyncio
+import concurrent.futures
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(SERVER_DIR, "web_root", "_bench")
+HOST = "127.0.0.1"
+# Slow clients connect from their own loopback address, so per-address limits tell them apart from good clients
+SLOW_CLIENT_ADDRESS = "127.0.0.2"
+MODES = ('fork', 'prefork', 'event', 'reuseport')
+POOLED_MODES = ('prefork', 'reuseport')
+
+# Scenario name -> request line target, or raw bytes for requests that are not valid HTTP
+SCENARIOS = {
+    "small": "/index.html",
+    "image": "/foo/bar.jpg",
+    "large": "/_bench/large.bin",
+    "404": "/missing.html",
+    "400": b"GARBAGE\r\n\r\n",
+}
+
+# Keys and values put and read back through /kv/ by --kv-check, several containing the DHT's verbs
+KV_CHECK_PAIRS = [
+    ("widget", "blue"),
+    ("color", "budget"),
+    ("target", "zz"),
+    ("getput", "output"),
+    ("plain", "value"),
+]
+# Values the gateway must refuse with 400, after which the key must read as absent rather than fail
+KV_CHECK_REJECTED = [
+    ("removed", "<EMPTY>"),
+]
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of sorted values.
+    :param values: Sorted list of numbers.
+    :param fraction: Percentile as a fraction between 0 and 1.
+    :return: Percentile value, or None for an empty list.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def build_request(scenario, keep_alive):
+    """
+    Build the request bytes sent for a scenario.
+    :param scenario: Scenario name.
+    :param keep_alive: Whether the connection is reused for further requests.
+    :return: Request bytes.
+    """
+    target = SCENARIOS[scenario]
+    if isinstance(target, bytes):
+        return target
+    return ("GET " + target + " HTTP/1.1\r\nHost: " + HOST + "\r\nConnection: " +
+            ("keep-alive" if keep_alive else "close") + "\r\n\r\n").encode()
+
+
+async def read_response(reader):
+    """
+    Read one response from the server.
+    :param reader: Stream reader for the connection.
+    :return: Status code and whether the server is closing the connection.
+    """
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("iso-8859-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    length = 0
+    closing = False
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "connection":
+            closing = value.strip().lower() == "close"
+    while length > 0:
+        chunk = await reader.read(min(length, 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed mid-body")
+        length -= len(chunk)
+    return status, closing
+
+
+async def client_connection(port, scenario, keep_alive, deadline, stats):
+    """
+    Send requests on one connection, reconnecting whenever it closes, until the deadline.
+    Latency is measured per request and includes connection setup for fresh connections.
+    :param port: Server port.
+    :param scenario: Scenario name.
+    :param keep_alive: Whether to reuse the connection for further requests.
+    :param deadline: time.monotonic() value to stop at.
+    :param stats: Dictionary collecting latencies, status counts and errors.
+    """
+    request = build_request(scenario, keep_alive)
+    while time.monotonic() < deadline:
+        writer = None
+        try:
+            start = time.monotonic()
+            reader, writer = await asyncio.open_connection(HOST, port)
+            while time.monotonic() < deadline:
+                writer.write(request)
+                status, closing = await read_response(reader)
+                stats["latencies"].append(time.monotonic() - start)
+                stats["status"][status] = stats["status"].get(status, 0) + 1
+                if closing or not keep_alive:
+                    break
+                start = time.monotonic()
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+            stats["errors"] += 1
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+async def slow_connection(port, interval, deadline, stats):
+    """
+    Hold a connection open slowloris-style: start a request and send one more header line every
+    interval, never finishing it. Reconnects after each interval when the server drops the connection.
+    :param port: Server port.
+    :param interval: Seconds between header lines.
+    :param deadline: time.monotonic() value to stop at.
+    :param stats: Dictionary collecting connection, response and error counts.
+    """
+    while time.monotonic() < deadline:
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection(HOST, port, local_addr=(SLOW_CLIENT_ADDRESS, 0))
+            stats["connections"] += 1
+            writer.write(b"GET /index.html HTTP/1.1\r\nHost: " + HOST.encode() + b"\r\n")
+            while time.monotonic() < deadline:
+                try:
+                    data = await asyncio.wait_for(reader.read(4096), interval)
+                except asyncio.TimeoutError:
+                    writer.write(b"X-Slow: 1\r\n")
+                    continue
+                status = data[9:12].decode() if data else "closed"
+                stats["status"][status] = stats["status"].get(status, 0) + 1
+                break
+        except OSError:
+            stats["errors"] += 1
+        finally:
+            if writer is not None:
+                writer.close()
+        await asyncio.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+
+
+def run_slow_clients(port, connections, interval, duration):
+    """
+    Run the slow clients in their own process.
+    :param port: Server port.
+    :param connections: Number of slow connections to hold open.
+    :param interval: Seconds between header lines.
+    :param duration: Seconds to keep the connections open for.
+    :return: Dictionary of connection, response and error counts.
+    """
+    stats = {"connections": 0, "status": {}, "errors": 0}
+
+    async def run():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(slow_connection(port, interval, deadline, stats) for _ in range(connections)))
+
+    asyncio.run(run())
+    return stats
+
+
+def run_clients(port, scenario, connections, keep_alive_share, duration):
+    """
+    Run one load-generating process.
+    :param port: Server port.
+    :param scenario: Scenario name.
+    :param connections: Number of concurrent connections in this process.
+    :param keep_alive_share: Fraction of connections that reuse their connection.
+    :param duration: Seconds to generate load for.
+    :return: Dictionary of latencies, status counts and errors.
+    """
+    stats = {"latencies": [], "status": {}, "errors": 0}
+    persistent = round(connections * keep_alive_share)
+
+    async def run():
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(client_connection(port, scenario, index < persistent, deadline, stats)
+                               for index in range(connections)))
+
+    asyncio.run(run())
+    return stats
+
+
+class ServerProcess:
+    """
+    Starts http_svr.py in a given serving mode and samples the resident memory of its process tree.
+    """
+
+    def __init__(self, port, mode, workers, backlog, options=()):
+        self.port = port
+        self.args = [sys.executable, "http_svr.py"] + list(options) + [str(port), mode, str(workers), str(backlog)]
+        self.process = None
+        self.peak_rss = 0
+        self.sampling = False
+        self.sampler = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(self.args, cwd=SERVER_DIR, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        wait_for_port(self.port)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_sampling()
+        self.process.terminate()
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def start_sampling(self):
+        """
+        Sample the process tree's resident memory in the background, keeping the peak.
+        """
+        self.peak_rss = self.tree_rss()
+        self.sampling = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def stop_sampling(self):
+        """
+        Stop background memory sampling.
+        """
+        self.sampling = False
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+
+    def sample(self):
+        while self.sampling:
+            self.peak_rss = max(self.peak_rss, self.tree_rss())
+            time.sleep(0.2)
+
+    def tree_rss(self):
+        """
+        Sum the resident memory of the server and its child processes.
+        :return: Resident memory in KiB.
+        """
+        total = 0
+        pending = [self.process.pid]
+        while pending:
+            pid = pending.pop()
+            try:
+                with open("/proc/{pid}/status".format(pid=pid)) as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total += int(line.split()[1])
+                with open("/proc/{pid}/task/{pid}/children".format(pid=pid)) as f:
+                    pending.extend(int(child) for child in f.read().split())
+            except (OSError, ValueError):
+                continue
+        return total
+
+
+def wait_for_port(port, timeout=10.0):
+    """
+    Wait until the server accepts connections.
+    :param port: Server port.
+    :param timeout: Seconds to wait.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("server did not start listening on port " + str(port))
+
+
+def kv_round_trip(port, key, value):
+    """
+    Put a value through the server's DHT gateway and read it back.
+    :param port: Server port.
+    :param key: Key string.
+    :param value: Value string.
+    :return: Description of the failure, or None if the value was read back.
+    """
+    connection = http.client.HTTPConnection(HOST, port, timeout=10)
+    try:
+        connection.request("PUT", "/kv/" + key, value.encode())
+        response = connection.getresponse()
+        response.read()
+        if response.status != 204:
+            return "PUT /kv/{key} returned {status}".format(key=key, status=response.status)
+        connection.request("GET", "/kv/" + key)
+        response = connection.getresponse()
+        body = response.read().decode(errors="replace")
+        if response.status != 200 or body != value:
+            return "GET /kv/{key} returned {status} {body!r}, expected {value!r}".format(
+                key=key, status=response.status, body=body, value=value)
+        return None
+    except (OSError, http.client.HTTPException) as e:
+        return "/kv/{key}: {error}".format(key=key, error=e)
+    finally:
+        connection.close()
+
+
+def kv_rejected(port, key, value):
+    """
+    Put a value the gateway cannot store and check that it is refused and the key reads as absent.
+    :param port: Server port.
+    :param key: Key string.
+    :param value: Value string.
+    :return: Description of the failure, or None if the value was refused.
+    """
+    connection = http.client.HTTPConnection(HOST, port, timeout=10)
+    try:
+        connection.request("PUT", "/kv/" + key, value.encode())
+        response = connection.getresponse()
+        response.read()
+        if response.status != 400:
+            return "PUT /kv/{key} {value!r} returned {status}, expected 400".format(
+                key=key, value=value, status=response.status)
+        connection.request("GET", "/kv/" + key)
+        response = connection.getresponse()
+        response.read()
+        if response.status != 404:
+            return "GET /kv/{key} returned {status}, expected 404".format(key=key, status=response.status)
+        return None
+    except (OSError, http.client.HTTPException) as e:
+        return "/kv/{key}: {error}".format(key=key, error=e)
+    finally:
+        connection.close()
+
+
+def kv_check(port):
+    """
+    Round-trip every KV_CHECK_PAIRS entry and try every KV_CHECK_REJECTED entry through a freshly
+    started server at once, so the first requests of each process arrive together.
+    :param port: Server port.
+    :return: List of failure descriptions.
+    """
+    checks = [(kv_round_trip, pair) for pair in KV_CHECK_PAIRS] + [(kv_rejected, pair) for pair in KV_CHECK_REJECTED]
+    with concurrent.futures.ThreadPoolExecutor(len(checks)) as pool:
+        results = pool.map(lambda check: check[0](port, *check[1]), checks)
+        return [failure for failure in results if failure is not None]
+
+
+def make_large_file(size_mb):
+    """
+    Create the synthetic large file served by the 'large' scenario.
+    :param size_mb: File size in MiB.
+    """
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    block = os.urandom(1 << 20)
+    with open(os.path.join(BENCH_DIR, "large.bin"), "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+
+
+def remove_large_file():
+    """
+    Remove the synthetic files again.
+    """
+    try:
+        os.remove(os.path.join(BENCH_DIR, "large.bin"))
+        os.rmdir(BENCH_DIR)
+    except OSError:
+        pass
+
+
+def measure(server, scenario, connections, keep_alive_share, duration, client_procs, slow_clients=0,
+            slow_interval=1.0):
+    """
+    Run one load test against a started server.
+    :param server: Running ServerProcess.
+    :param scenario: Scenario name.
+    :param connections: Total number of concurrent connections.
+    :param keep_alive_share: Fraction of connections that reuse their connection.
+    :param duration: Seconds to generate load for.
+    :param client_procs: Number of load-generating processes.
+    :param slow_clients: Number of slowloris-style connections held open alongside the load.
+    :param slow_interval: Seconds between the slow clients' header lines.
+    :return: Result dictionary.
+    """
+    client_procs = max(1, min(client_procs, connections))
+    shares = [connections // client_procs + (1 if i < connections % client_procs else 0)
+              for i in range(client_procs)]
+    server.start_sampling()
+    with multiprocessing.Pool(client_procs + 1) as pool:
+        slow = None
+        if slow_clients:
+            # Let the slow clients take their connections before the measured load starts
+            slow = pool.apply_async(run_slow_clients, (server.port, slow_clients, slow_interval, duration + 1.0))
+            time.sleep(1.0)
+        parts = pool.starmap(run_clients, [(server.port, scenario, share, keep_alive_share, duration)
+                                           for share in shares])
+        slow = slow.get() if slow is not None else None
+    server.stop_sampling()
+
+    latencies = sorted(latency for part in parts for latency in part["latencies"])
+    status = {}
+    for part in parts:
+        for code, count in part["status"].items():
+            status[str(code)] = status.get(str(code), 0) + count
+
+    def millis(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "scenario": scenario,
+        "connections": connections,
+        "keepalive": keep_alive_share,
+        "duration": duration,
+        "requests": len(latencies),
+        "errors": sum(part["errors"] for part in parts),
+        "rps": round(len(latencies) / duration, 1),
+        "p50_ms": millis(percentile(latencies, 0.50)),
+        "p95_ms": millis(percentile(latencies, 0.95)),
+        "p99_ms": millis(percentile(latencies, 0.99)),
+        "max_ms": millis(latencies[-1] if latencies else None),
+        "status": status,
+        "server_rss_kb": server.peak_rss,
+        "slow_clients": slow_clients,
+        "slow": slow,
+    }
+
+
+def print_result(result):
+    """
+    Print one result row.
+    :param result: Result dictionary.
+    """
+    print("{mode:<10} w={workers:<3} {scenario:<6} c={connections:<5} ka={keepalive:<4} {rps:>10,.1f} req/s  "
+          "p50 {p50_ms} ms  p95 {p95_ms} ms  p99 {p99_ms} ms  errors {errors}  rss {server_rss_kb} KiB  {status}"
+          .format(**result))
+    if result["slow"]:
+        print("{indent}slow clients {slow_clients}: {connections} connections, responses {status}, errors {errors}"
+              .format(indent=' ' * 11, slow_clients=result["slow_clients"], **result["slow"]))
+
+
+def result_key(result):
+    return (result["mode"], result["workers"], result["scenario"], result["connections"], result["keepalive"],
+            result.get("slow_clients", 0))
+
+
+def compare(baseline_path, results):
+    """
+    Print throughput and tail latency changes against an earlier results file.
+    :param baseline_path: Path to a JSON file written by an earlier run.
+    :param results: Results of this run.
+    """
+    with open(baseline_path) as f:
+        baseline = {result_key(result): result for result in json.load(f)["results"]}
+    print("\nChange against " + baseline_path)
+    for result in results:
+        old = baseline.get(result_key(result))
+        if old is None or not old["rps"] or not old["p99_ms"] or result["p99_ms"] is None:
+            continue
+        print("{mode:<10} w={workers:<3} {scenario:<6} c={connections:<5} ka={keepalive:<4} "
+              "req/s {rps:+.1f}%  p99 {p99:+.1f}%".format(rps=(result["rps"] / old["rps"] - 1) * 100,
+                                                          p99=(result["p99_ms"] / old["p99_ms"] - 1) * 100,
+                                                          **result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test http_svr.py serving modes on localhost.")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--modes", default="event", help="comma separated: " + ", ".join(MODES))
+    parser.add_argument("--workers", default="1", help="comma separated worker counts for pooled modes")
+    parser.add_argument("--backlog", type=int, default=1024)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: " + ", ".join(SCENARIOS))
+    parser.add_argument("--connections", default="50", help="comma separated concurrent connection counts")
+    parser.add_argument("--keepalive", default="1.0", help="comma separated shares of persistent connections")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per measurement")
+    parser.add_argument("--slow-clients", type=int, default=0,
+                        help="slowloris-style connections from " + SLOW_CLIENT_ADDRESS + " held open during each run")
+    parser.add_argument("--slow-interval", type=float, default=1.0, help="seconds between slow clients' header lines")
+    parser.add_argument("--client-procs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--large-size", type=int, default=16, help="MiB in the 'large' scenario file")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON file from an earlier run to compare against")
+    parser.add_argument("--kv-check", metavar="HOST_FILE",
+                        help="instead, check that /kv/ PUTs read back in each mode, through the running DHT "
+                             "ring started with this host file")
+    args = parser.parse_args()
+
+    modes = args.modes.split(",")
+    scenarios = args.scenarios.split(",")
+    for name in modes:
+        if name not in MODES:
+            parser.error("unknown mode " + name)
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario " + name)
+
+    if args.kv_check:
+        failed = False
+        for mode in modes:
+            worker_counts = [int(count) for count in args.workers.split(",")] if mode in POOLED_MODES else [1]
+            for workers in worker_counts:
+                with ServerProcess(args.port, mode, workers, args.backlog, ("-d", args.kv_check)):
+                    failures = kv_check(args.port)
+                print("{mode:<9} workers {workers:>2}  /kv/ round trips: {result}".format(
+                    mode=mode, workers=workers, result="; ".join(failures) if failures else
+                    "all {count} read back, {rejected} refused".format(
+                        count=len(KV_CHECK_PAIRS), rejected=len(KV_CHECK_REJECTED))))
+                failed = failed or bool(failures)
+        sys.exit(1 if failed else 0)
+
+    results = []
+    make_large_file(args.large_size)
+    try:
+        for mode in modes:
+            worker_counts = [int(count) for count in args.workers.split(",")] if mode in POOLED_MODES else [1]
+            for workers in worker_counts:
+                with ServerProcess(args.port, mode, workers, args.backlog) as server:
+                    for scenario in scenarios:
+                        for connections in args.connections.split(","):
+                            for keep_alive_share in args.keepalive.split(","):
+                                result = measure(server, scenario, int(connections), float(keep_alive_share),
+                                                 args.duration, args.client_procs, args.slow_clients,
+                                                 args.slow_interval)
+                                result.update(mode=mode, workers=workers)
+                                print_result(result)
+                                results.append(result)
+    finally:
+        remove_large_file()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"started": time.strftime("%Y-%m-%dT%H:%M:%S"), "cpus": os.cpu_count(),
+                       "args": vars(args), "results": results}, f, indent=2)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
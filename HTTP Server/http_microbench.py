@@ -0,0 +1,223 @@
+import mimetypes
+import os
+import sys
+import timeit
+from datetime import datetime
+
+import http_svr
+
+REQUEST = (b"GET /foo/index.html HTTP/1.1\r\n"
+           b"Host: localhost:8080\r\n"
+           b"User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:78.0) Gecko/20100101 Firefox/78.0\r\n"
+           b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8\r\n"
+           b"Accept-Language: en-US,en;q=0.5\r\n"
+           b"Accept-Encoding: gzip, deflate\r\n"
+           b"Connection: keep-alive\r\n"
+           b"If-None-Match: \"a4-5aa0f1b3c7f00\"\r\n\r\n")
+PIPELINE_DEPTH = 32
+FRAGMENT_SIZE = 16
+FILE_PATH = "web_root/foo/index.html"
+
+
+def legacy_split_lines(request):
+    """
+    Split request string with newline characters, as the server did before RequestParser.
+    :param request: Received request from client.
+    :return: Request string object broken up by newline characters.
+    """
+    return ''.join((line + '\n') for line in request.splitlines())
+
+
+def legacy_get_header(lines, name):
+    """
+    Find the value of a request header by scanning the split request.
+    :param lines: Request broken up by newline characters.
+    :param name: Header name, matched case-insensitively.
+    :return: Header value or None if the header is absent.
+    """
+    name = name.lower() + ':'
+    for line in lines.split('\n')[1:]:
+        if not line:
+            break
+        if line.lower().startswith(name):
+            return line[len(name):].strip()
+    return None
+
+
+def legacy_parse(data):
+    """
+    Frame and parse every request in a buffer the old way: search for the blank line, rebuild the
+    request with split_lines(), slice the path out with find("HTTP") and scan for each header used.
+    :param data: Received bytes.
+    :return: Number of requests parsed.
+    """
+    buffer = bytearray(data)
+    count = 0
+    while True:
+        end = buffer.find(b'\r\n\r\n')
+        if end == -1:
+            return count
+        request = bytes(buffer[:end + 4])
+        lines = legacy_split_lines(request.decode('iso-8859-1'))
+        legacy_get_header(lines, 'Content-Length')
+        del buffer[:end + 4]
+        lines.find("/../")
+        lines[4:lines.find("HTTP") - 1]
+        legacy_get_header(lines, 'Connection')
+        legacy_get_header(lines, 'If-None-Match')
+        legacy_get_header(lines, 'Accept-Encoding')
+        count += 1
+
+
+def parser_parse(chunks):
+    """
+    Feed chunks to a RequestParser and take off every complete request with the headers the server uses.
+    :param chunks: Received byte chunks.
+    :return: Number of requests parsed.
+    """
+    parser = http_svr.RequestParser()
+    count = 0
+    for chunk in chunks:
+        parser.feed(chunk)
+        while True:
+            request = parser.next_request()
+            if request is None:
+                break
+            request.target.partition('?')
+            request.header('Connection')
+            request.header('If-None-Match')
+            request.header('Accept-Encoding')
+            count += 1
+    return count
+
+
+def legacy_parse_fragments(chunks):
+    """
+    Parse fragmented input the old way, which searches and re-splits the whole buffer after every chunk.
+    :param chunks: Received byte chunks.
+    :return: Number of requests parsed.
+    """
+    buffer = bytearray()
+    count = 0
+    for chunk in chunks:
+        buffer += chunk
+        parsed = legacy_parse(buffer)
+        if parsed:
+            count += parsed
+            del buffer[:]
+    return count
+
+
+def legacy_err_response(response_code):
+    """
+    Construct an error response the old way: find the status in the page's <title>, format the date
+    and concatenate the header line by line.
+    :param response_code: Integer representation of HTTP error code.
+    :return: Complete Error Response.
+    """
+    response = http_svr.generate_response_message(response_code)
+    status = (response[(response.find("<title>") + 7):response.find("</title>")])
+    http_header = "HTTP/1.1 " + status + "\r\n"
+    utc_datetime = datetime.utcnow()
+    http_header += "Date: " + utc_datetime.strftime('%a, %d %b %Y %H:%M:%S GMT') + "\r\n"
+    http_header += "Content-Type: text/html\r\n"
+    http_header += "Content-Length: " + str(len(response)) + "\r\n"
+    http_header += "Connection: Close"
+    http_header += "\r\n\r\n"
+    return http_header.encode(), response.encode()
+
+
+def legacy_form_response(file_path, stat):
+    """
+    Construct an OK response header the old way, with a new MimeTypes() and strftime() per request.
+    :param file_path: Path to resource in web_root.
+    :param stat: os.stat() result for the file.
+    :return: Complete OK response header.
+    """
+    mime_type = mimetypes.MimeTypes().guess_type(file_path)[0]
+    http_header = "HTTP/1.1 200 OK\r\n"
+    utc_datetime = datetime.utcnow()
+    http_header += "Date: " + utc_datetime.strftime('%a, %d %b %Y %H:%M:%S GMT') + "\r\n"
+    http_header += "Last-Modified: " + datetime.fromtimestamp(stat.st_mtime).strftime(
+        '%a, %d %b %Y %H:%M:%S GMT') + "\r\n"
+    http_header += "Content-Type: " + str(mime_type) + "\r\n"
+    http_header += "Content-Length: " + str(stat.st_size) + "\r\n"
+    http_header += "Connection: Close"
+    http_header += "\r\n\r\n"
+    return http_header.encode()
+
+
+def current_form_response(file_path, stat):
+    """
+    Construct an OK response header with the precomputed MIME table, status line and Date header.
+    :param file_path: Path to resource in web_root.
+    :param stat: os.stat() result for the file.
+    :return: Complete OK response header.
+    """
+    http_header, http_body = http_svr.form_response(b'', str(stat.st_size), stat.st_mtime,
+                                                    http_svr.mime_type_for(file_path), http_svr.make_etag(stat),
+                                                    http_svr.cache_control_for(file_path[len(http_svr.WEB_ROOT):]))
+    return http_svr.finish_header(http_header, False)
+
+
+def report_time(name, legacy, current, number):
+    """
+    Time both approaches and print the cost of one call.
+    :param name: Scenario name.
+    :param legacy: Callable using the old approach.
+    :param current: Callable using the current approach.
+    :param number: Number of timing iterations.
+    """
+    legacy_time = min(timeit.repeat(legacy, number=number, repeat=5)) / number
+    current_time = min(timeit.repeat(current, number=number, repeat=5)) / number
+    print('{name:<22} legacy {legacy:>8.2f} us   current {current:>8.2f} us   saved {saved:>8.2f} us'.format(
+        name=name, legacy=legacy_time * 1e6, current=current_time * 1e6, saved=(legacy_time - current_time) * 1e6))
+
+
+def report(name, legacy, parser, number):
+    """
+    Time both approaches and print requests per second.
+    :param name: Scenario name.
+    :param legacy: Callable using the old approach, returning the number of requests parsed.
+    :param parser: Callable using RequestParser, returning the number of requests parsed.
+    :param number: Number of timing iterations.
+    """
+    requests = parser()
+    assert legacy() == requests
+    legacy_time = min(timeit.repeat(legacy, number=number, repeat=5))
+    parser_time = min(timeit.repeat(parser, number=number, repeat=5))
+    print('{name:<22} legacy {legacy:>10,.0f} req/s   parser {parser:>10,.0f} req/s   x{ratio:.2f}'.format(
+        name=name, legacy=requests * number / legacy_time, parser=requests * number / parser_time,
+        ratio=legacy_time / parser_time))
+
+
+def bench_parser(number):
+    """
+    Compare RequestParser with the old split_lines() based request handling.
+    :param number: Number of timing iterations.
+    """
+    pipelined = REQUEST * PIPELINE_DEPTH
+    fragments = [REQUEST[i:i + FRAGMENT_SIZE] for i in range(0, len(REQUEST), FRAGMENT_SIZE)]
+    report('single request', lambda: legacy_parse(REQUEST), lambda: parser_parse([REQUEST]), number)
+    report('pipelined x' + str(PIPELINE_DEPTH), lambda: legacy_parse(pipelined),
+           lambda: parser_parse([pipelined]), max(number // PIPELINE_DEPTH, 1))
+    report(str(FRAGMENT_SIZE) + '-byte fragments', lambda: legacy_parse_fragments(fragments),
+           lambda: parser_parse(fragments), number)
+
+
+def bench_responses(number):
+    """
+    Compare precomputed response generation with building every header per request.
+    :param number: Number of timing iterations.
+    """
+    stat = os.stat(FILE_PATH)
+    report_time('404 response', lambda: legacy_err_response(404),
+                lambda: http_svr.finish_header(http_svr.err_response(404)[0], False), number)
+    report_time('200 response header', lambda: legacy_form_response(FILE_PATH, stat),
+                lambda: current_form_response(FILE_PATH, stat), max(number // 10, 1))
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bench_parser(iterations)
+    bench_responses(iterations)
@@ -1,26 +1,752 @@
+import asyncio
+import bisect
+import collections
+import email.utils
 import errno
+import fcntl
+import gzip
+import json
 import mimetypes
 import os
+import posixpath
+import resource
+import select
+import shutil
 import signal
 import socket
 import sys
-from datetime import datetime
-from os import path
+import tempfile
+import threading
+import time
+import urllib.parse
 
-# Check Command Line args
-if len(sys.argv) > 1:
-    try:
-        isinstance(int(sys.argv[1]), int)
-    except ValueError as z:
-        print("Please provide a valid port number.")
-        os._exit(0)
-    finally:
-        SERVER_ADDRESS = (HOST, PORT) = '', int(sys.argv[1])
-else:
-    print("Please provide a valid port number.")
-    os._exit(0)
-REQUEST_QUEUE_SIZE = 5
+import dht_gateway
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SERVE_MODES = ('fork', 'prefork', 'event', 'reuseport')
+# Listen backlog; bursts of connections queue here while pooled workers are busy. Argument 4 overrides it.
+REQUEST_QUEUE_SIZE = socket.SOMAXCONN
+WORKER_COUNT = os.cpu_count() or 1
+SERVE_MODE = 'fork'
+PIN_WORKERS = False
+WORKER_RESTART_DELAY = 1.0
 MAX_PACKET = 131072
+MAX_HEADER_SIZE = 65536
+MAX_BODY_SIZE = 1024 * 1024
+KEEP_ALIVE_TIMEOUT = 5
+MAX_KEEP_ALIVE_REQUESTS = 100
+# Seconds a client may take to send a complete request once it has started sending it
+HEADER_TIMEOUT = 10
+# Seconds a response may take to be written to the client
+WRITE_TIMEOUT = 30
+# Connections served at once, in total and per client address, before new ones get a 503.
+# Enforced by the fork-mode parent and by each event loop; prefork workers serve one connection at a time.
+MAX_CONNECTIONS = 1024
+MAX_CONNECTIONS_PER_IP = 256
+# Seconds a client refused with 503 is asked to wait before retrying
+RETRY_AFTER = 1
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+CACHE_MAX_ENTRY = 256 * 1024
+WEB_ROOT = "web_root"
+ROUTE_REFRESH_INTERVAL = 1.0
+ROUTE_RESCAN_BATCH = 2000
+
+# Cache-Control value for responses, by URL path prefix (starting with '/') or file extension.
+# The first matching rule wins; CACHE_CONTROL_DEFAULT applies when none match.
+CACHE_CONTROL_RULES = [
+    ('.html', 'no-cache'),
+    ('.jpg', 'public, max-age=86400'),
+    ('.jpeg', 'public, max-age=86400'),
+    ('.png', 'public, max-age=86400'),
+]
+CACHE_CONTROL_DEFAULT = 'public, max-age=300'
+MAX_RANGES = 16
+
+# Structured access log, one JSON object per request; None disables it. Set with -l on the command line.
+ACCESS_LOG_PATH = None
+# Buffered access log lines that wake the flusher early
+ACCESS_LOG_BATCH = 512
+# Seconds between background flushes of the access log and the shared metrics
+TELEMETRY_FLUSH_INTERVAL = 1.0
+# Prometheus text-format metrics are served on this path; None disables the endpoint. Set with -m on the command line.
+METRICS_PATH = None
+# Host file of the Chord DHT ring, as given to dht_node.py; when set, GET and PUT under KV_PREFIX
+# are answered from the DHT. Set with -d on the command line.
+DHT_HOST_FILE = None
+KV_PREFIX = '/kv/'
+# UDP sockets each process shares between its DHT requests
+DHT_POOL_SIZE = 4
+# Seconds to wait for a DHT response before resending, and how many times to resend
+DHT_TIMEOUT = 0.5
+DHT_RETRIES = 2
+# Seconds and entries successful DHT lookups are cached for
+DHT_CACHE_TTL = 2.0
+DHT_CACHE_SIZE = 10000
+# Largest value accepted by PUT, leaving room in the datagram for the rest of the request
+DHT_MAX_VALUE = 60000
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Content types worth compressing; images and other already compressed types are sent as is
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 128
+# Supported content codings in order of preference, with the suffix of precompressed siblings on disk
+ENCODING_SUFFIXES = collections.OrderedDict([('br', '.br'), ('gzip', '.gz')])
+if brotli is None:
+    del ENCODING_SUFFIXES['br']
+STATUS_LINES = {
+    200: b"HTTP/1.1 200 OK\r\n",
+    204: b"HTTP/1.1 204 No Content\r\n",
+    206: b"HTTP/1.1 206 Partial Content\r\n",
+    304: b"HTTP/1.1 304 Not Modified\r\n",
+    400: b"HTTP/1.1 400 Bad Request\r\n",
+    404: b"HTTP/1.1 404 Not Found\r\n",
+    408: b"HTTP/1.1 408 Request Timeout\r\n",
+    413: b"HTTP/1.1 413 Payload Too Large\r\n",
+    416: b"HTTP/1.1 416 Range Not Satisfiable\r\n",
+    431: b"HTTP/1.1 431 Request Header Fields Too Large\r\n",
+    500: b"HTTP/1.1 500 Internal Server Error\r\n",
+    501: b"HTTP/1.1 501 Not Implemented\r\n",
+    502: b"HTTP/1.1 502 Bad Gateway\r\n",
+    503: b"HTTP/1.1 503 Service Unavailable\r\n",
+    504: b"HTTP/1.1 504 Gateway Timeout\r\n",
+}
+CONNECTION_CLOSE = b"Connection: Close\r\n\r\n"
+RETRY_AFTER_HEADER = ("Retry-After: " + str(RETRY_AFTER) + "\r\n").encode()
+CONNECTION_KEEP_ALIVE = ("Connection: keep-alive\r\nKeep-Alive: timeout={timeout}, max={max}\r\n\r\n".format(
+    timeout=KEEP_ALIVE_TIMEOUT, max=MAX_KEEP_ALIVE_REQUESTS)).encode()
+
+# Response body that is streamed from disk instead of being held in memory
+FileSegment = collections.namedtuple('FileSegment', ['file_path', 'offset', 'count'])
+
+# Indexed file under web_root with everything needed to answer for it
+Route = collections.namedtuple('Route', ['url_path', 'file_path', 'stat', 'mime_type', 'cache_control'])
+
+
+class RouteIndex:
+    """
+    In-memory index of the regular files under web_root, mapping normalized URL paths to Routes.
+    Requests are answered from the index without touching the filesystem. Every ROUTE_REFRESH_INTERVAL
+    seconds the index rescans the directories whose mtime changed, and restats the next
+    ROUTE_RESCAN_BATCH files in turn to pick up in-place edits, which leave directory mtimes alone.
+    """
+
+    def __init__(self, root, refresh_interval, rescan_batch):
+        self.ROOT = root
+        self.REFRESH_INTERVAL = refresh_interval
+        self.RESCAN_BATCH = rescan_batch
+        self.routes = {}
+        self.directories = {}
+        self.pending_rescan = []
+        self.last_refresh = 0.0
+
+    def build(self):
+        """
+        Index the whole tree.
+        """
+        self.routes.clear()
+        self.directories.clear()
+        self.scan_directory(self.ROOT)
+        self.last_refresh = time.monotonic()
+
+    def lookup(self, url_path):
+        """
+        Find the file for a normalized URL path.
+        :param url_path: URL path starting with '/'.
+        :return: Route, or None if no such file is indexed.
+        """
+        self.maybe_refresh()
+        return self.routes.get(url_path)
+
+    def maybe_refresh(self):
+        """
+        Refresh the index if the refresh interval has passed.
+        """
+        now = time.monotonic()
+        if now - self.last_refresh >= self.REFRESH_INTERVAL:
+            self.last_refresh = now
+            self.refresh()
+            self.rescan()
+
+    def refresh(self):
+        """
+        Rescan every directory whose mtime changed since it was last scanned.
+        """
+        for dir_path in list(self.directories):
+            entry = self.directories.get(dir_path)
+            if entry is None:
+                continue
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                self.remove_directory(dir_path)
+                continue
+            if mtime_ns != entry[0]:
+                self.scan_directory(dir_path)
+
+    def rescan(self):
+        """
+        Restat the next batch of indexed files to pick up in-place modifications.
+        """
+        if not self.pending_rescan:
+            self.pending_rescan = list(self.routes)
+        batch = self.pending_rescan[-self.RESCAN_BATCH:]
+        del self.pending_rescan[-self.RESCAN_BATCH:]
+        for url_path in batch:
+            route = self.routes.get(url_path)
+            if route is None:
+                continue
+            try:
+                stat = os.stat(route.file_path)
+            except OSError:
+                del self.routes[url_path]
+                continue
+            if stat.st_mtime_ns != route.stat.st_mtime_ns or stat.st_size != route.stat.st_size:
+                self.routes[url_path] = route._replace(stat=stat)
+
+    def scan_directory(self, dir_path):
+        """
+        Index the files of one directory, dropping entries that disappeared and descending into
+        new subdirectories. Symbolic links are only followed to files inside web_root.
+        :param dir_path: Directory under web_root.
+        """
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+            entries = list(os.scandir(dir_path))
+        except OSError:
+            self.remove_directory(dir_path)
+            return
+
+        files, subdirs = set(), set()
+        for entry in entries:
+            try:
+                if entry.is_symlink():
+                    real_root = os.path.realpath(self.ROOT) + os.sep
+                    if not os.path.realpath(entry.path).startswith(real_root) or not entry.is_file():
+                        continue
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.add(entry.path)
+                elif entry.is_file():
+                    files.add(entry.path)
+                    self.add_file(entry.path, entry.stat())
+            except OSError:
+                continue
+
+        previous = self.directories.get(dir_path)
+        self.directories[dir_path] = (mtime_ns, files, subdirs)
+        if previous is not None:
+            for file_path in previous[1] - files:
+                self.routes.pop(file_path[len(self.ROOT):].replace(os.sep, '/'), None)
+            for subdir in previous[2] - subdirs:
+                self.remove_directory(subdir)
+        for subdir in subdirs:
+            if subdir not in self.directories:
+                self.scan_directory(subdir)
+
+    def add_file(self, file_path, stat):
+        """
+        Index one file.
+        :param file_path: Path to resource in web_root.
+        :param stat: os.stat() result for the file.
+        """
+        url_path = file_path[len(self.ROOT):].replace(os.sep, '/')
+        self.routes[url_path] = Route(url_path, file_path, stat, mime_type_for(file_path),
+                                      cache_control_for(url_path))
+
+    def remove_directory(self, dir_path):
+        """
+        Drop a directory and everything indexed below it.
+        :param dir_path: Directory under web_root.
+        """
+        entry = self.directories.pop(dir_path, None)
+        if entry is None:
+            return
+        for file_path in entry[1]:
+            self.routes.pop(file_path[len(self.ROOT):].replace(os.sep, '/'), None)
+        for subdir in entry[2]:
+            self.remove_directory(subdir)
+
+
+class ResponseCache:
+    """
+    Byte-budgeted LRU cache of built responses for small static files.
+    Entries are keyed by file path and revalidated against the file's mtime and size.
+    """
+
+    def __init__(self, max_bytes, max_entry):
+        self.MAX_BYTES = max_bytes
+        self.MAX_ENTRY = max_entry
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, file_path, stat):
+        """
+        Look up a cached response and check it is still current.
+        :param file_path: Path to resource in web_root.
+        :param stat: Fresh os.stat() result for the file.
+        :return: Cached response header and body, or None on a miss.
+        """
+        entry = self.entries.get(file_path)
+        if entry is not None:
+            mtime, size, http_header, http_body = entry
+            if mtime == stat.st_mtime_ns and size == stat.st_size:
+                self.entries.move_to_end(file_path)
+                self.hits += 1
+                return http_header, http_body
+            self.discard(file_path)
+        self.misses += 1
+        return None
+
+    def put(self, file_path, stat, http_header, http_body):
+        """
+        Store a built response, evicting least recently used entries to stay within budget.
+        :param file_path: Path to resource in web_root.
+        :param stat: os.stat() result the response was built from.
+        :param http_header: Response header.
+        :param http_body: Response body bytes.
+        """
+        cost = len(http_header) + len(http_body)
+        if cost > self.MAX_ENTRY:
+            return
+        self.discard(file_path)
+        while self.entries and self.size + cost > self.MAX_BYTES:
+            old_path, old_entry = self.entries.popitem(last=False)
+            self.size -= len(old_entry[2]) + len(old_entry[3])
+            self.evictions += 1
+        self.entries[file_path] = (stat.st_mtime_ns, stat.st_size, http_header, http_body)
+        self.size += cost
+
+    def discard(self, file_path):
+        """
+        Remove a cached response if present.
+        :param file_path: Path to resource in web_root.
+        """
+        entry = self.entries.pop(file_path, None)
+        if entry is not None:
+            self.size -= len(entry[2]) + len(entry[3])
+
+    def stats(self):
+        """
+        Report cache effectiveness.
+        :return: Dictionary of hit, miss and eviction counts, entry count and bytes used.
+        """
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self.entries), "bytes": self.size}
+
+
+class AccessLog:
+    """
+    Buffered structured access log. Requests are kept in memory as JSON lines and written out in
+    batches by the telemetry flusher thread, so serving a request never waits on the disk.
+    Every process appends whole batches to the same file opened with O_APPEND.
+    """
+
+    def __init__(self, path, batch):
+        self.PATH = path
+        self.BATCH = batch
+        self.pending = []
+        self.lock = threading.Lock()
+        self.full = threading.Event()
+        self.fd = None
+
+    def record(self, method, target, status, sent, duration):
+        """
+        Buffer one access log entry.
+        :param method: Request method, or '-' for requests that could not be parsed.
+        :param target: Request target, or '-' for requests that could not be parsed.
+        :param status: Response status code.
+        :param sent: Response body bytes.
+        :param duration: Seconds from the parsed request to the response being sent.
+        """
+        if self.PATH is None:
+            return
+        line = json.dumps({"time": round(time.time(), 3), "pid": os.getpid(), "method": method, "path": target,
+                           "status": status, "bytes": sent, "duration_ms": round(duration * 1000, 3)})
+        with self.lock:
+            self.pending.append(line)
+            if len(self.pending) >= self.BATCH:
+                self.full.set()
+
+    def flush(self):
+        """
+        Write every buffered entry to the log file.
+        """
+        with self.lock:
+            lines, self.pending = self.pending, []
+        if not lines:
+            return
+        try:
+            if self.fd is None:
+                self.fd = os.open(self.PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            data = ('\n'.join(lines) + '\n').encode()
+            while data:
+                data = data[os.write(self.fd, data):]
+        except OSError as g:
+            print(g)
+
+
+class Metrics:
+    """
+    Request counters and latency histograms per route and status, rendered in the Prometheus text
+    format. When a shared directory is set, each process periodically writes its totals there so any
+    worker can answer a scrape for the whole server. Exiting workers leave their final totals as a
+    retired record, which scrapes fold into the retired file. Fork-mode children, which exit after every
+    connection, instead write their totals down a pipe to the parent, which folds them into its own.
+    """
+
+    def __init__(self, buckets):
+        self.BUCKETS = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+        self.directory = None
+        # Read and write ends of the pipe fork-mode children retire through, and unread bytes from it
+        self.retire_pipe = None
+        self.retire_buffer = b''
+
+    def observe(self, route, status, sent, duration):
+        """
+        Count one response.
+        :param route: Route label.
+        :param status: Response status code.
+        :param sent: Response body bytes.
+        :param duration: Seconds from the parsed request to the response being sent.
+        """
+        bucket = 3 + bisect.bisect_left(self.BUCKETS, duration)
+        with self.lock:
+            values = self.series.get((route, status))
+            if values is None:
+                # Request count, body bytes, latency sum, then one count per bucket and +Inf
+                values = self.series[(route, status)] = [0] * (len(self.BUCKETS) + 4)
+            values[0] += 1
+            values[1] += sent
+            values[2] += duration
+            values[bucket] += 1
+
+    def snapshot(self):
+        """
+        Copy this process's totals.
+        :return: List of [route, status, values] entries.
+        """
+        with self.lock:
+            return [[route, status, list(values)] for (route, status), values in self.series.items()]
+
+    def shared_path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write_shared(self, name, entries):
+        """
+        Atomically replace a file in the shared directory.
+        :param name: File name.
+        :param entries: List of [route, status, values] entries.
+        """
+        temp_path = self.shared_path(name + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.shared_path(name))
+
+    def read_shared(self, name):
+        try:
+            with open(self.shared_path(name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def flush(self):
+        """
+        Publish this process's totals to the shared directory.
+        """
+        if self.directory is None:
+            return
+        try:
+            self.write_shared(str(os.getpid()) + '.json', self.snapshot())
+        except OSError as h:
+            print(h)
+
+    def retire(self):
+        """
+        Leave this process's final totals as a retired record before the process exits. The record
+        replaces the process's published totals in one rename; the shared lock only keeps a scrape from
+        listing the directory halfway through, so exiting processes do not wait for each other.
+        """
+        if self.directory is None:
+            return
+        if self.retire_pipe is not None:
+            self.send_retired()
+            return
+        try:
+            name = str(os.getpid()) + '.json'
+            with open(self.shared_path('lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                self.write_shared(name, self.snapshot())
+                os.replace(self.shared_path(name), self.shared_path('retired.' + name))
+            with self.lock:
+                self.series.clear()
+        except OSError as i:
+            print(i)
+
+    def open_retire_pipe(self):
+        """
+        Create the pipe fork-mode children retire through, before any child is forked.
+        """
+        if self.directory is None:
+            return
+        read_end, write_end = os.pipe()
+        os.set_blocking(read_end, False)
+        self.retire_pipe = (read_end, write_end)
+
+    def send_retired(self):
+        """
+        Write this process's totals to the parent, one JSON entry per line. Writes of at most PIPE_BUF
+        bytes are atomic, so lines from children exiting at once do not interleave.
+        """
+        chunk = b''
+        try:
+            for entry in self.snapshot():
+                line = (json.dumps(entry) + '\n').encode()
+                if chunk and len(chunk) + len(line) > select.PIPE_BUF:
+                    os.write(self.retire_pipe[1], chunk)
+                    chunk = b''
+                chunk += line
+            if chunk:
+                os.write(self.retire_pipe[1], chunk)
+        except OSError as i:
+            print(i)
+
+    def fold_retired(self):
+        """
+        Add the totals children have written to the pipe since the last call to this process's own.
+        :return: Whether any totals were added.
+        """
+        if self.retire_pipe is None:
+            return False
+        while True:
+            try:
+                data = os.read(self.retire_pipe[0], 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            self.retire_buffer += data
+        lines = self.retire_buffer.split(b'\n')
+        self.retire_buffer = lines.pop()
+        if not lines:
+            return False
+        with self.lock:
+            self.merge(self.series, [json.loads(line) for line in lines])
+        return True
+
+    @staticmethod
+    def merge(series, entries):
+        """
+        Add entries to a series dictionary.
+        :param series: Dictionary of values by (route, status).
+        :param entries: List of [route, status, values] entries.
+        :return: The updated series dictionary.
+        """
+        for route, status, values in entries:
+            total = series.get((route, status))
+            if total is None:
+                series[(route, status)] = list(values)
+            else:
+                for index, value in enumerate(values):
+                    total[index] += value
+        return series
+
+    def collect(self):
+        """
+        Gather the totals of every process serving on this port.
+        :return: Dictionary of values by (route, status).
+        """
+        series = self.merge({}, self.snapshot())
+        if self.directory is None:
+            return series
+        own_file = str(os.getpid()) + '.json'
+        with open(self.shared_path('lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            names = [name for name in os.listdir(self.directory) if name.endswith('.json')]
+
+            # Fold the records of processes that exited since the last scrape into the retired file
+            records = [name for name in names if name.startswith('retired.') and name != 'retired.json']
+            retired = self.merge({}, self.read_shared('retired.json'))
+            if records:
+                for name in records:
+                    self.merge(retired, self.read_shared(name))
+                self.write_shared('retired.json', [[route, status, values]
+                                                   for (route, status), values in retired.items()])
+                for name in records:
+                    os.remove(self.shared_path(name))
+            self.merge(series, [[route, status, values] for (route, status), values in retired.items()])
+            for name in names:
+                if not name.startswith('retired.') and name != own_file:
+                    self.merge(series, self.read_shared(name))
+        return series
+
+    def render(self):
+        """
+        Render the collected totals in the Prometheus text exposition format.
+        :return: Metrics text.
+        """
+        series = [('route="{route}",status="{status}"'.format(
+            route=route.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'), status=status), values)
+            for (route, status), values in sorted(self.collect().items())]
+        lines = ['# HELP http_requests_total Requests served.',
+                 '# TYPE http_requests_total counter']
+        lines += ['http_requests_total{%s} %d' % (labels, values[0]) for labels, values in series]
+        lines += ['# HELP http_response_bytes_total Response body bytes sent.',
+                  '# TYPE http_response_bytes_total counter']
+        lines += ['http_response_bytes_total{%s} %d' % (labels, values[1]) for labels, values in series]
+        lines += ['# HELP http_request_duration_seconds Time from a parsed request to its response being sent.',
+                  '# TYPE http_request_duration_seconds histogram']
+        bounds = [repr(bound) for bound in self.BUCKETS] + ['+Inf']
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(bounds, values[3:]):
+                cumulative += count
+                lines.append('http_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+            lines.append('http_request_duration_seconds_sum{%s} %.6f' % (labels, values[2]))
+            lines.append('http_request_duration_seconds_count{%s} %d' % (labels, values[0]))
+        return '\n'.join(lines) + '\n'
+
+
+class ConnectionLimiter:
+    """
+    Admission control for new connections, capping how many are served at once in total
+    and from any one client address.
+    """
+
+    def __init__(self, max_connections, max_per_ip):
+        self.MAX_CONNECTIONS = max_connections
+        self.MAX_PER_IP = max_per_ip
+        self.active = 0
+        self.per_ip = {}
+        self.refused = 0
+
+    def admit(self, client_ip):
+        """
+        Take a connection slot for a client if one is free.
+        :param client_ip: Client address.
+        :return: Whether the connection may be served.
+        """
+        count = self.per_ip.get(client_ip, 0)
+        if self.active >= self.MAX_CONNECTIONS or count >= self.MAX_PER_IP:
+            self.refused += 1
+            return False
+        self.active += 1
+        self.per_ip[client_ip] = count + 1
+        return True
+
+    def release(self, client_ip):
+        """
+        Give back the slot of a finished connection.
+        :param client_ip: Client address the slot was admitted for.
+        """
+        self.active -= 1
+        count = self.per_ip.get(client_ip, 1) - 1
+        if count:
+            self.per_ip[client_ip] = count
+        else:
+            self.per_ip.pop(client_ip, None)
+
+
+RESPONSE_CACHE = ResponseCache(CACHE_MAX_BYTES, CACHE_MAX_ENTRY)
+ROUTE_INDEX = RouteIndex(WEB_ROOT, ROUTE_REFRESH_INTERVAL, ROUTE_RESCAN_BATCH)
+ACCESS_LOG = AccessLog(ACCESS_LOG_PATH, ACCESS_LOG_BATCH)
+METRICS = Metrics(LATENCY_BUCKETS)
+CONNECTION_LIMITER = ConnectionLimiter(MAX_CONNECTIONS, MAX_CONNECTIONS_PER_IP)
+
+# Gateway to the Chord DHT, set up by serve() when DHT_HOST_FILE is given
+DHT_GATEWAY = None
+
+# Client address of each fork-mode child, and children reaped since the parent last released their slots
+CHILDREN = {}
+FINISHED_CHILDREN = []
+
+# Background thread flushing the access log and shared metrics, with the event that stops it
+TELEMETRY_FLUSHER = None
+
+# MIME types by lower-case file extension, loaded once
+mimetypes.init()
+MIME_TYPES = dict(mimetypes.types_map)
+
+# Date header line and the second it was formatted for
+DATE_SECOND = 0
+DATE_HEADER = b''
+
+
+def report_cache(signum, frame):
+    """
+    Print response cache statistics.
+    :param signum: Signal Number.
+    :param frame: Stack Frame.
+    """
+    print('Response cache [{pid}]: {stats}'.format(pid=os.getpid(), stats=RESPONSE_CACHE.stats()))
+
+
+def flush_telemetry(stop):
+    """
+    Flush the access log and publish metrics every TELEMETRY_FLUSH_INTERVAL seconds,
+    or sooner when the access log buffer fills up.
+    :param stop: Event set when the process stops serving.
+    """
+    while not stop.is_set():
+        ACCESS_LOG.full.wait(TELEMETRY_FLUSH_INTERVAL)
+        ACCESS_LOG.full.clear()
+        ACCESS_LOG.flush()
+        METRICS.flush()
+
+
+def start_telemetry():
+    """
+    Start the background telemetry flusher in a long-lived serving process.
+    """
+    global TELEMETRY_FLUSHER
+    stop = threading.Event()
+    thread = threading.Thread(target=flush_telemetry, args=(stop,), daemon=True)
+    thread.start()
+    TELEMETRY_FLUSHER = (thread, stop)
+
+
+def stop_telemetry():
+    """
+    Stop the flusher, write out the rest of the access log and retire this process's metrics.
+    """
+    global TELEMETRY_FLUSHER
+    if TELEMETRY_FLUSHER is not None:
+        thread, stop = TELEMETRY_FLUSHER
+        stop.set()
+        ACCESS_LOG.full.set()
+        thread.join()
+        TELEMETRY_FLUSHER = None
+    ACCESS_LOG.flush()
+    METRICS.retire()
+
+
+def reset_telemetry():
+    """
+    Drop access log entries and metrics inherited from the parent process, which still owns them.
+    """
+    ACCESS_LOG.pending = []
+    METRICS.series = {}
+
+
+os.register_at_fork(after_in_child=reset_telemetry)
+
+
+def exit_process(signum, frame):
+    """
+    Exit through the normal cleanup path when the process is asked to terminate.
+    :param signum: Signal Number.
+    :param frame: Stack Frame.
+    """
+    raise SystemExit(0)
 
 
 def end_service(signum, frame):
@@ -41,40 +767,293 @@ def end_service(signum, frame):
 
         if pid == 0:
             return
+        FINISHED_CHILDREN.append(pid)
 
 
-def split_lines(request):
+class RequestError(Exception):
     """
-    Split request string with newline characters for later processing.
-    :param request: Received request from client.
-    :return: Request string object broken up by newline characters.
+    Raised when a request cannot be parsed or exceeds a size limit.
     """
-    try:
-        return ''.join((line + '\n') for line in request.splitlines())
-    except Exception as g:
-        print(g)
-        return err_response(500)
 
+    def __init__(self, response_code):
+        super().__init__(response_code)
+        self.response_code = response_code
+
+
+class Request:
+    """
+    Request line, headers and body of a parsed HTTP request.
+    """
+    __slots__ = ('method', 'target', 'version', 'headers', 'body', 'route')
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = b''
+        # Normalized path the request was routed to, used to label metrics
+        self.route = None
+
+    def header(self, name):
+        """
+        Find the value of a request header.
+        :param name: Header name, matched case-insensitively.
+        :return: Header value or None if the header is absent.
+        """
+        return self.headers.get(name.lower())
 
-def recv_all(sock):
+
+class RequestParser:
+    """
+    Incremental HTTP/1.x request parser over a connection's receive buffer.
+    Received bytes are appended with feed() and complete requests are taken off the front with
+    next_request(), so fragmented and pipelined requests are handled the same way.
+    """
+
+    def __init__(self, max_header=MAX_HEADER_SIZE, max_body=MAX_BODY_SIZE):
+        self.MAX_HEADER = max_header
+        self.MAX_BODY = max_body
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.pending = None
+        self.body_length = 0
+
+    def feed(self, data):
+        """
+        Append received bytes to the buffer.
+        :param data: Bytes received from the connection.
+        """
+        self.buffer += data
+
+    def started(self):
+        """
+        Check whether part of a request has been received.
+        :return: True if the buffer holds an incomplete request.
+        """
+        return self.pending is not None or len(self.buffer) > 0
+
+    def next_request(self):
+        """
+        Remove the first complete request from the buffer.
+        :return: Parsed Request, or None if more bytes are needed.
+        """
+        if self.pending is None:
+            # Only scan bytes not searched on a previous call, allowing for a terminator split across reads
+            end = self.buffer.find(b'\r\n\r\n', max(self.scanned - 3, 0))
+            if end == -1:
+                self.scanned = len(self.buffer)
+                if self.scanned > self.MAX_HEADER:
+                    raise RequestError(431)
+                return None
+            if end + 4 > self.MAX_HEADER:
+                raise RequestError(431)
+            self.pending, self.body_length = self.parse_head(self.buffer[:end].decode('iso-8859-1'))
+            del self.buffer[:end + 4]
+            self.scanned = 0
+
+        if len(self.buffer) < self.body_length:
+            return None
+        request = self.pending
+        if self.body_length:
+            request.body = bytes(self.buffer[:self.body_length])
+            del self.buffer[:self.body_length]
+        self.pending = None
+        self.body_length = 0
+        return request
+
+    def parse_head(self, head):
+        """
+        Parse the request line and headers.
+        :param head: Request line and headers, without the terminating blank line.
+        :return: Parsed Request and the length of the body that follows it.
+        """
+        lines = head.lstrip('\r\n').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise RequestError(400)
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep or not name or name[-1] in ' \t':
+                raise RequestError(400)
+            name = name.lower()
+            value = value.strip()
+            headers[name] = headers[name] + ', ' + value if name in headers else value
+
+        if 'transfer-encoding' in headers:
+            raise RequestError(501)
+        length = headers.get('content-length', '0')
+        if not length.isdigit():
+            raise RequestError(400)
+        length = int(length)
+        if length > self.MAX_BODY:
+            raise RequestError(413)
+        return Request(parts[0], parts[1], parts[2], headers), length
+
+
+def keep_alive_requested(request):
+    """
+    Decide whether the client wants the connection kept open after the response.
+    :param request: Parsed request.
+    :return: True for persistent connections, False otherwise.
     """
-    Loop recv() function until complete communication is received.
-    :param sock: Socket connection.
-    :return: Data received from connection.
+    connection = (request.header('Connection') or '').lower()
+    if request.version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+def date_header():
+    """
+    Get the Date header line, formatting it at most once per second.
+    :return: Date header line.
+    """
+    global DATE_SECOND, DATE_HEADER
+    now = int(time.time())
+    if now != DATE_SECOND:
+        DATE_HEADER = b"Date: " + email.utils.formatdate(now, usegmt=True).encode() + b"\r\n"
+        DATE_SECOND = now
+    return DATE_HEADER
+
+
+def mime_type_for(file_path):
+    """
+    Look up the type of content from the file extension.
+    :param file_path: Path to resource in web_root.
+    :return: MIME type, or None if the extension is unknown.
+    """
+    return MIME_TYPES.get(os.path.splitext(file_path)[1].lower())
+
+
+def finish_header(http_header, keep_alive):
     """
+    Append the Date and Connection headers and the blank line that ends the header.
+    :param http_header: Response header built by a handler.
+    :param keep_alive: Whether the connection stays open after the response.
+    :return: Complete response header.
+    """
+    return b''.join((http_header, date_header(), CONNECTION_KEEP_ALIVE if keep_alive else CONNECTION_CLOSE))
+
+
+def respond(request, served):
+    """
+    Build the complete response to one request on a connection.
+    :param request: Parsed request.
+    :param served: Number of requests already served on the connection, including this one.
+    :return: Response header, response body and whether to keep the connection open.
+    """
+    http_header, http_body = handle(request)
+    return finish_response(request, served, http_header, http_body)
+
+
+def finish_response(request, served, http_header, http_body):
+    """
+    Decide whether to keep the connection open and complete the response header.
+    :param request: Parsed request.
+    :param served: Number of requests already served on the connection, including this one.
+    :param http_header: Response header built by a handler.
+    :param http_body: Response body.
+    :return: Response header, response body and whether to keep the connection open.
+    """
+    # Close after bad requests, server errors, or when the client or request limit asks to
+    keep_alive = (keep_alive_requested(request) and served < MAX_KEEP_ALIVE_REQUESTS
+                  and http_header[9:12] not in (b'400', b'500'))
+    http_header = finish_header(http_header, keep_alive)
+    return http_header, http_body, keep_alive
+
+
+def body_length(http_body):
+    """
+    Count the bytes in a response body.
+    :param http_body: Body bytes, a FileSegment, or a list of them.
+    :return: Number of bytes.
+    """
+    if isinstance(http_body, list):
+        return sum(body_length(part) for part in http_body)
+    if isinstance(http_body, FileSegment):
+        return http_body.count
+    return len(http_body)
+
+
+def log_request(request, http_header, http_body, started):
+    """
+    Record a sent response in the access log and metrics.
+    :param request: Parsed request, or None if the request could not be parsed.
+    :param http_header: Complete response header.
+    :param http_body: Response body.
+    :param started: time.monotonic() value when the request was parsed.
+    """
+    duration = time.monotonic() - started
+    status = int(http_header[9:12])
+    sent = body_length(http_body)
+    if request is None:
+        ACCESS_LOG.record('-', '-', status, sent, duration)
+        METRICS.observe('unmatched', status, sent, duration)
+        return
+    ACCESS_LOG.record(request.method, request.target, status, sent, duration)
+    # Only routed requests get their own label, so bad paths cannot grow the metrics without bound
+    METRICS.observe(request.route if request.route is not None and status < 400 else 'unmatched',
+                    status, sent, duration)
+
+
+def rejection(response_code):
+    """
+    Build the response for a connection the server gives up on without serving a request.
+    :param response_code: 408 for a client too slow to send its request, 503 when the server is saturated.
+    :return: Complete response header and body.
+    """
+    http_header, http_body = err_response(response_code)
+    if response_code == 503:
+        http_header += RETRY_AFTER_HEADER
+    return finish_header(http_header, False), http_body
+
+
+def reject_connection(client_connection, response_code):
+    """
+    Send a rejection without blocking; a client that cannot take it right away does not get it.
+    :param client_connection: Socket connection.
+    :param response_code: 408 or 503.
+    """
+    started = time.monotonic()
+    http_header, http_body = rejection(response_code)
     try:
-        data = bytearray()
-        while True:
-            part = sock.recv(MAX_PACKET)
-            data += part
-            if len(part) < MAX_PACKET:
-                # either 0 or end of data
-                break
-        return data
+        client_connection.setblocking(False)
+        client_connection.send(http_header + http_body)
+    except OSError:
+        pass
+    log_request(None, http_header, http_body, started)
 
-    except Exception as h:
-        print(h)
-        return err_response(500)
+
+def read_timeout(parser, deadline):
+    """
+    Work out how long to wait for more request bytes. Idle connections wait up to KEEP_ALIVE_TIMEOUT,
+    while a request that has been started must arrive in full within HEADER_TIMEOUT, so clients that
+    trickle bytes cannot hold a connection open.
+    :param parser: Connection's RequestParser.
+    :param deadline: time.monotonic() deadline of the request being received, or None.
+    :return: Seconds to wait, and the deadline of the request being received or None if idle.
+    """
+    if not parser.started():
+        return KEEP_ALIVE_TIMEOUT, None
+    if deadline is None:
+        deadline = time.monotonic() + HEADER_TIMEOUT
+    return deadline - time.monotonic(), deadline
+
+
+def metrics_response(request):
+    """
+    Build the response for a metrics scrape.
+    :param request: Parsed request for METRICS_PATH.
+    :return: Response header and body.
+    """
+    request.route = METRICS_PATH
+    http_body = METRICS.render().encode()
+    http_header = b''.join((STATUS_LINES[200], b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n",
+                            b"Cache-Control: no-store\r\n", b"Content-Length: ", str(len(http_body)).encode(),
+                            b"\r\n"))
+    return http_header, http_body
 
 
 def generate_response_message(response_code):
@@ -88,7 +1067,7 @@ def generate_response_message(response_code):
              "Request</title>\n</head>\n<body>\n    <h1>Bad Request</h1>\n   <p>Your browser sent a request that this "
              "server could not understand.</p>\n   <p>The request line contained invalid characters following the "
              "protocol string.</p>\n</body>\n</html>",
-        404: "<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n<html>\n<head>\n    <title>404 Fot "
+        404: "<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n<html>\n<head>\n    <title>404 Not "
              "Found</title>\n</head>\n<body>\n    <h1>Not Found</h1>\n   <p>The requested URL was not found on this "
              "server.</p>\n</body>\n</html>",
         500: "<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n<html>\n<head>\n    <title>500 Internal Server "
@@ -96,97 +1075,455 @@ def generate_response_message(response_code):
              "wrong.</p>\n</body>\n</html>",
         501: "<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n<html>\n<head>\n    <title>501 Not "
              "Implemented</title>\n</head>\n<body>\n    <h1>Not Implemented</h1>\n   <p>Server does not support the "
-             "functionality required to fulfill the request.</p>\n</body>\n</html>"
+             "functionality required to fulfill the request.</p>\n</body>\n</html>",
+        413: "<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n<html>\n<head>\n    <title>413 Payload Too "
+             "Large</title>\n</head>\n<body>\n    <h1>Payload Too Large</h1>\n   <p>The request body is larger than "
+             "the server is willing to process.</p>\n</body>\n</html>",
+        416: "<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n<html>\n<head>\n    <title>416 Range Not "
+             "Satisfiable</title>\n</head>\n<body>\n    <h1>Range Not Satisfiable</h1>\n   <p>None of the requested "
+             "ranges overlap the current extent of the selected resource.</p>\n</body>\n</html>",
+        431: "<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n<html>\n<head>\n    <title>431 Request Header "
+             "Fields Too Large</title>\n</head>\n<body>\n    <h1>Request Header Fields Too Large</h1>\n   <p>The "
+             "request line and headers are larger than the server is willing to process.</p>\n</body>\n</html>",
+        408: "<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n<html>\n<head>\n    <title>408 Request "
+             "Timeout</title>\n</head>\n<body>\n    <h1>Request Timeout</h1>\n   <p>The server timed out waiting "
+             "for the request.</p>\n</body>\n</html>",
+        503: "<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n<html>\n<head>\n    <title>503 Service "
+             "Unavailable</title>\n</head>\n<body>\n    <h1>Service Unavailable</h1>\n   <p>The server is handling "
+             "too many connections. Please try again shortly.</p>\n</body>\n</html>",
+        502: "<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n<html>\n<head>\n    <title>502 Bad "
+             "Gateway</title>\n</head>\n<body>\n    <h1>Bad Gateway</h1>\n   <p>The hash table returned an invalid "
+             "response.</p>\n</body>\n</html>",
+        504: "<!DOCTYPE HTML PUBLIC \"-//IETF//DTD HTML 2.0//EN\">\n<html>\n<head>\n    <title>504 Gateway "
+             "Timeout</title>\n</head>\n<body>\n    <h1>Gateway Timeout</h1>\n   <p>The hash table did not respond "
+             "in time.</p>\n</body>\n</html>"
     }.get(response_code)
 
 
-def err_response(response_code):
+def build_error_response(response_code, encoding=None):
     """
-    Constructs complete error response.
+    Constructs error response, leaving the Date and Connection headers to the caller.
     :param response_code: Integer representation of HTTP error code.
+    :param encoding: Content coding to compress the body with, if any.
     :return: Complete Error Response.
     """
-    try:
-        response = generate_response_message(response_code)
-        status = (response[(response.find("<title>") + 7):response.find("</title>")])
-        http_header = "HTTP/1.1 " + status + "\r\n"
-        utc_datetime = datetime.utcnow()
-        http_header += "Date: " + utc_datetime.strftime('%a, %d %b %Y %H:%M:%S GMT') + "\r\n"
-        http_header += "Content-Type: text/html\r\n"
-        http_header += "Content-Length: " + str(len(response)) + "\r\n"
-        http_header += "Connection: Close"
-        http_header += "\r\n\r\n"
-        http_body = response
-        http_body += "\r\n\r\n"
-        return http_header.encode(), http_body.encode()
-
-    except Exception as a:
-        print(a)
-        return err_response(500)
+    http_body = generate_response_message(response_code).encode()
+    http_header = [STATUS_LINES[response_code], b"Content-Type: text/html\r\n"]
+    if encoding is not None:
+        http_body = compress(http_body, encoding)
+        http_header.append(b"Content-Encoding: " + encoding.encode() + b"\r\n")
+        http_header.append(b"Vary: Accept-Encoding\r\n")
+    http_header.append(b"Content-Length: " + str(len(http_body)).encode() + b"\r\n")
+    return b''.join(http_header), http_body
+
 
+def err_response(response_code, request=None):
+    """
+    Look up the error response built at startup.
+    :param response_code: Integer representation of HTTP error code.
+    :param request: Parsed request, used to negotiate a compressed body.
+    :return: Complete Error Response.
+    """
+    encoding = choose_encoding(request) if request is not None else None
+    return ERROR_RESPONSES[(response_code, encoding)]
 
-def form_response(contents, file_size, mtime, mime_type):
+
+def form_response(contents, file_size, mtime, mime_type, etag, cache_control, content_encoding=None, vary=False):
     """
-    Constructs complete OK response given type of content requested.
-    :param contents: Contents to send to client.
+    Constructs OK response given type of content requested, leaving the Date and Connection headers
+    to the caller.
+    :param contents: Contents to send to client, as bytes or a FileSegment.
     :param file_size: Size of content requested.
     :param mtime: Time content was last modified.
     :param mime_type: Type of content.
+    :param etag: Entity tag of content.
+    :param cache_control: Cache-Control header value.
+    :param content_encoding: Content coding applied to contents, if any.
+    :param vary: Whether the response depends on Accept-Encoding.
     :return: Complete OK response.
     """
     try:
         # Form Header
-        http_header = "HTTP/1.1 200 OK\r\n"
-        utc_datetime = datetime.utcnow()
-        http_header += "Date: " + utc_datetime.strftime('%a, %d %b %Y %H:%M:%S GMT') + "\r\n"
-        http_header += "Last-Modified: " + datetime.fromtimestamp(mtime).strftime(
-            '%a, %d %b %Y %H:%M:%S GMT') + "\r\n"
-        http_header += "Content-Type: " + str(mime_type) + "\r\n"
-        http_header += "Content-Length: " + file_size + "\r\n"
-        http_header += "Connection: Close"
-        http_header += "\r\n\r\n"
+        http_header = "".join([
+            "Last-Modified: ", email.utils.formatdate(mtime, usegmt=True), "\r\n",
+            "ETag: ", etag, "\r\n",
+            "Cache-Control: ", cache_control, "\r\n",
+            "Accept-Ranges: bytes\r\n",
+            "Content-Type: ", str(mime_type), "\r\n",
+            "Content-Encoding: " + content_encoding + "\r\n" if content_encoding is not None else "",
+            "Vary: Accept-Encoding\r\n" if vary else "",
+            "Content-Length: ", file_size, "\r\n"])
         http_body = contents
-        return http_header.encode(), http_body
+        return STATUS_LINES[200] + http_header.encode(), http_body
 
     except Exception as b:
         print(b)
         return err_response(500)
 
 
-def find_resource(file_path):
+def not_modified_response(mtime, etag, cache_control, vary=False):
     """
-    Get requested resource from web_root.
-    :param file_path: Path to resource in web_root.
-    :return: Call to form_response: Complete OK response.
+    Constructs bodiless Not Modified response, leaving the Date and Connection headers to the caller.
+    :param mtime: Time content was last modified.
+    :param etag: Entity tag of content.
+    :param cache_control: Cache-Control header value.
+    :param vary: Whether the response depends on Accept-Encoding.
+    :return: Complete Not Modified response.
+    """
+    http_header = "".join([
+        "Last-Modified: ", email.utils.formatdate(mtime, usegmt=True), "\r\n",
+        "ETag: ", etag, "\r\n",
+        "Cache-Control: ", cache_control, "\r\n",
+        "Vary: Accept-Encoding\r\n" if vary else ""])
+    return STATUS_LINES[304] + http_header.encode(), b''
+
+
+def parse_range(range_header, size):
+    """
+    Parse a bytes Range header against the size of the resource.
+    :param range_header: Range header value.
+    :param size: Size of the resource.
+    :return: List of inclusive (start, end) byte positions that can be satisfied, or None if the header
+    is malformed or asks for too many ranges and should be ignored.
+    """
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+
+    ranges = []
+    specs = spec.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    for part in specs:
+        first, dash, last = part.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            # Suffix range: the last N bytes
+            if not first:
+                suffix = int(last)
+                if suffix < 0:
+                    return None
+                if suffix > 0 and size > 0:
+                    ranges.append((max(size - suffix, 0), size - 1))
+                continue
+
+            start = int(first)
+            end = int(last) if last else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and end < start):
+            return None
+        if end is None:
+            end = size - 1
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    return ranges
+
+
+def if_range_matches(request, stat, etag):
+    """
+    Evaluate If-Range against the current file.
+    :param request: Parsed request.
+    :param stat: os.stat() result for the file.
+    :param etag: Current entity tag of the file.
+    :return: True if the Range header should be honoured.
+    """
+    if_range = request.header('If-Range')
+    if if_range is None:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    return if_range == email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+
+def range_response(route, request, etag):
+    """
+    Constructs Partial Content response streaming only the requested byte ranges, leaving the Date
+    and Connection headers to the caller.
+    :param route: Indexed file.
+    :param request: Parsed Get Request.
+    :param etag: Current entity tag of the file.
+    :return: Partial Content or Range Not Satisfiable response, or None to send the whole file.
+    """
+    file_path, stat, mime_type, cache_control = route.file_path, route.stat, route.mime_type, route.cache_control
+    range_header = request.header('Range')
+    if range_header is None or not if_range_matches(request, stat, etag):
+        return None
+    ranges = parse_range(range_header, stat.st_size)
+    if ranges is None:
+        return None
+    if not ranges:
+        http_header, http_body = err_response(416)
+        return http_header + b"Content-Range: bytes */" + str(stat.st_size).encode() + b"\r\n", http_body
+
+    http_header = [
+        "Last-Modified: ", email.utils.formatdate(stat.st_mtime, usegmt=True), "\r\n",
+        "ETag: ", etag, "\r\n",
+        "Cache-Control: ", cache_control, "\r\n",
+        "Accept-Ranges: bytes\r\n"]
+
+    # Single range is sent as is
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        http_header += [
+            "Content-Type: ", str(mime_type), "\r\n",
+            "Content-Range: bytes {start}-{end}/{size}\r\n".format(start=start, end=end, size=stat.st_size),
+            "Content-Length: ", str(end - start + 1), "\r\n"]
+        return STATUS_LINES[206] + "".join(http_header).encode(), FileSegment(file_path, start, end - start + 1)
+
+    # Several ranges are sent as multipart/byteranges, each part streamed from the file
+    boundary = os.urandom(12).hex()
+    http_body = []
+    for start, end in ranges:
+        part_header = "\r\n--" + boundary + "\r\n"
+        part_header += "Content-Type: " + str(mime_type) + "\r\n"
+        part_header += "Content-Range: bytes {start}-{end}/{size}\r\n\r\n".format(start=start, end=end,
+                                                                                  size=stat.st_size)
+        http_body.append(part_header.encode())
+        http_body.append(FileSegment(file_path, start, end - start + 1))
+    http_body.append(("\r\n--" + boundary + "--\r\n").encode())
+    length = sum(part.count if isinstance(part, FileSegment) else len(part) for part in http_body)
+    http_header += [
+        "Content-Type: multipart/byteranges; boundary=", boundary, "\r\n",
+        "Content-Length: ", str(length), "\r\n"]
+    return STATUS_LINES[206] + "".join(http_header).encode(), http_body
+
+
+def choose_encoding(request):
+    """
+    Negotiate a content coding from the Accept-Encoding header.
+    :param request: Parsed request.
+    :return: Preferred supported content coding, or None to send the identity coding.
+    """
+    accept_encoding = request.header('Accept-Encoding')
+    if not accept_encoding:
+        return None
+
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip().lower()] = weight
+
+    best, best_weight = None, 0.0
+    for coding in ENCODING_SUFFIXES:
+        weight = weights.get(coding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def compressible(mime_type):
+    """
+    Check whether a content type benefits from compression.
+    :param mime_type: Type of content.
+    :return: True for text-like types, False for already compressed ones.
+    """
+    return mime_type is not None and mime_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def compress(data, encoding):
+    """
+    Compress bytes with the given content coding.
+    :param data: Bytes to compress.
+    :param encoding: Content coding (gzip or br).
+    :return: Compressed bytes.
+    """
+    if encoding == 'br':
+        return brotli.compress(data)
+    return gzip.compress(data, COMPRESS_LEVEL, mtime=0)
+
+
+# Every error response, plain and compressed, built once at startup and keyed by (response code, content coding)
+ERROR_RESPONSES = {(code, encoding): build_error_response(code, encoding)
+                   for code in (400, 404, 408, 413, 416, 431, 500, 501, 502, 503, 504)
+                   for encoding in [None] + list(ENCODING_SUFFIXES)}
+
+
+def compressed_response(route, etag, encoding):
+    """
+    Get a compressed variant of a resource, preferring a precompressed sibling on disk (index.html.gz)
+    and otherwise compressing the file once and keeping the result in the response cache.
+    :param route: Indexed file.
+    :param etag: Entity tag of the compressed variant.
+    :param encoding: Content coding to apply.
+    :return: Compressed OK response, or None if the file is too large to compress on the fly.
+    """
+    file_path, stat, mime_type, cache_control = route.file_path, route.stat, route.mime_type, route.cache_control
+
+    # Precompressed sibling that is at least as new as the original
+    variant = ROUTE_INDEX.lookup(route.url_path + ENCODING_SUFFIXES[encoding])
+    if variant is not None and variant.stat.st_mtime >= stat.st_mtime:
+        contents = FileSegment(variant.file_path, 0, variant.stat.st_size)
+        return form_response(contents, str(variant.stat.st_size), stat.st_mtime, mime_type, etag, cache_control,
+                             encoding, True)
+
+    if stat.st_size > RESPONSE_CACHE.MAX_ENTRY:
+        return None
+
+    # Variants are cached alongside identity responses and revalidated against the original file
+    cache_key = file_path + '\0' + encoding
+    response = RESPONSE_CACHE.get(cache_key, stat)
+    if response is not None:
+        return response
+
+    with open(file_path, "rb") as f:
+        contents = compress(f.read(), encoding)
+    http_header, http_body = form_response(contents, str(len(contents)), stat.st_mtime, mime_type, etag,
+                                           cache_control, encoding, True)
+    RESPONSE_CACHE.put(cache_key, stat, http_header, http_body)
+    return http_header, http_body
+
+
+def make_etag(stat):
+    """
+    Build a strong entity tag from file metadata.
+    :param stat: os.stat() result for the file.
+    :return: Quoted entity tag.
+    """
+    return '"{size:x}-{mtime:x}"'.format(size=stat.st_size, mtime=stat.st_mtime_ns)
+
+
+def cache_control_for(url_path):
+    """
+    Find the Cache-Control value configured for a resource.
+    :param url_path: URL path of the resource.
+    :return: Cache-Control header value.
+    """
+    for rule, value in CACHE_CONTROL_RULES:
+        if url_path.startswith(rule) if rule.startswith('/') else url_path.endswith(rule):
+            return value
+    return CACHE_CONTROL_DEFAULT
+
+
+def not_modified(request, stat, etag):
+    """
+    Evaluate If-None-Match and If-Modified-Since against the current file.
+    :param request: Parsed request.
+    :param stat: os.stat() result for the file.
+    :param etag: Current entity tag of the file.
+    :return: True if the client's copy is current.
+    """
+    if_none_match = request.header('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+    if_modified_since = request.header('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stat.st_mtime) <= since
+    return False
+
+
+def find_resource(url_path, request):
+    """
+    Get requested resource from the web_root index, serving small files from the response cache
+    and streaming larger ones from disk.
+    :param url_path: Normalized URL path of the resource.
+    :param request: Parsed Get Request.
+    :return: Call to form_response: OK response, Not Modified if the client's copy is current,
+    Partial Content for range requests, or Not Found if there is no such file.
     """
     try:
-        # If the file is binary
-        if file_path.find(".jpg") > -1 or file_path.find(".jpeg") > -1 or file_path.find(".png") > -1:
-            f = open(file_path, "rb")
-            contents = bytearray(f.read())
-            f.close()
-            contents += b'\r\n'
-            return form_response(contents, str(len(contents)), os.path.getmtime(file_path),
-                                 mimetypes.MimeTypes().guess_type(file_path)[0])
-
-        # If file is text
-        else:
-            f = open(file_path, "r")
+        route = ROUTE_INDEX.lookup(url_path)
+        if route is None:
+            return err_response(404, request)
+        file_path, stat, mime_type, cache_control = route.file_path, route.stat, route.mime_type, route.cache_control
+
+        etag = make_etag(stat)
+
+        # Compressed variants get their own entity tag; ranges are always served from the identity coding
+        vary = compressible(mime_type)
+        encoding = None
+        if vary and stat.st_size >= COMPRESS_MIN_SIZE and request.header('Range') is None:
+            encoding = choose_encoding(request)
+            if encoding is not None:
+                etag = etag[:-1] + '-' + encoding + '"'
+
+        if not_modified(request, stat, etag):
+            return not_modified_response(stat.st_mtime, etag, cache_control, vary)
+
+        if encoding is not None:
+            response = compressed_response(route, etag, encoding)
+            if response is not None:
+                return response
+            etag = make_etag(stat)
+
+        response = range_response(route, request, etag)
+        if response is not None:
+            return response
+
+        response = RESPONSE_CACHE.get(file_path, stat)
+        if response is not None:
+            return response
+
+        if stat.st_size > RESPONSE_CACHE.MAX_ENTRY:
+            contents = FileSegment(file_path, 0, stat.st_size)
+            return form_response(contents, str(stat.st_size), stat.st_mtime, mime_type, etag, cache_control,
+                                 vary=vary)
+
+        with open(file_path, "rb") as f:
             contents = f.read()
-            f.close()
-            contents += "\r\n"
-            return form_response(contents.encode(), str(len(contents)), os.path.getmtime(file_path),
-                                 mimetypes.MimeTypes().guess_type(file_path)[0])
+        http_header, http_body = form_response(contents, str(len(contents)), stat.st_mtime, mime_type, etag,
+                                               cache_control, vary=vary)
+        RESPONSE_CACHE.put(file_path, stat, http_header, http_body)
+        return http_header, http_body
 
     except Exception as c:
         print(c)
         return err_response(500)
 
 
+def send_body(client_connection, http_body):
+    """
+    Send a response body, streaming file segments straight from the kernel with sendfile.
+    socket.sendfile() falls back to chunked reads where sendfile is unavailable.
+    :param client_connection: Socket connection.
+    :param http_body: Body bytes, a FileSegment, or a list of them.
+    """
+    if isinstance(http_body, list):
+        for part in http_body:
+            send_body(client_connection, part)
+    elif isinstance(http_body, FileSegment):
+        with open(http_body.file_path, "rb") as f:
+            client_connection.sendfile(f, http_body.offset, http_body.count)
+    else:
+        client_connection.sendall(http_body)
+
+
+async def write_body(writer, http_body):
+    """
+    Write a response body to a client stream, streaming file segments with the event loop's
+    sendfile, which falls back to chunked reads when the transport cannot use it.
+    :param writer: Stream writer for the client connection.
+    :param http_body: Body bytes, a FileSegment, or a list of them.
+    """
+    if isinstance(http_body, list):
+        for part in http_body:
+            await write_body(writer, part)
+    elif isinstance(http_body, FileSegment):
+        await writer.drain()
+        with open(http_body.file_path, "rb") as f:
+            await asyncio.get_running_loop().sendfile(writer.transport, f, http_body.offset, http_body.count)
+    else:
+        writer.write(http_body)
+
+
 def handle_file_extension(file_path):
     """
     Extract file extension if available or add general path to index file.
-    :param file_path: Path to resource in web_root.
+    :param file_path: Path to resource.
     :return: Formatted path.
     """
     try:
@@ -205,76 +1542,204 @@ def handle_file_extension(file_path):
         return err_response(500)
 
 
-def handle_get(lines):
+def handle_get(request):
     """
     Check get request and form appropriate response.
-    :param lines: Get Request.
+    :param request: Parsed Get Request.
     :return: Appropriate response for condition.
     """
     try:
-        file_path = "web_root"
+        target = request.target.partition('?')[0]
+        if not target.startswith('/') or "/../" in target or target.endswith('/..') or target.endswith('.'):
+            return err_response(400, request)
+
+        # Collapse repeated and trailing slashes; the index only holds files under web_root
+        url_path = handle_file_extension(posixpath.normpath('/' + target.lstrip('/')))
+        request.route = url_path
+        return find_resource(url_path, request)
+
+    except Exception as e:
+        print(e)
+        return err_response(500)
 
-        http_index = lines.find("HTTP")
-        if http_index == -1 or lines.find("/../") != -1:
-            return err_response(400)
 
-        file_path += (lines[4:http_index - 1])
-        if file_path == "web_root" or file_path.endswith('.'):
-            return err_response(400)
+def kv_request(request):
+    """
+    Check whether a request is for the DHT gateway.
+    :param request: Parsed request.
+    :return: True if the request should be answered from the DHT.
+    """
+    return DHT_GATEWAY is not None and request.target.startswith(KV_PREFIX)
 
-        file_path = handle_file_extension(file_path)
 
-        if path.exists(file_path):
-            return find_resource(file_path)
-        else:
-            return err_response(404)
+def parse_kv_request(request):
+    """
+    Check a DHT gateway request. The DHT protocol separates keys and values with spaces,
+    so neither may contain whitespace.
+    :param request: Parsed request for a path under KV_PREFIX.
+    :return: Error response code or None, followed by the DHT verb, key and value.
+    """
+    request.route = KV_PREFIX
+    if request.method not in ("GET", "PUT"):
+        return 501, None, None, None
+    key = urllib.parse.unquote(request.target[len(KV_PREFIX):].partition('?')[0])
+    if key.split() != [key]:
+        return 400, None, None, None
+    if request.method == "GET":
+        return None, "get", key, None
+    if len(request.body) > DHT_MAX_VALUE:
+        return 413, None, None, None
+    try:
+        value = request.body.decode()
+    except UnicodeDecodeError:
+        return 400, None, None, None
+    # The nodes report removed keys with EMPTY_VALUE, so it cannot be stored as a value
+    if value.split() != [value] or value == dht_gateway.EMPTY_VALUE:
+        return 400, None, None, None
+    return None, "put", key, value
 
-    except Exception as e:
-        print(e)
+
+def kv_response(verb, status, value):
+    """
+    Construct the response to a DHT gateway request.
+    :param verb: DHT verb that was sent.
+    :param status: HTTP status code for the DHT's answer.
+    :param value: Value found by a get.
+    :return: Response header and body.
+    """
+    if status != 200:
+        return err_response(status)
+    if verb == "put":
+        return STATUS_LINES[204] + b"Cache-Control: no-store\r\n", b''
+    http_body = value.encode()
+    return b''.join((STATUS_LINES[200], b"Content-Type: text/plain; charset=utf-8\r\n",
+                     b"Cache-Control: no-store\r\n", b"Content-Length: ", str(len(http_body)).encode(),
+                     b"\r\n")), http_body
+
+
+def handle_kv(request):
+    """
+    Answer a DHT gateway request, waiting for the DHT in the blocking serving modes.
+    :param request: Parsed request for a path under KV_PREFIX.
+    :return: Response header and body.
+    """
+    error, verb, key, value = parse_kv_request(request)
+    if error is not None:
+        return err_response(error, request)
+    return kv_response(verb, *DHT_GATEWAY.call(verb, key, value))
+
+
+async def handle_kv_async(request):
+    """
+    Answer a DHT gateway request without blocking the event loop.
+    :param request: Parsed request for a path under KV_PREFIX.
+    :return: Response header and body.
+    """
+    try:
+        error, verb, key, value = parse_kv_request(request)
+        if error is not None:
+            return err_response(error, request)
+        return kv_response(verb, *(await DHT_GATEWAY.call_async(verb, key, value)))
+    except Exception as k:
+        print(k)
         return err_response(500)
 
 
-def handle(lines):
+def handle(request):
     """
     Handle received request from client.
-    :param lines: Request from client.
+    :param request: Parsed request from client.
     :return: Appropriate response for condition.
     """
     try:
-        if "GET" in lines:
-            return handle_get(lines)
+        if kv_request(request):
+            return handle_kv(request)
+        if request.method == "GET":
+            if METRICS_PATH is not None and request.target.partition('?')[0] == METRICS_PATH:
+                return metrics_response(request)
+            return handle_get(request)
         else:
-            return err_response(501)
+            return err_response(501, request)
     except Exception as f:
         print(f)
         return err_response(500)
 
 
-def serve():
+def serve_connection(client_connection):
     """
-    Listens for client connections until stopped.
+    Serve requests from a connected client in order until it closes the connection,
+    goes idle, or reaches the request limit.
+    :param client_connection: Socket connection.
     """
-
-    # Set up socket and listen for connections on specified port
+    parser = RequestParser()
+    served = 0
+    deadline = None
     try:
-        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listen_socket.bind(SERVER_ADDRESS)
-        listen_socket.listen(REQUEST_QUEUE_SIZE)
-    except PermissionError as x:
-        print(x)
-        os._exit(0)
+        while True:
+            try:
+                request = parser.next_request()
+            except RequestError as r:
+                started = time.monotonic()
+                http_header, http_body = err_response(r.response_code)
+                http_header = finish_header(http_header, False)
+                client_connection.sendall(http_header + http_body)
+                log_request(None, http_header, http_body, started)
+                break
+            if request is None:
+                timeout, deadline = read_timeout(parser, deadline)
+                try:
+                    if timeout <= 0:
+                        raise socket.timeout()
+                    client_connection.settimeout(timeout)
+                    part = client_connection.recv(MAX_PACKET)
+                except socket.timeout:
+                    if deadline is not None:
+                        reject_connection(client_connection, 408)
+                    break
+                if not part:
+                    break
+                parser.feed(part)
+                continue
+
+            served += 1
+            deadline = None
+            started = time.monotonic()
+            http_header, http_body, keep_alive = respond(request, served)
+            # sendall() and sendfile() treat the timeout as a limit on the whole send
+            client_connection.settimeout(WRITE_TIMEOUT)
+            if isinstance(http_body, bytes):
+                client_connection.sendall(http_header + http_body)
+            else:
+                client_connection.sendall(http_header)
+                send_body(client_connection, http_body)
+            log_request(request, http_header, http_body, started)
+            if not keep_alive:
+                break
+    except socket.timeout:
+        pass
     finally:
-        print('Serving HTTP on port {port} ...'.format(port=PORT))
+        client_connection.close()
+
+
+def serve_fork(listen_socket):
+    """
+    Accept connections and break off a child process to serve each one.
+    :param listen_socket: Listening socket.
+    """
 
     # Set up async handler
     signal.signal(signal.SIGCHLD, end_service)
+    METRICS.open_retire_pipe()
+    # Wake up at least once per flush interval to publish the totals of children that have exited
+    listen_socket.settimeout(TELEMETRY_FLUSH_INTERVAL)
+    published = 0.0
+    unpublished = False
 
-    # Core Functionality
-    # Accept connections and break off child process to serve individual connections
     while True:
         try:
             client_connection, client_address = listen_socket.accept()
+        except socket.timeout:
+            client_connection = None
         except IOError as x:
             code, msg = x.args
             # restart 'accept' if it was interrupted
@@ -283,21 +1748,382 @@ def serve():
             else:
                 raise
 
+        # The parent serves no requests, so it publishes its refusals and its children's totals itself
+        unpublished = METRICS.fold_retired() or unpublished
+        if unpublished and time.monotonic() - published >= TELEMETRY_FLUSH_INTERVAL:
+            ACCESS_LOG.flush()
+            METRICS.flush()
+            published = time.monotonic()
+            unpublished = False
+        if client_connection is None:
+            continue
+
+        # Children inherit the index, so keep the parent's copy current
+        ROUTE_INDEX.maybe_refresh()
+
+        # Free the slots of children that have exited, then admit or refuse the new connection
+        while FINISHED_CHILDREN:
+            client_ip = CHILDREN.pop(FINISHED_CHILDREN.pop(), None)
+            if client_ip is not None:
+                CONNECTION_LIMITER.release(client_ip)
+        client_ip = client_address[0]
+        if not CONNECTION_LIMITER.admit(client_ip):
+            reject_connection(client_connection, 503)
+            client_connection.close()
+            unpublished = True
+            continue
+
         pid = os.fork()
         if pid == 0:  # child
             listen_socket.close()  # close child copy
-            request = recv_all(client_connection)
-            lines = split_lines(request.decode())
-            print("\nReceived Request...\nRequest:\n" + lines)
-            http_header, http_body = handle(lines)
-            print("Outgoing Response Header:\n" + http_header.decode())
-            client_connection.sendall(http_header)
-            client_connection.sendall(http_body)
-            client_connection.close()
-            os._exit(0)
+            try:
+                serve_connection(client_connection)
+            finally:
+                stop_telemetry()
+                os._exit(0)
         else:  # parent
+            CHILDREN[pid] = client_ip
             client_connection.close()  # close parent copy and loop over
 
 
+def worker_loop(listen_socket):
+    """
+    Accept and serve connections on a shared listening socket until the process is killed.
+    :param listen_socket: Listening socket shared with the other workers.
+    """
+    start_telemetry()
+    try:
+        while True:
+            try:
+                client_connection, client_address = listen_socket.accept()
+            except InterruptedError:
+                continue
+            try:
+                serve_connection(client_connection)
+            except Exception as w:
+                print(w)
+                client_connection.close()
+    finally:
+        stop_telemetry()
+
+
+def pin_worker(index):
+    """
+    Pin the calling worker process to one CPU, spreading workers round-robin over the CPUs
+    this process may run on.
+    :param index: Worker number.
+    """
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+    except (AttributeError, OSError) as t:
+        print(t)
+
+
+def spawn_worker(target, index):
+    """
+    Fork a long-lived worker process.
+    :param target: Function the worker runs until it is killed.
+    :param index: Worker number, used for CPU pinning.
+    :return: Process ID of the worker.
+    """
+    pid = os.fork()
+    if pid == 0:  # worker
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, exit_process)
+        if PIN_WORKERS:
+            pin_worker(index)
+        try:
+            target()
+        finally:
+            os._exit(0)
+    return pid
+
+
+def stop_workers(workers):
+    """
+    Terminate and reap every worker process.
+    :param workers: Process IDs of running workers.
+    """
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+
+def supervise(target):
+    """
+    Start a fixed pool of worker processes and restart any worker that dies.
+    :param target: Function each worker runs until it is killed.
+    """
+    signal.signal(signal.SIGTERM, exit_process)
+    workers = {}
+    started = {}
+    try:
+        for index in range(WORKER_COUNT):
+            pid = spawn_worker(target, index)
+            workers[pid] = index
+            started[index] = time.monotonic()
+        print('Started {count} workers'.format(count=WORKER_COUNT))
+
+        # Supervise workers and replace any that exit
+        while True:
+            try:
+                pid, status = os.wait()
+            except InterruptedError:
+                continue
+            index = workers.pop(pid, None)
+            if index is None:
+                continue
+            print('Worker {pid} exited, restarting'.format(pid=pid))
+
+            # Back off if the worker is failing right after start
+            if time.monotonic() - started[index] < WORKER_RESTART_DELAY:
+                time.sleep(WORKER_RESTART_DELAY)
+            pid = spawn_worker(target, index)
+            workers[pid] = index
+            started[index] = time.monotonic()
+    finally:
+        stop_workers(workers)
+
+
+def serve_prefork(listen_socket):
+    """
+    Start a pool of worker processes that accept on the shared listening socket.
+    :param listen_socket: Listening socket.
+    """
+    supervise(lambda: worker_loop(listen_socket))
+
+
+def serve_reuseport():
+    """
+    Start a pool of worker processes that each bind their own SO_REUSEPORT listening socket on the
+    same port and run an event loop on it, so the kernel spreads new connections across workers
+    and no single accept queue is shared between them.
+    """
+
+    def run():
+        serve_events(create_listener(True))
+
+    supervise(run)
+
+
+async def serve_stream(reader, writer):
+    """
+    Serve requests from a client stream in order until it closes the connection,
+    goes idle, or reaches the request limit.
+    :param reader: Stream reader for the client connection.
+    :param writer: Stream writer for the client connection.
+    """
+    peer = writer.get_extra_info('peername')
+    client_ip = peer[0] if peer else ''
+    if not CONNECTION_LIMITER.admit(client_ip):
+        started = time.monotonic()
+        http_header, http_body = rejection(503)
+        writer.write(http_header + http_body)
+        writer.close()
+        log_request(None, http_header, http_body, started)
+        return
+
+    parser = RequestParser()
+    served = 0
+    deadline = None
+    try:
+        while True:
+            try:
+                request = parser.next_request()
+            except RequestError as r:
+                started = time.monotonic()
+                http_header, http_body = err_response(r.response_code)
+                http_header = finish_header(http_header, False)
+                writer.write(http_header + http_body)
+                await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+                log_request(None, http_header, http_body, started)
+                break
+            if request is None:
+                timeout, deadline = read_timeout(parser, deadline)
+                try:
+                    part = await asyncio.wait_for(reader.read(MAX_PACKET), max(timeout, 0))
+                except asyncio.TimeoutError:
+                    if deadline is not None:
+                        started = time.monotonic()
+                        http_header, http_body = rejection(408)
+                        writer.write(http_header + http_body)
+                        log_request(None, http_header, http_body, started)
+                    break
+                if not part:
+                    break
+                parser.feed(part)
+                continue
+
+            served += 1
+            deadline = None
+            started = time.monotonic()
+            if kv_request(request):
+                http_header, http_body = await handle_kv_async(request)
+                http_header, http_body, keep_alive = finish_response(request, served, http_header, http_body)
+            else:
+                http_header, http_body, keep_alive = respond(request, served)
+            if isinstance(http_body, bytes):
+                writer.write(http_header + http_body)
+            else:
+                writer.write(http_header)
+                await asyncio.wait_for(write_body(writer, http_body), WRITE_TIMEOUT)
+            # Only wait when the client is not keeping up with what has been written
+            if writer.transport.get_write_buffer_size():
+                await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+            log_request(request, http_header, http_body, started)
+            if not keep_alive:
+                break
+    except asyncio.TimeoutError:
+        # A client that stops reading would keep a closing transport waiting on its buffer forever
+        writer.transport.abort()
+    except Exception as v:
+        print(v)
+    finally:
+        CONNECTION_LIMITER.release(client_ip)
+        writer.close()
+
+
+def raise_file_limit():
+    """
+    Raise the soft limit on open file descriptors to the hard limit so one process can hold
+    many concurrent connections.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as u:
+            print(u)
+
+
+def serve_events(listen_socket):
+    """
+    Multiplex every client connection on a single asyncio event loop.
+    :param listen_socket: Listening socket.
+    """
+
+    async def run():
+        server = await asyncio.start_server(serve_stream, sock=listen_socket, backlog=REQUEST_QUEUE_SIZE)
+        async with server:
+            await server.serve_forever()
+
+    raise_file_limit()
+    start_telemetry()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_telemetry()
+
+
+def create_listener(reuse_port=False):
+    """
+    Set up socket and listen for connections on specified port.
+    :param reuse_port: Whether to set SO_REUSEPORT so several processes can bind the same port.
+    :return: Listening socket.
+    """
+    try:
+        # An explicit IPPROTO_TCP lets asyncio recognise accepted sockets as TCP and disable Nagle on them;
+        # the blocking modes inherit TCP_NODELAY from the listener, so headers and bodies are not held back
+        # waiting for the client's delayed ACK.
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listen_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if reuse_port:
+            listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listen_socket.bind(SERVER_ADDRESS)
+        listen_socket.listen(REQUEST_QUEUE_SIZE)
+        return listen_socket
+    except PermissionError as x:
+        print(x)
+        os._exit(0)
+
+
+def serve():
+    """
+    Listens for client connections until stopped.
+    """
+    global DHT_GATEWAY
+    ROUTE_INDEX.build()
+    print('Indexed {count} files under {root}'.format(count=len(ROUTE_INDEX.routes), root=WEB_ROOT))
+    if DHT_HOST_FILE is not None:
+        # A fork-mode child serves one connection and exits, so a pool or cache would not outlive it
+        one_connection = SERVE_MODE == 'fork'
+        DHT_GATEWAY = dht_gateway.DHTGateway(DHT_HOST_FILE, 1 if one_connection else DHT_POOL_SIZE, DHT_TIMEOUT,
+                                             DHT_RETRIES, DHT_CACHE_TTL, 0 if one_connection else DHT_CACHE_SIZE)
+        print('Serving {prefix} from {count} DHT nodes'.format(prefix=KV_PREFIX, count=len(DHT_GATEWAY.addresses)))
+    signal.signal(signal.SIGUSR1, report_cache)
+    signal.signal(signal.SIGTERM, exit_process)
+
+    # Requests are served by several processes outside event mode, so they share metrics through a directory
+    if METRICS_PATH is not None and SERVE_MODE != 'event':
+        METRICS.directory = tempfile.mkdtemp(prefix='http_svr_metrics.')
+    try:
+        # Workers bind their own sockets in reuseport mode
+        if SERVE_MODE == 'reuseport':
+            print('Serving HTTP on port {port} ...'.format(port=PORT))
+            serve_reuseport()
+            return
+
+        listen_socket = create_listener()
+        print('Serving HTTP on port {port} ...'.format(port=PORT))
+
+        # Core Functionality
+        if SERVE_MODE == 'prefork':
+            serve_prefork(listen_socket)
+        elif SERVE_MODE == 'event':
+            serve_events(listen_socket)
+        else:
+            serve_fork(listen_socket)
+    finally:
+        if METRICS.directory is not None:
+            shutil.rmtree(METRICS.directory, ignore_errors=True)
+
+
 if __name__ == '__main__':
+
+    # Check Command Line args
+    # Usage: http_svr.py [-l <access log>] [-m <metrics path>] [-d <DHT host file>] <port> [mode] [workers]
+    #                    [backlog] [pin]
+    while len(sys.argv) > 2 and sys.argv[1] in ("-l", "-m", "-d"):
+        if sys.argv[1] == "-l":
+            ACCESS_LOG_PATH = ACCESS_LOG.PATH = sys.argv[2]
+        elif sys.argv[1] == "-m":
+            METRICS_PATH = sys.argv[2]
+        else:
+            DHT_HOST_FILE = sys.argv[2]
+        del sys.argv[1:3]
+    if len(sys.argv) > 1:
+        try:
+            isinstance(int(sys.argv[1]), int)
+            if len(sys.argv) > 2:
+                SERVE_MODE = sys.argv[2]
+                if SERVE_MODE not in SERVE_MODES:
+                    raise ValueError(SERVE_MODE)
+            if len(sys.argv) > 3:
+                WORKER_COUNT = int(sys.argv[3])
+            if len(sys.argv) > 4:
+                REQUEST_QUEUE_SIZE = int(sys.argv[4])
+            if len(sys.argv) > 5:
+                if sys.argv[5] != 'pin':
+                    raise ValueError(sys.argv[5])
+                PIN_WORKERS = True
+        except ValueError as z:
+            print("Please provide a valid port number, mode (" + ", ".join(SERVE_MODES) +
+                  "), worker count, backlog and optionally 'pin' to pin workers to CPUs.")
+            os._exit(0)
+        finally:
+            SERVER_ADDRESS = (HOST, PORT) = '', int(sys.argv[1])
+    else:
+        print("Please provide a valid port number.")
+        os._exit(0)
     serve()